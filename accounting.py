@@ -0,0 +1,242 @@
+"""トークン・料金・レイテンシの集計（セッション × モデル × コマンド）。
+
+プロバイダが使用量を返した場合はその値を使い、返さなかった項目だけローカルのトークナイザーで推定する。
+推定はメッセージ本文のハッシュごとにメモ化するので、長い会話でも履歴全体を毎回数え直さない。
+"""
+import csv
+import hashlib
+import io
+import json
+import os
+import re
+import time
+from collections import OrderedDict
+from dataclasses import asdict, dataclass, field
+from typing import Iterable, Optional
+
+from tracing import TraceExporter
+
+# 使用量の記録を1件ずつ追記する JSONL（未指定なら書き出さない）
+USAGE_EXPORT_PATH = os.getenv("USAGE_EXPORT_PATH")
+# トークン数のメモ化件数
+TOKEN_CACHE_SIZE = int(os.getenv("USAGE_TOKEN_CACHE_SIZE", "20000"))
+# メモリに保持する記録の上限（古いものから捨てる。全件が必要なら USAGE_EXPORT_PATH を使う）
+USAGE_MAX_RECORDS = int(os.getenv("USAGE_MAX_RECORDS", "100000"))
+
+# 100万トークンあたりの USD（入力, 出力, キャッシュ済み入力）。公開価格の参考値で、モデル名の前方一致で引く。
+# USAGE_PRICES_PATH に同じ形の JSON（{"model-prefix": [in, out, cached]}）を置くと上書きできる。
+MODEL_PRICES = {
+    "gpt-4o-mini": (0.15, 0.60, 0.075),
+    "gpt-4o": (2.50, 10.00, 1.25),
+    "gpt-4.1-mini": (0.40, 1.60, 0.10),
+    "gpt-4.1": (2.00, 8.00, 0.50),
+    "gpt-5-nano": (0.05, 0.40, 0.005),
+    "gpt-5-mini": (0.25, 2.00, 0.025),
+    "gpt-5-pro": (15.00, 120.00, 15.00),
+    "gpt-5": (1.25, 10.00, 0.125),
+    "gemini-2.5-flash-lite": (0.10, 0.40, 0.025),
+    "gemini-2.5-flash": (0.30, 2.50, 0.075),
+    "gemini-flash-latest": (0.30, 2.50, 0.075),
+    "gemini-2.5-pro": (1.25, 10.00, 0.31),
+    "claude-opus-4": (15.00, 75.00, 1.50),
+    "claude-sonnet-4": (3.00, 15.00, 0.30),
+    "claude-3-7-sonnet": (3.00, 15.00, 0.30),
+    "grok-4-fast": (0.20, 0.50, 0.05),
+    "grok-code-fast": (0.20, 1.50, 0.02),
+    "grok-4": (3.00, 15.00, 0.75),
+}
+if os.getenv("USAGE_PRICES_PATH"):
+    with open(os.getenv("USAGE_PRICES_PATH"), encoding="utf-8") as f:
+        MODEL_PRICES.update({k: tuple(v) for k, v in json.load(f).items()})
+
+
+def model_price(model: str) -> Optional[tuple]:
+    """最も長く一致する接頭辞の価格を返す（gpt-4o-mini が gpt-4o に負けないように）。"""
+    best = None
+    for prefix, price in MODEL_PRICES.items():
+        if model.startswith(prefix) and (best is None or len(prefix) > len(best[0])):
+            best = (prefix, price)
+    return best[1] if best else None
+
+
+# --- トークン数の推定 ---
+try:
+    import tiktoken
+
+    _encoding = tiktoken.get_encoding("o200k_base")
+except Exception:  # tiktoken が無い / エンコーディングを取得できない環境では文字種から推定する
+    _encoding = None
+
+_CJK_RE = re.compile(r"[぀-ヿ㐀-鿿豈-﫿가-힯]")
+_token_cache: "OrderedDict[bytes, int]" = OrderedDict()
+
+
+def _estimate(text: str) -> int:
+    if _encoding is not None:
+        return len(_encoding.encode(text, disallowed_special=()))
+    cjk = len(_CJK_RE.findall(text))
+    # 日本語・中国語はおおむね1文字1トークン、それ以外は4文字1トークン程度
+    return cjk + max(0, len(text) - cjk + 3) // 4
+
+
+def count_tokens(text: Optional[str]) -> int:
+    """テキストのトークン数（本文のハッシュでメモ化）。"""
+    if not text:
+        return 0
+    key = hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest()
+    cached = _token_cache.get(key)
+    if cached is not None:
+        _token_cache.move_to_end(key)
+        return cached
+    count = _estimate(text)
+    _token_cache[key] = count
+    if len(_token_cache) > TOKEN_CACHE_SIZE:
+        _token_cache.popitem(last=False)
+    return count
+
+
+def count_prompt_tokens(system_prompt: str, messages: Iterable) -> int:
+    """システムプロンプト＋履歴の入力トークン数（メッセージごとにメモ化されるので増分だけ数える）。"""
+    return count_tokens(system_prompt) + sum(count_tokens(getattr(m, "content", m)) for m in messages)
+
+
+# --- 記録と集計 ---
+@dataclass
+class UsageRecord:
+    session_id: str
+    provider: str
+    model: str
+    command: str  # "chat" / "Picture" / "slide" など
+    input_tokens: int = 0
+    output_tokens: int = 0
+    cached_tokens: int = 0
+    estimated: bool = False  # プロバイダが返さず推定した項目がある
+    ttft_ms: Optional[float] = None
+    total_ms: Optional[float] = None
+    cost_usd: Optional[float] = None
+    ts: float = field(default_factory=time.time)
+
+
+def estimate_cost(model: str, input_tokens: int, output_tokens: int, cached_tokens: int = 0) -> Optional[float]:
+    price = model_price(model)
+    if price is None:
+        return None
+    p_in, p_out, p_cached = price
+    uncached = max(0, input_tokens - cached_tokens)
+    return round((uncached * p_in + cached_tokens * p_cached + output_tokens * p_out) / 1_000_000, 6)
+
+
+class UsageLedger:
+    """使用量の記録をプロセス内に保持し、セッション・モデル・コマンド別に集計する。"""
+
+    def __init__(self, export_path: Optional[str] = USAGE_EXPORT_PATH, max_records: int = USAGE_MAX_RECORDS):
+        self.records: list[UsageRecord] = []
+        self.max_records = max_records
+        self._exporter = TraceExporter(export_path) if export_path else None
+
+    def record(
+        self,
+        session_id: str,
+        provider: str,
+        model: str,
+        command: str,
+        usage: Optional[dict] = None,
+        prompt_tokens: Optional[int] = None,
+        completion_text: str = "",
+        ttft_ms: Optional[float] = None,
+        total_ms: Optional[float] = None,
+    ) -> UsageRecord:
+        """usage（input_tokens / output_tokens / cached_tokens）の欠けている項目は推定で補う。
+
+        prompt_tokens は推定用の入力トークン数（count_prompt_tokens の結果）。
+        """
+        usage = usage or {}
+        estimated = False
+        input_tokens = usage.get("input_tokens")
+        if input_tokens is None:
+            input_tokens, estimated = prompt_tokens or 0, True
+        output_tokens = usage.get("output_tokens")
+        if output_tokens is None:
+            output_tokens, estimated = count_tokens(completion_text), True
+        cached_tokens = usage.get("cached_tokens") or 0
+        rec = UsageRecord(
+            session_id=session_id,
+            provider=provider,
+            model=model,
+            command=command,
+            input_tokens=input_tokens,
+            output_tokens=output_tokens,
+            cached_tokens=cached_tokens,
+            estimated=estimated,
+            ttft_ms=ttft_ms,
+            total_ms=total_ms,
+            cost_usd=estimate_cost(model, input_tokens, output_tokens, cached_tokens),
+        )
+        self.records.append(rec)
+        if len(self.records) > self.max_records:
+            del self.records[: len(self.records) - self.max_records]
+        if self._exporter is not None:
+            self._exporter.submit(asdict(rec))
+        return rec
+
+    def summarize(self, session_id: Optional[str] = None, by: tuple = ("model", "command")) -> list[dict]:
+        """by の組ごとの件数・トークン・料金・レイテンシ（平均 / p95）を料金の多い順に返す。"""
+        groups: dict[tuple, list[UsageRecord]] = {}
+        for rec in self.records:
+            if session_id is not None and rec.session_id != session_id:
+                continue
+            groups.setdefault(tuple(getattr(rec, k) for k in by), []).append(rec)
+        rows = []
+        for key, recs in groups.items():
+            latencies = sorted(r.total_ms for r in recs if r.total_ms is not None)
+            ttfts = [r.ttft_ms for r in recs if r.ttft_ms is not None]
+            costs = [r.cost_usd for r in recs if r.cost_usd is not None]
+            rows.append({
+                **dict(zip(by, key)),
+                "requests": len(recs),
+                "input_tokens": sum(r.input_tokens for r in recs),
+                "output_tokens": sum(r.output_tokens for r in recs),
+                "cached_tokens": sum(r.cached_tokens for r in recs),
+                "estimated": sum(r.estimated for r in recs),
+                "cost_usd": round(sum(costs), 6) if costs else None,
+                "avg_ttft_ms": round(sum(ttfts) / len(ttfts), 1) if ttfts else None,
+                "avg_ms": round(sum(latencies) / len(latencies), 1) if latencies else None,
+                "p95_ms": latencies[max(0, int(len(latencies) * 0.95) - 1)] if latencies else None,
+            })
+        rows.sort(key=lambda r: (r["cost_usd"] or 0, r["requests"]), reverse=True)
+        return rows
+
+    def to_csv(self, session_id: Optional[str] = None) -> str:
+        """記録を CSV 文字列にする（エクスポート用）。"""
+        buf = io.StringIO()
+        names = list(UsageRecord.__dataclass_fields__)
+        writer = csv.DictWriter(buf, fieldnames=names)
+        writer.writeheader()
+        for rec in self.records:
+            if session_id is None or rec.session_id == session_id:
+                writer.writerow(asdict(rec))
+        return buf.getvalue()
+
+
+def format_summary(rows: list[dict]) -> str:
+    """集計結果を Markdown の表にする（/usage コマンド用）。"""
+    if not rows:
+        return "まだ記録がありません。"
+    def ms(v):
+        return "-" if v is None else f"{v:.0f} ms"
+    lines = [
+        "| モデル | コマンド | 回数 | 入力 | 出力 | キャッシュ | 推定 | 料金 (USD) | TTFT 平均 | 平均 | p95 |",
+        "|---|---|---:|---:|---:|---:|---:|---:|---:|---:|---:|",
+    ]
+    for r in rows:
+        cost = "-" if r["cost_usd"] is None else f"{r['cost_usd']:.4f}"
+        lines.append(
+            f"| {r['model']} | {r['command']} | {r['requests']} | {r['input_tokens']:,} | {r['output_tokens']:,} | "
+            f"{r['cached_tokens']:,} | {r['estimated']} | {cost} | {ms(r['avg_ttft_ms'])} | {ms(r['avg_ms'])} | {ms(r['p95_ms'])} |"
+        )
+    total = sum(r["cost_usd"] or 0 for r in rows)
+    lines.append(f"\n合計: {sum(r['requests'] for r in rows)} 回 / 約 ${total:.4f}（料金は公開価格からの概算。推定 = 使用量をローカルで推定した回数）")
+    return "\n".join(lines)
+
+
+usage_ledger = UsageLedger()
@@ -4,19 +4,38 @@ import json
 import asyncio
 import time
 import base64
+from contextlib import aclosing
 import chainlit as cl
 from chainlit.input_widget import Select, Switch
 from typing import Optional
 
 
 # --- Provider SDKs ---
-from openai import OpenAI, AsyncOpenAI
+from openai import AsyncOpenAI
 from anthropic import AsyncAnthropic
 from xai_sdk import Client
-from xai_sdk.chat import user, system,assistant
-from xai_sdk.search import SearchParameters
 from google import genai
-from google.genai.types import Tool, GenerateContentConfig, GoogleSearch, UrlContext
+
+# --- アップロードファイル ---
+from uploads import upload_elements, hash_element
+from retrieval import BM25Index, SHARED_INDEX_ENABLED, shared_index, index_file, is_indexable, format_context, TOP_K
+from tool_router import MCP, OPENAI_ALL_TOOLS, openai_tools_for, select_tool_kinds
+from mcp_pool import MCPClientManager, load_server_configs
+from providers import ProviderClients, TurnRequest, TurnResult, stream_turn, MISSING_KEY_MESSAGES
+from singleflight import SingleFlight, SINGLEFLIGHT_ENABLED, SINGLEFLIGHT_SCOPE, coalesce_key
+from stream_pipe import StreamPipe
+from voice import VoiceInput, Speaker, pick_transcriber, latency_report, VOICE_TTS_ENABLED, VOICE_TTS_MODEL
+from speculative import DRAFT_MODE_DEFAULT, wants_draft, pick_draft_model, draft_request, draft_then_refine
+from profiling import profiled, PROFILE_COMMAND, PROFILE_DIR
+from warmup import ProviderWarmer
+from tracing import traced_step, TRACE_INSTRUMENT_OPENAI
+from status import StatusManager
+from workbench import update_workbench, resync_workbench, stream_output
+from exec_pool import ExecPool
+from search_index import search_index, SEARCH_INDEX_ENABLED, format_hits
+from accounting import usage_ledger, count_prompt_tokens, format_summary
+from batch_jobs import BatchJobQueue, batch_clients_from_env, SUPPORTED_PROVIDERS as BATCH_PROVIDERS, COMPLETED
+from slides import normalize_slides, open_slide_deck, resync_slide_deck, update_slide
 
 # --- Langchain Core ---
 from langchain_core.messages import SystemMessage, HumanMessage, AIMessage
@@ -37,14 +56,42 @@ ANTHROPIC_API_KEY = os.getenv("ANTHROPIC_API_KEY")
 XAI_API_KEY = os.getenv("XAI_API_KEY")
 
 # クライアントはグローバルに初期化しておくと効率的
-openai_client = OpenAI(api_key=OPENAI_API_KEY) if OPENAI_API_KEY else None
 openai_async_client = AsyncOpenAI(api_key=OPENAI_API_KEY) if OPENAI_API_KEY else None
 anthropic_client = AsyncAnthropic(api_key=ANTHROPIC_API_KEY) if ANTHROPIC_API_KEY else None
 xai_client = Client(api_key=XAI_API_KEY) if XAI_API_KEY else None
 gemini_client = genai.Client(api_key=GOOGLE_API_KEY) if GOOGLE_API_KEY else None
+# 応答のストリーミング（providers.py）で使うクライアント
+provider_clients = ProviderClients(openai=openai_async_client, anthropic=anthropic_client, gemini=gemini_client, xai=xai_client)
+
+# --- 接続の事前ウォームアップ（各プロバイダのモデル情報を取得して接続プールを温める） ---
+WARMUP_ENABLED = os.getenv("WARMUP_ENABLED", "1") != "0"
+
+async def _warm_openai(model: str):
+    return await openai_async_client.models.retrieve(model)
+
+async def _warm_claude(model: str):
+    return await anthropic_client.models.retrieve(model)
+
+async def _warm_gemini(model: str):
+    return await gemini_client.aio.models.get(model=model)
 
-# Chainlitのトレース機能
-cl.instrument_openai()
+async def _warm_grok(model: str):
+    return await asyncio.to_thread(xai_client.models.get_language_model, model)
+
+provider_warmer = ProviderWarmer({
+    name: fn
+    for name, fn, client in (
+        ("openai", _warm_openai, openai_async_client),
+        ("claude", _warm_claude, anthropic_client),
+        ("gemini", _warm_gemini, gemini_client),
+        ("grok", _warm_grok, xai_client),
+    )
+    if client is not None
+})
+
+# Chainlitのトレース機能（TRACE_SAMPLE_RATE < 1 のときは既定で無効。tracing.py 参照）
+if TRACE_INSTRUMENT_OPENAI:
+    cl.instrument_openai()
 
 # --- モデルリストの定義 ---
 AVAILABLE_MODELS = [
@@ -107,23 +154,246 @@ DEFAULT_PROMPT_INDEX = 0
 COMMANDS_BASE = [
     { "id": "Picture",   "label": "Picture",   "icon": "image",  "description": "Use gpt4.1-mini to generate an image" },
     { "id": "Code", "label": "Code", "icon": "code", "description": "Open the coding workbench (editor/preview)" },
-    { "id": "slide", "label": "Slide", "icon": "presentation", "description": "Generate a slide presentation from text" },
+    { "id": "slide", "label": "Slide", "icon": "presentation", "description": "Generate a slide presentation from text (\"3: 指示\" で表示中の3枚目だけを作り直す)" },
+    { "id": "Batch", "label": "Batch", "icon": "layers", "description": "Submit each line as a Batch API job (empty: job status)" },
 ]
 
 # コマンドは画像系のみ表示（Toolsトグルは設定パネルのスイッチで管理）
 
-# OpenAI用のツール定義（有効時のみ付与）
-OPENAI_ALL_TOOLS = [
-    {"type": "web_search"},
-    {"type": "code_interpreter", "container": {"type": "auto"}},
-    {"type": "image_generation"},
-    {
-        "type": "mcp",
-        "server_label": "deepwiki",
-        "server_url": "https://mcp.deepwiki.com/mcp",
-        "require_approval": "never",
-    },
-]
+# --- MCP: 設定済みサーバーへのウォームな接続を全セッションで共有 ---
+# 既定では OPENAI_ALL_TOOLS の MCP サーバーを対象にする（MCP_SERVERS で JSON ファイルを指定すると上書き）
+# OpenAI のターンでは、これらのツールを function ツールとして渡し、呼び出しはこのプールから実行する
+MCP_WARMUP = os.getenv("MCP_WARMUP", "1") != "0"
+mcp_manager = MCPClientManager(load_server_configs([
+    {"name": t["server_label"], "transport": "streamable-http", "url": t["server_url"]}
+    for t in OPENAI_ALL_TOOLS if t["type"] == "mcp"
+]))
+_mcp_warmup_task: Optional[asyncio.Task] = None
+
+def ensure_mcp_warm() -> None:
+    """初回のチャット開始時に、バックグラウンドで MCP 接続とツール一覧を温めておく。"""
+    global _mcp_warmup_task
+    if MCP_WARMUP and _mcp_warmup_task is None and mcp_manager.configs:
+        _mcp_warmup_task = asyncio.create_task(mcp_manager.warm_up())
+
+@cl.on_mcp_connect
+async def on_mcp_connect(connection, session):
+    """UI から追加された MCP サーバーのツール名をセッションに控える（接続は Chainlit がセッションごとに持つので、プールには入れない）。"""
+    try:
+        result = await session.list_tools()
+        mcp_tools = cl.user_session.get("mcp_tools", {})
+        mcp_tools[connection.name] = [t.name for t in result.tools]
+        cl.user_session.set("mcp_tools", mcp_tools)
+        print(f"[MCP] connected: {connection.name} ({len(result.tools)} tools)")
+    except Exception as e:
+        print(f"[MCP] list_tools failed on connect: {connection.name}: {e}")
+
+@cl.on_mcp_disconnect
+async def on_mcp_disconnect(name: str, session):
+    mcp_tools = cl.user_session.get("mcp_tools", {})
+    mcp_tools.pop(name, None)
+    cl.user_session.set("mcp_tools", mcp_tools)
+
+# Code コマンドで Python を実行するローカル実行プール（POSIX のみ。EXEC_POOL_ENABLED=0 で無効）
+EXEC_POOL_ENABLED = os.getenv("EXEC_POOL_ENABLED", "1") != "0" and os.name == "posix"
+exec_pool = ExecPool() if EXEC_POOL_ENABLED else None
+_exec_pool_task: Optional[asyncio.Task] = None
+
+def ensure_exec_pool_warm() -> None:
+    """初回のチャット開始時に、バックグラウンドで実行ワーカーを起動しておく。"""
+    global _exec_pool_task
+    if exec_pool is not None and _exec_pool_task is None:
+        _exec_pool_task = asyncio.create_task(exec_pool.start())
+
+# 同一入力の同時リクエストをまとめる（SINGLEFLIGHT_ENABLED=0 で無効）
+single_flight = SingleFlight()
+
+# Batch API ジョブ（OpenAI / Claude）。状態は BATCH_JOBS_DIR に保存され、起動後のチャット開始時にポーリングを再開する
+batch_queue = BatchJobQueue(batch_clients_from_env(openai_async_client, anthropic_client))
+
+@profiled("handle_batch_command")
+async def handle_batch_command(text: str) -> None:
+    """Batch コマンド: 各行をプロンプトとしてバッチ投入する。空なら状態一覧、"results <job_id>" で結果ファイル。"""
+    text = (text or "").strip()
+    if not text or text.lower() == "status":
+        jobs = batch_queue.list_jobs(current_owner())
+        lines = [f"- `{job.summary()}`" for job in jobs] or ["（ジョブはありません）"]
+        await cl.Message("Batch ジョブ:\n" + "\n".join(lines), author="system").send()
+        return
+    if text.lower().startswith("results "):
+        job = batch_queue.get_job(text.split(None, 1)[1].strip(), current_owner())
+        if job is None or job.status != COMPLETED:
+            await cl.Message("完了したジョブが見つかりません。", author="system").send()
+            return
+        await cl.Message(
+            f"{job.job_id} の結果（{job.counts}）",
+            author="system",
+            elements=[cl.File(name=f"{job.job_id}.jsonl", path=batch_queue.results_path(job.job_id), display="inline")],
+        ).send()
+        return
+
+    model_info = cl.user_session.get("model") or AVAILABLE_MODELS[DEFAULT_MODEL_INDEX]
+    if model_info["type"] not in BATCH_PROVIDERS:
+        await cl.Message(f"Batch API は {', '.join(BATCH_PROVIDERS)} のモデルでのみ使えます。", author="system").send()
+        return
+    system_prompt = cl.user_session.get("system_prompt") or ""
+    prompts = [line.strip() for line in text.splitlines() if line.strip()]
+    for prompt in prompts:
+        batch_queue.enqueue(model_info["type"], model_info["value"], prompt, system_prompt, owner=current_owner())
+    jobs = await batch_queue.flush()
+    await cl.Message(
+        f"{len(prompts)} 件をバッチとして投入しました。\n" + "\n".join(f"- `{job.summary()}`" for job in jobs)
+        + "\n\n状態は内容を空にした Batch コマンドで確認できます。",
+        author="system",
+    ).send()
+
+def current_session_id() -> str:
+    try:
+        return cl.context.session.id
+    except Exception:
+        return "unknown"
+
+@profiled("handle_usage_command")
+async def handle_usage_command(args: str) -> None:
+    """/usage: このセッションのモデル・コマンド別の集計。"/usage all" で全セッション、"/usage export" で CSV。"""
+    args = (args or "").strip().lower()
+    session_id = None if args == "all" else current_session_id()
+    if args == "export":
+        await cl.Message(
+            "使用量の記録（CSV）",
+            author="system",
+            elements=[cl.File(name="usage.csv", content=usage_ledger.to_csv(session_id).encode("utf-8"), mime="text/csv", display="inline")],
+        ).send()
+        return
+    title = "全セッション" if session_id is None else "このセッション"
+    await cl.Message(f"**{title}の使用量**\n\n{format_summary(usage_ledger.summarize(session_id))}", author="system").send()
+
+def current_user_id() -> str:
+    user = getattr(cl.context.session, "user", None)
+    return getattr(user, "identifier", None) or ""
+
+def current_owner() -> str:
+    """ログイン中ならユーザー ID、未ログインならセッション ID（匿名の利用者どうしでデータを共有しない単位）。"""
+    return current_user_id() or f"session:{current_session_id()}"
+
+def index_turn(entries: list) -> None:
+    """ターンの内容（(kind, text) のリスト）を検索インデックスに積む（書き込みは待たない）。"""
+    if not SEARCH_INDEX_ENABLED:
+        return
+    try:
+        search_index.add(current_owner(), getattr(cl.context.session, "thread_id", None), current_session_id(), entries)
+    except Exception as e:
+        print(f"[Search] index error: {e}")
+
+def hook_thread_deletion() -> None:
+    """データレイヤーのスレッド削除で、検索インデックスからもそのスレッドの行を消す（1回だけ差し込む）。"""
+    from chainlit.data import get_data_layer
+
+    data_layer = get_data_layer()
+    if not SEARCH_INDEX_ENABLED or data_layer is None or getattr(data_layer, "_search_hooked", False):
+        return
+    delete_thread = data_layer.delete_thread
+
+    async def delete_thread_and_index(thread_id: str):
+        result = await delete_thread(thread_id)
+        await search_index.delete_thread(thread_id)
+        return result
+
+    data_layer.delete_thread = delete_thread_and_index
+    data_layer._search_hooked = True
+
+@profiled("handle_search_command")
+async def handle_search_command(args: str) -> None:
+    """/search <語句>: 過去の会話（質問・回答・コード・スライドのタイトル）を関連度順に探す。"""
+    query = (args or "").strip()
+    if not query:
+        await cl.Message("使い方: `/search 語句`（空白区切りで AND）", author="system").send()
+        return
+    hits, elapsed_ms = await search_index.search(current_owner(), query)
+    print(f"[Search] query={query!r} hits={len(hits)} elapsed={elapsed_ms:.1f}ms")
+    scope = "" if current_user_id() else "（未ログインのため、このセッションの会話だけが対象）"
+    await cl.Message(f"**検索: {query}**{scope}\n\n{format_hits(hits, elapsed_ms)}", author="system").send()
+
+async def handle_profile_command(args: str) -> None:
+    """/profile on|off: このセッションのターンを計測する（PROFILE_COMMAND=1 のときだけ有効）。"""
+    args = (args or "").strip().lower()
+    if args in ("on", "off"):
+        cl.user_session.set("profile", args == "on")
+    state = "ON" if cl.user_session.get("profile") else "OFF"
+    await cl.Message(f"プロファイル: {state}（出力先: `{PROFILE_DIR}`）", author="system").send()
+
+def get_status_manager() -> StatusManager:
+    """セッションのステータス表示マネージャーを返す（set/clear は待たずに戻る）。"""
+    status = cl.user_session.get("status_manager")
+    if status is None:
+        status = StatusManager(cl.context.emitter)
+        cl.user_session.set("status_manager", status)
+    return status
+
+def get_provider_state(key: str = "provider_state") -> dict:
+    """会話ごとにプロバイダ側で持つ状態（previous_response_id、Gemini の履歴変換、Grok のチャットなど）。
+
+    下書きモードのモデルは本来のモデルと混ざらないよう key="draft_state" で別に持つ。
+    """
+    state = cl.user_session.get(key)
+    if state is None:
+        state = {}
+        cl.user_session.set(key, state)
+    return state
+
+def files_api_client(provider: str):
+    """Files API のアップロードに使うクライアントを返す。"""
+    return {
+        "openai": openai_async_client,
+        "claude": anthropic_client,
+        "gemini": gemini_client,
+        "grok": xai_client,  # Files API はなく、画像をリクエストに埋め込む
+    }.get(provider)
+
+@profiled("collect_attachments")
+async def collect_attachments(message: cl.Message, provider: str) -> list:
+    """メッセージの添付ファイルをプロバイダの Files API に（重複排除しつつ）アップロードする。"""
+    elements = getattr(message, "elements", None) or []
+    if not elements:
+        return []
+    refs, skipped = await upload_elements(elements, provider, files_api_client(provider))
+    if skipped:
+        await cl.Message(
+            f"次のファイルはこのモデルに添付できないためスキップしました: {', '.join(skipped)}",
+            author="system",
+        ).send()
+    return refs
+
+def get_doc_index() -> BM25Index:
+    """セッション（または共有）の文書インデックスを返す。"""
+    if SHARED_INDEX_ENABLED:
+        return shared_index
+    index = cl.user_session.get("doc_index")
+    if index is None:
+        index = BM25Index()
+        cl.user_session.set("doc_index", index)
+    return index
+
+@profiled("retrieve_context")
+async def retrieve_context(message: cl.Message) -> str:
+    """添付文書をインデックスに追加し、今回のメッセージに関連するチャンクを返す。"""
+    index = get_doc_index()
+    for el in getattr(message, "elements", None) or []:
+        if not is_indexable(getattr(el, "name", ""), getattr(el, "mime", None)):
+            continue
+        local = await hash_element(el)
+        if local is None:
+            continue
+        try:
+            added = await index_file(index, local.digest, local.path, local.name, local.mime)
+            if added:
+                print(f"[RAG] indexed {local.name}: {added} chunks (total={len(index)})")
+        except Exception as e:
+            print(f"[RAG] {local.name} の索引化に失敗しました: {e}")
+    if not len(index):
+        return ""
+    hits = await asyncio.to_thread(index.search, message.content or "", TOP_K)
+    return format_context(hits)
 
 # --- Chainlit App Logic ---
 @cl.on_chat_start
@@ -138,6 +408,7 @@ async def start():
     await cl.Html(html)
     await cl.Message(content="WebGL 背景を適用しました。").send()
     
+@profiled("open_code_workbench")
 async def open_code_workbench(
     code: Optional[str] = None,
     title: str = "Code Workbench",
@@ -145,44 +416,103 @@ async def open_code_workbench(
     language: str = "html",
     read_only: bool = False,
     auto_preview: bool = True,
+    runnable: bool = False,
 ):
-    version = cl.user_session.get("workbench_version", 0) + 1
-    cl.user_session.set("workbench_version", version)
-    props = {
-        "code": code,
+    # 同じワークベンチ（タイトル/ファイル名/言語が同じ）なら差分だけを送り、エディタの状態を保つ
+    meta = {
         "title": title,
         "filename": filename,
         "language": language,
         "readOnly": read_only,
         "autoPreview": auto_preview,
-        "key": f"workbench-{version}",
+        "runnable": runnable,
     }
-    element = cl.CustomElement(name="CodeWorkbench", props=props, display="inline")
-    await cl.ElementSidebar.set_title("Code Workbench")
-    await cl.ElementSidebar.set_elements([element])
+    return await update_workbench(code or "", meta, sidebar_title="Code Workbench")
 
 
-async def open_slide_preview(slides_json: str, title: str = "Slide Preview"):
-    version = cl.user_session.get("slide_preview_version", 0) + 1
-    cl.user_session.set("slide_preview_version", version)
-    # Debug to terminal: always log a short preview
+async def run_python_in_workbench(doc, code: str) -> None:
+    """Python コードを実行プールで実行し、出力をワークベンチの出力欄へ流す。"""
+    if exec_pool is None or cl.user_session.get("exec_running"):
+        return
+    cl.user_session.set("exec_running", True)
+    # アクションの実行は Chainlit の停止対象（current_task）にならないので、自分で覚えておいて止める
+    cl.user_session.set("exec_task", asyncio.current_task())
     try:
-        preview = (slides_json or "")[:800]
-        length_info = 0
-        try:
-            data = json.loads(slides_json)
-            if isinstance(data, list):
-                length_info = len(data)
-        except Exception:
-            pass
-        print("[SlideDebug] open_slide_preview: length=", length_info)
-        print("[SlideDebug] open_slide_preview preview:\n", preview)
-    except Exception:
-        pass
-    props = {"slides_json": slides_json, "title": title, "key": f"slide-preview-{version}"}
-    element = cl.CustomElement(name="SlidePreview", props=props, display="inline")
-    await cl.ElementSidebar.set_title(title)
-    await cl.ElementSidebar.set_elements([element])
+        info = await stream_output(doc, exec_pool.run(code))
+        print(f"[Exec] ok={info and info.get('ok')} duration_ms={info and info.get('duration_ms')}")
+    except asyncio.CancelledError:
+        # 実行中のワーカーは exec_pool.run() の後始末で止められ、入れ替えられる
+        print("[Exec] cancelled")
+    except Exception as e:
+        print(f"[Exec] failed: {e}")
+    finally:
+        cl.user_session.set("exec_running", False)
+        cl.user_session.set("exec_task", None)
+
+
+@cl.action_callback("workbench_run")
+@profiled("workbench_run")
+async def on_workbench_run(action: cl.Action):
+    """ワークベンチの Run ボタン。エディタ上の（編集後の）コードを実行する。"""
+    payload = action.payload or {}
+    doc = cl.user_session.get("workbench_doc")
+    if doc is None or doc.doc_id != payload.get("docId") or not doc.meta.get("runnable"):
+        return
+    await run_python_in_workbench(doc, payload.get("code") or doc.text)
+
+
+@cl.action_callback("workbench_resync")
+@profiled("workbench_resync")
+async def on_workbench_resync(action: cl.Action):
+    """クライアントが差分を適用できなかったときに全文を送り直す。"""
+    await resync_workbench((action.payload or {}).get("docId", ""))
+
+
+# スライドのデバッグログ（端末に短いプレビューを出す）
+SLIDE_DEBUG = os.getenv("SLIDE_DEBUG", "0") == "1"
+
+@profiled("open_slide_preview")
+async def open_slide_preview(slides: list, title: str = "Slide Preview"):
+    """検証済みのスライド配列をサイドバーに表示する（JSON 文字列の再パースはしない）。"""
+    deck = await open_slide_deck(slides, title=title)
+    if SLIDE_DEBUG:
+        print(f"[SlideDebug] open_slide_preview: deck={deck.deck_id} slides={len(slides)} updates={deck.seq}")
+
+
+@profiled("edit_slide")
+async def edit_slide(deck, index: int, instruction: str) -> bool:
+    """表示中のスライドの1枚（index は0始まり）を指示に従って作り直し、その1枚だけを送る。"""
+    slide_json = json.dumps(deck.slides[index], ensure_ascii=False)
+    prompt = SLIDE_EDIT_PROMPT_TEMPLATE.replace("{slide_json}", slide_json).replace("{instruction}", instruction)
+    started_at = time.monotonic()
+    response = await openai_async_client.chat.completions.create(
+        model="gpt-4o",
+        messages=[{"role": "user", "content": prompt}],
+        temperature=0.7,
+        max_tokens=1500,
+    )
+    text = response.choices[0].message.content
+    usage = getattr(response, "usage", None)
+    usage_ledger.record(
+        current_session_id(), "openai", "gpt-4o", "slide",
+        {"input_tokens": usage.prompt_tokens, "output_tokens": usage.completion_tokens} if usage else None,
+        prompt_tokens=count_prompt_tokens("", [prompt]),
+        completion_text=text or "",
+        total_ms=round((time.monotonic() - started_at) * 1000, 1),
+    )
+    slides = extract_slides(text)
+    if not slides:
+        return False
+    if SLIDE_DEBUG:
+        print(f"[SlideDebug] edit_slide: deck={deck.deck_id} index={index}")
+    return await update_slide(deck, index, slides[0])
+
+
+@cl.action_callback("slides_resync")
+@profiled("slides_resync")
+async def on_slides_resync(action: cl.Action):
+    """クライアントが更新を適用できなかったときに全スライドを送り直す。"""
+    await resync_slide_deck((action.payload or {}).get("deckId", ""))
 
 # より柔軟なフェンス検出: 言語指定/オプション/改行の有無を許容
 FENCE_ANY_RE = re.compile(r"^\s*```(.*?)$\n(.*?)^\s*```\s*$", re.MULTILINE | re.DOTALL)
@@ -214,6 +544,26 @@ SLIDE_GENERATION_PROMPT_TEMPLATE = """
 {user_input}
 """
 
+# 表示中のスライドの1枚だけを作り直す（"3: 指示" の形式）
+SLIDE_EDIT_RE = re.compile(r"^\s*(\d+)\s*[:：]\s*(.+)$", re.DOTALL)
+
+SLIDE_EDIT_PROMPT_TEMPLATE = """
+あなたはプロのプレゼンテーション作成アシスタントです。
+以下のスライド（JSON）を、ユーザーの指示に従って1枚だけ書き直してください。
+キー（title / content / directives / notes）の意味は元のスライドと同じです。
+
+# 厳守事項
+- 返答は書き直したスライド1枚だけを含むJSON配列のみ（例: `[ {...} ]`）。前後に説明文やコードフェンス（```）を含めない。
+- Markdownの改行は必ず`\\n`を使用。
+
+---
+元のスライド:
+{slide_json}
+
+ユーザーの指示:
+{instruction}
+"""
+
 def extract_fenced_code(text: str) -> Optional[str]:
     """マークダウンから最初のフェンスコードブロックを抽出する。"""
     if not text:
@@ -225,8 +575,9 @@ def extract_fenced_code(text: str) -> Optional[str]:
             return code
     return None
 
-def extract_json_array(text: str) -> Optional[str]:
-    """LLM応答からJSON配列を安全に取り出し、妥当なら文字列として返す。
+@profiled("extract_slides")
+def extract_slides(text: str) -> Optional[list]:
+    """LLM応答からスライド配列を取り出し、検証済みのリストとして返す（各候補のパースは1回だけ）。
     1) そのままJSONとしてロード
     2) 角括弧で囲まれた最初のブロックを抽出してロード
     3) フェンスコードから抽出してロード
@@ -235,54 +586,38 @@ def extract_json_array(text: str) -> Optional[str]:
     if not text:
         return None
     t = text.strip()
-    # 1) 直接ロード
-    try:
-        data = json.loads(t)
-        if isinstance(data, list):
-            return json.dumps(data, ensure_ascii=False)
-        if isinstance(data, dict) and isinstance(data.get("slides"), list):
-            return json.dumps(data["slides"], ensure_ascii=False)
-    except Exception:
-        pass
+    candidates = [t]
     # 2) [ ... ] ブロックを抽出（まず最初の [ から最後の ] までを貪欲に）
-    try:
-        first = t.find('[')
-        last = t.rfind(']')
-        if first != -1 and last != -1 and last > first:
-            candidate = t[first:last+1]
-            data = json.loads(candidate)
-            if isinstance(data, list):
-                return json.dumps(data, ensure_ascii=False)
-            if isinstance(data, dict) and isinstance(data.get("slides"), list):
-                return json.dumps(data["slides"], ensure_ascii=False)
-    except Exception:
-        pass
+    first = t.find('[')
+    last = t.rfind(']')
+    if first != -1 and last != -1 and last > first:
+        candidates.append(t[first:last+1])
     # 2b) 非貪欲（保険）
     m = re.search(r"\[([\s\S]*?)\]", t)
     if m:
-        candidate = "[" + m.group(1) + "]"
-        try:
-            data = json.loads(candidate)
-            if isinstance(data, list):
-                return json.dumps(data, ensure_ascii=False)
-        except Exception:
-            pass
+        candidates.append("[" + m.group(1) + "]")
     # 3) フェンスから抽出
     fenced = extract_fenced_code(t)
     if fenced:
+        candidates.append(fenced)
+    seen = set()
+    for candidate in candidates:
+        if candidate in seen:
+            continue
+        seen.add(candidate)
         try:
-            data = json.loads(fenced)
-            if isinstance(data, list):
-                return json.dumps(data, ensure_ascii=False)
-            if isinstance(data, dict) and isinstance(data.get("slides"), list):
-                return json.dumps(data["slides"], ensure_ascii=False)
+            data = json.loads(candidate)
         except Exception:
-            pass
+            continue
+        slides = normalize_slides(data)
+        if slides is not None:
+            return slides
     return None
 
 
 HTML_TAG_HINTS = ("<html", "<head", "<body", "<header", "<section", "<div", "<main", "<footer", "<h1", "<p", "<nav", "<ul", "<li")
 
+@profiled("extract_html_code")
 def extract_html_code(text: str) -> Optional[str]:
     if not text:
         return None
@@ -325,6 +660,19 @@ def extract_html_code(text: str) -> Optional[str]:
         pass
     return None
 
+@profiled("extract_python_code")
+def extract_python_code(text: str) -> Optional[str]:
+    """LLM応答から言語指定が Python のフェンスコードを抽出（指定が無いものは対象外）。"""
+    if not text:
+        return None
+    for m in FENCE_ANY_RE.finditer(text):
+        lang = (m.group(1) or "").strip().lower()
+        code = (m.group(2) or "").strip()
+        if lang in ("python", "py", "python3") and code:
+            return code
+    return None
+
+@profiled("extract_js_code")
 def extract_js_code(text: str) -> Optional[str]:
     """LLM応答からJavaScript/TypeScriptのコードブロックを抽出。"""
     if not text:
@@ -344,11 +692,19 @@ def extract_js_code(text: str) -> Optional[str]:
 @cl.on_chat_start
 async def start_chat():
     """チャット開始時に呼び出され、設定UIを初期化します。"""
+    ensure_mcp_warm()
+    ensure_exec_pool_warm()
+    batch_queue.start()
+    hook_thread_deletion()
     # Toolsトグルの初期状態をセッションに保存（デフォルト: OFF）
     tools_enabled = cl.user_session.get("tools_enabled")
     if tools_enabled is None:
         tools_enabled = False
         cl.user_session.set("tools_enabled", tools_enabled)
+    draft_enabled = cl.user_session.get("draft_enabled")
+    if draft_enabled is None:
+        draft_enabled = DRAFT_MODE_DEFAULT
+        cl.user_session.set("draft_enabled", draft_enabled)
 
     # メッセージバーのコマンドボタンを登録（画像系のみ）
     try:
@@ -377,6 +733,7 @@ async def start_chat():
         Select(id="model", label="モデル", values=[m["label"] for m in AVAILABLE_MODELS], initial_index=initial_model_index),
         Select(id="system_prompt", label="システムプロンプト（AIの性格・役割）", values=[p["label"] for p in SYSTEM_PROMPT_CHOICES], initial_index=initial_prompt_index),
         Switch(id="tools_enabled", label="Tools（Web検索/実行/MCP）", initial=tools_enabled),
+        Switch(id="draft_enabled", label="下書きモード（遅いモデルの応答中に高速モデルの下書きを表示）", initial=draft_enabled),
     ]).send()
     
     # 初期設定を設定（UIの初期値に合わせる）
@@ -398,6 +755,9 @@ async def setup_agent(settings: dict):
     selected_model = next((m for m in AVAILABLE_MODELS if m["label"] == model_label), AVAILABLE_MODELS[DEFAULT_MODEL_INDEX])
     
     cl.user_session.set("model", selected_model)
+    # 選択中プロバイダへの接続をバックグラウンドで温める（待たない）
+    if WARMUP_ENABLED:
+        provider_warmer.schedule(selected_model["type"], selected_model["value"])
 
     prompt_label = settings["system_prompt"]
     selected_prompt = next((p["content"] for p in SYSTEM_PROMPT_CHOICES if p["label"] == prompt_label), SYSTEM_PROMPT_CHOICES[DEFAULT_PROMPT_INDEX]["content"])
@@ -412,10 +772,13 @@ async def setup_agent(settings: dict):
             await cl.context.emitter.set_commands(COMMANDS_BASE)
         except Exception as e:
             print(f"Failed to update commands on settings change: {e}")
+    if "draft_enabled" in settings:
+        cl.user_session.set("draft_enabled", bool(settings["draft_enabled"]))
 
     print(f"Settings updated: Model={selected_model['label']}, Prompt={prompt_label}")
 
 @cl.on_message
+@profiled("on_message")
 async def on_message(message: cl.Message):
     """ユーザーからのメッセージ受信時に呼び出されます。"""
     # まずはコマンド押下を検出して通常フローを止める
@@ -426,13 +789,23 @@ async def on_message(message: cl.Message):
             if not openai_async_client:
                 await cl.Message("エラー: OPENAI_API_KEYが設定されていないため画像生成を実行できません。", author="system").send()
                 return
+            status = get_status_manager()
+            status.set("画像生成中...")
             try:
+                started_at = time.monotonic()
                 response = await openai_async_client.responses.create(
                     model="gpt-4.1-mini",
                     input=message.content,
                     tools=[{"type":"image_generation"}],
                     #stream=True,
                 )
+                usage = getattr(response, "usage", None)
+                usage_ledger.record(
+                    current_session_id(), "openai", "gpt-4.1-mini", "Picture",
+                    {"input_tokens": usage.input_tokens, "output_tokens": usage.output_tokens} if usage else None,
+                    prompt_tokens=count_prompt_tokens("", [message.content]),
+                    total_ms=round((time.monotonic() - started_at) * 1000, 1),
+                )
                 # 生成された画像（base64）を取り出す
                 image_data = [
                     output.result
@@ -462,6 +835,8 @@ async def on_message(message: cl.Message):
                     f"画像生成中にエラーが発生しました: {e}",
                     author="system"
                 ).send()
+            finally:
+                status.clear()
             return
         elif cmd == "Code":
             # エディタ/プレビューを表示。入力が無ければ直近のアシスタント発話から抽出。
@@ -469,6 +844,28 @@ async def on_message(message: cl.Message):
             initial_code = user_input or None
             notification = "Code Workbench を開きました。Editor/Preview を切り替えてご利用ください。"
 
+            # Python のコードは実行プールで実行し、出力をワークベンチに流す。
+            # ユーザーが入力したコードはすぐに実行し、モデルが書いたコードは Run を押すまで実行しない
+            python_code = extract_python_code(user_input)
+            from_model = False
+            if python_code is None and initial_code is None:
+                for m in reversed(cl.user_session.get("conversation_history", [])):
+                    if isinstance(m, AIMessage):
+                        if "<html" not in (m.content or "").lower():
+                            python_code = extract_python_code(m.content)
+                            from_model = python_code is not None
+                        break
+            if python_code and exec_pool is not None:
+                doc = await open_code_workbench(
+                    code=python_code, filename="main.py", language="python", auto_preview=False, runnable=True,
+                )
+                if from_model:
+                    await cl.Message("直前の回答の Python コードを Code Workbench に開きました。内容を確認して Run で実行してください。", author="system").send()
+                    return
+                await cl.Message("Code Workbench で Python を実行しています。Run で再実行できます。", author="system").send()
+                await run_python_in_workbench(doc, python_code)
+                return
+
             if initial_code is None:
                 history = cl.user_session.get("conversation_history", [])
                 for m in reversed(history):
@@ -502,17 +899,48 @@ async def on_message(message: cl.Message):
             await cl.Message(notification, author="system").send()
             return
 
+        elif cmd == "Batch":
+            try:
+                await handle_batch_command(message.content)
+            except Exception as e:
+                await cl.Message(f"バッチ投入中にエラーが発生しました: {e}", author="system").send()
+            return
+
         elif cmd == "slide":
             if not openai_async_client:
                 await cl.Message("エラー: OPENAI_API_KEYが設定されていないためスライド生成を実行できません。", author="system").send()
                 return
 
-            async with cl.Step(name="スライド生成中...") as step:
+            # "3: 指示" なら表示中のスライドの3枚目だけを作り直して、その1枚だけを送る
+            edit = SLIDE_EDIT_RE.match(message.content or "")
+            deck = cl.user_session.get("slide_deck")
+            if edit and deck is not None:
+                index = int(edit.group(1)) - 1
+                if not (0 <= index < len(deck.slides)):
+                    await cl.Message(f"スライドの番号は 1〜{len(deck.slides)} で指定してください。", author="system").send()
+                    return
+                status = get_status_manager()
+                status.set(f"スライド {index + 1} を作り直しています...")
+                try:
+                    if await edit_slide(deck, index, edit.group(2).strip()):
+                        await cl.Message(f"スライド {index + 1} を更新しました。", author="system").send()
+                    else:
+                        await cl.Message("書き直したスライドを抽出できませんでした。", author="system").send()
+                except Exception as e:
+                    await cl.Message(f"スライドの更新中にエラーが発生しました: {e}", author="system").send()
+                finally:
+                    status.clear()
+                return
+
+            status = get_status_manager()
+            status.set("スライド生成中...")
+            async with traced_step("スライド生成中...") as step:
                 step.input = message.content
                 # braces を含むテンプレ内で format() を使うと例外になるため、手動置換にする
                 prompt = SLIDE_GENERATION_PROMPT_TEMPLATE.replace("{user_input}", message.content)
                 
                 try:
+                    started_at = time.monotonic()
                     response = await openai_async_client.chat.completions.create(
                         model="gpt-4o",
                         messages=[
@@ -522,41 +950,54 @@ async def on_message(message: cl.Message):
                         max_tokens=4000,
                     )
                     slide_json_str = response.choices[0].message.content
+                    usage = getattr(response, "usage", None)
+                    usage_ledger.record(
+                        current_session_id(), "openai", "gpt-4o", "slide",
+                        {"input_tokens": usage.prompt_tokens, "output_tokens": usage.completion_tokens} if usage else None,
+                        prompt_tokens=count_prompt_tokens("", [prompt]),
+                        completion_text=slide_json_str or "",
+                        total_ms=round((time.monotonic() - started_at) * 1000, 1),
+                    )
                     step.output = slide_json_str
                     
-                    extracted_json = extract_json_array(slide_json_str)
-                    
-                    if extracted_json:
-                        try:
-                            parsed = json.loads(extracted_json)
-                            count = len(parsed) if isinstance(parsed, list) else 0
-                        except Exception:
-                            parsed, count = None, 0
-                        if count > 0:
-                            await open_slide_preview(slides_json=extracted_json, title=f"{message.content[:20]}... のスライド")
-                            await cl.Message(f"スライドのプレビューをサイドバーに表示しました。（{count}枚）", author="system").send()
-                        else:
-                            # Debug previews for terminal and user
-                            raw_preview = (slide_json_str or "")[:800]
-                            extracted_preview = (extracted_json or "")[:800]
-                            print("[SlideDebug] Empty array after extraction. Raw preview:\n", raw_preview)
-                            print("[SlideDebug] Extracted preview:\n", extracted_preview)
-                            await cl.Message("抽出できましたが、配列が空です。AI応答を確認します。（プレビューを端末ログに出力しました）", author="system").send()
-                            await open_code_workbench(code=f"<pre>{slide_json_str}</pre>", title="Slide JSON Raw Output (empty array)")
+                    slides = extract_slides(slide_json_str)
+
+                    if slides:
+                        index_turn([("user", message.content), *(("slide", s.get("title", "")) for s in slides)])
+                        await open_slide_preview(slides, title=f"{message.content[:20]}... のスライド")
+                        await cl.Message(f"スライドのプレビューをサイドバーに表示しました。（{len(slides)}枚）", author="system").send()
+                    elif slides is not None:
+                        if SLIDE_DEBUG:
+                            print("[SlideDebug] Empty array after extraction. Raw preview:\n", (slide_json_str or "")[:200])
+                        await cl.Message("抽出できましたが、配列が空です。AIの応答をサイドバーに表示します。", author="system").send()
+                        await open_code_workbench(code=f"<pre>{slide_json_str}</pre>", title="Slide JSON Raw Output (empty array)")
                     else:
-                        # Debug previews for terminal and user
-                        raw_preview = (slide_json_str or "")[:800]
-                        print("[SlideDebug] Extraction failed. Raw preview:\n", raw_preview)
-                        await cl.Message("スライドのJSON配列を抽出できませんでした。AIの応答をサイドバーに表示します。（プレビューを端末ログに出力しました）", author="system").send()
+                        if SLIDE_DEBUG:
+                            print("[SlideDebug] Extraction failed. Raw preview:\n", (slide_json_str or "")[:200])
+                        await cl.Message("スライドのJSON配列を抽出できませんでした。AIの応答をサイドバーに表示します。", author="system").send()
                         await open_code_workbench(code=f"<pre>{slide_json_str}</pre>", title="Slide JSON Raw Output")
 
                 except Exception as e:
                     error_msg = f"スライド生成中にエラーが発生しました: {e}"
                     await cl.Message(error_msg, author="system").send()
+                finally:
+                    status.clear()
             return
         else:
             await cl.Message(f"未対応のコマンド: {cmd}", author="system").send()
         return
+    # テキストコマンド（履歴には入れない）
+    text = (message.content or "").strip()
+    if text == "/usage" or text.startswith("/usage "):
+        await handle_usage_command(text[len("/usage"):])
+        return
+    if SEARCH_INDEX_ENABLED and (text == "/search" or text.startswith("/search ")):
+        await handle_search_command(text[len("/search"):])
+        return
+    if PROFILE_COMMAND and (text == "/profile" or text.startswith("/profile ")):
+        await handle_profile_command(text[len("/profile"):])
+        return
+
     model_info = cl.user_session.get("model")
     system_prompt = cl.user_session.get("system_prompt")
     conversation_history = cl.user_session.get("conversation_history", [])
@@ -578,238 +1019,174 @@ async def on_message(message: cl.Message):
     # APIに渡すメッセージリストを作成
     api_messages = [msg for msg in conversation_history if not isinstance(msg, SystemMessage)]
     
-    msg = cl.Message(content="")
-    await msg.send()
-    answer_text = ""
+    # 添付ファイル（同一内容はプロバイダごとに1回だけアップロード）
+    attachments = await collect_attachments(message, model_info["type"])
 
+    # アップロード文書から関連チャンクを検索する（差し込み先はプロバイダごとに providers.py で決める）
     try:
-        # --- OpenAI Models ---
-        if model_info["type"] == "openai":
-            if not openai_client:
-                answer_text = "エラー: OPENAI_API_KEYが設定されていません。"
-                await msg.stream_token(answer_text)
-                await msg.update()
-                return
-            
-            model = model_info["value"]
-            previous_response_id = cl.user_session.get("previous_response_id")
+        doc_context = await retrieve_context(message)
+    except Exception as e:
+        print(f"[RAG] retrieval error: {e}")
+        doc_context = ""
+    provider = model_info["type"]
+    msg = cl.Message(content="")
+    await msg.send()
 
-            tools = OPENAI_ALL_TOOLS if cl.user_session.get("tools_enabled", False) else []
-            async with cl.Step(name="応答生成中...") as step:
-                step.input = message.content
-                response = openai_client.responses.create(
-                    model=model,
-                    input=[
-                        {
-                            "role": "system",
-                            "content": system_prompt
-                        },
-                        {
-                            "role": "user",
-                            "content": message.content
-                        }
-                    ],
-                    previous_response_id=previous_response_id,
-                    tools=tools,
-                    stream=True,
-                ) 
-                # ステータス表示: 応答生成開始
-                try:
-                    await cl.context.emitter.set_status("応答生成中...")
-                    status_set_at = time.monotonic()
-                except Exception:
-                    pass
-                for event in response:
-                    etype = getattr(event, "type", None)
-
-                    # テキストトークン（増分）
-                    if etype == "response.output_text.delta":
-                        token = getattr(event, "delta", "") or ""
-                        if token:
-                            answer_text += token
-                            await msg.stream_token(token)
-
-                    # ツール呼び出しの進捗（Responses API）
-                    elif etype == "response.tool_call.delta":
-                        delta = getattr(event, "delta", None)
-                        tool_name = None
-                        if delta is not None:
-                            tool_name = (
-                                getattr(delta, "name", None)
-                                or getattr(delta, "tool_name", None)
-                                or (getattr(getattr(delta, "function", None), "name", None))
-                            )
-                        try:
-                            await cl.context.emitter.set_status(
-                                f"ツール実行中: {tool_name}" if tool_name else "ツール実行中..."
-                            )
-                        except Exception:
-                            pass
-
-                    # ツール呼び出し完了（実装差異に対応）
-                    elif etype in ("response.tool_call.completed", "response.tool_calls.done"):
-                        try:
-                            await cl.context.emitter.set_status("応答生成中...")
-                        except Exception:
-                            pass
-
-                    # 出力テキスト完了（区切りイベント）
-                    elif etype == "response.output_text.done":
-                        # ここではクリアしない（瞬間的に消えるのを防ぐ）
-                        pass
-
-                    # 応答全体が完成
-                    elif etype == "response.completed":
-                        resp = getattr(event, "response", None)
-                        if resp and getattr(resp, "id", None):
-                            cl.user_session.set("previous_response_id", resp.id)
-                        # ステータスをクリア（最小表示時間を確保）
-                        try:
-                            elapsed = (time.monotonic() - status_set_at) if 'status_set_at' in locals() else 0
-                            if elapsed < 0.3:
-                                await asyncio.sleep(0.3 - elapsed)
-                            await cl.context.emitter.set_status("")
-                        except Exception:
-                            pass
-
-                    # エラーイベント
-                    elif etype == "response.error":
-                        err = getattr(event, "error", None)
-                        # ステータスをクリア（最小表示時間を確保）
-                        try:
-                            elapsed = (time.monotonic() - status_set_at) if 'status_set_at' in locals() else 0
-                            if elapsed < 0.3:
-                                await asyncio.sleep(0.3 - elapsed)
-                            await cl.context.emitter.set_status("")
-                        except Exception:
-                            pass
-                        raise RuntimeError(str(err) if err else "OpenAI streaming error")
-
-                    # 作成開始イベントなどは無視してOK
-                    else:
-                        # print("DEBUG OpenAI event:", event)
-                        pass
+    # ステータス表示: 応答生成開始（全プロバイダ共通）
+    status = get_status_manager()
+    status.set("応答生成中...")
 
-                # Step の出力を設定（最終テキスト）
-                try:
-                    step.output = answer_text
-                except Exception:
-                    pass
-        
-            #正常終了後、会話履歴を更新
-            if answer_text:
-                conversation_history.append(AIMessage(content=answer_text))
-                cl.user_session.set("conversation_history", conversation_history)
+    request = result = flight = None
+    leader = False
+    draft = None
+    drafted = refined = False
+    try:
+        if provider_clients.for_provider(provider) is None:
+            await msg.stream_token(MISSING_KEY_MESSAGES[provider])
             await msg.update()
+            return
 
-        # --- Gemini Models ---
-        elif model_info["type"] == "gemini":
-            if not GOOGLE_API_KEY:
-                answer_text = "エラー: GOOGLE_API_KEYが設定されていません。"
-                await msg.stream_token(answer_text)
-                await msg.update()
-                return
-                
-            # --- ツール設定（有効時のみ） ---
-            tools = (
-                [
-                    Tool(url_context=UrlContext()),
-                    Tool(google_search=GoogleSearch()),
-                    Tool(code_execution={}),
-                ]
-                if cl.user_session.get("tools_enabled", False)
-                else []
+        # ツールは Tools ON かつルーターが必要と判断したものだけ（Claude はツールなし）
+        tool_kinds = select_tool_kinds(provider, message.content, cl.user_session.get("tools_enabled", False))
+        # MCP は設定済みサーバーがあればプロセス共通のプール経由で呼ぶ（無ければ OpenAI 側の mcp ツール）
+        use_mcp_pool = provider == "openai" and MCP in tool_kinds and bool(mcp_manager.configs)
+        request = TurnRequest(
+            provider=provider,
+            model=model_info["value"],
+            history=api_messages,
+            system_prompt=system_prompt,
+            doc_context=doc_context,
+            attachments=attachments,
+            tool_kinds=tool_kinds,
+            openai_tools=openai_tools_for(tool_kinds, skip_mcp=use_mcp_pool),
+            mcp=mcp_manager if use_mcp_pool else None,
+            state=get_provider_state(),
+        )
+        # 同じ入力の同時リクエスト（スターターの一斉クリックなど）は上流のストリームを1本にまとめる
+        scope = "" if SINGLEFLIGHT_SCOPE == "global" else current_owner()
+        key = coalesce_key(request, scope) if SINGLEFLIGHT_ENABLED else None
+        if key is not None:
+            session_id = current_session_id()
+            flight, leader = single_flight.join(
+                key,
+                lambda r: stream_turn(provider_clients, request, r),
+                # 使用量は上流1本につき1回、上流が終わったときに記録する（開いた側が停止しても相乗りした側のために続く）
+                on_finish=lambda f: record_flight_usage(f, session_id, request, api_messages),
             )
-
-            # システムプロンプトとメッセージを結合
-            messages = [f"System: {system_prompt}"] if system_prompt else []
-            messages.extend([m.content for m in api_messages])
-            prompt = "\n".join(messages)
-
-            # --- API呼び出し ---
-            stream = gemini_client.models.generate_content(
-                model=model_info["value"],
-                contents=prompt,
-                config=GenerateContentConfig(
-                    tools=tools,
-                )
+            events, result = flight.subscribe(), flight.result
+        else:
+            leader, result = True, TurnResult()
+            events = stream_turn(provider_clients, request, result)
+        started = time.perf_counter()
+        ttft_ms = None
+        # 受信（生産者）と画面への送信（消費者）を分け、送信が遅れた分はまとめて送る
+        piped_events = StreamPipe(events).stream()
+        # 下書きモード: 遅いモデルの応答を待つ間、高速モデルの下書きを先に流す（相乗りした側は先頭の下書きを待たない）
+        if leader and cl.user_session.get("draft_enabled") and wants_draft(request.model):
+            draft_model = pick_draft_model(provider_clients, request.model)
+            if draft_model is not None:
+                draft = (draft_request(request, *draft_model, get_provider_state("draft_state")), TurnResult())
+                draft_events = StreamPipe(stream_turn(provider_clients, draft[0], draft[1])).stream()
+                piped_events = draft_then_refine(draft_events, piped_events)
+        # 音声モードのターンなら、本来の応答を文ごとに読み上げに回す（下書きは読まない）
+        speaker = cl.user_session.get("voice_speaker")
+        async with traced_step("応答生成中...") as step, aclosing(piped_events) as piped:
+            step.input = message.content
+            async for kind, text in piped:
+                if kind in ("token", "draft") and ttft_ms is None:
+                    ttft_ms = (time.perf_counter() - started) * 1000
+                if kind == "draft":
+                    if not drafted:
+                        drafted = True
+                        await msg.stream_token(f"*（下書き: {draft[0].model}）*\n\n")
+                    await msg.stream_token(text)
+                elif kind == "token":
+                    if speaker is not None:
+                        speaker.feed(text)
+                    if drafted and not refined:
+                        refined = True
+                        await msg.stream_token(text, is_sequence=True)  # 下書きを本来の応答で置き換える
+                    else:
+                        await msg.stream_token(text)
+                elif text:
+                    status.set(text)
+                else:
+                    # 最小表示時間はマネージャー側で確保し、ここでは待たない
+                    status.clear()
+            step.output = result.text
+        if drafted and not refined:
+            msg.content = result.text  # 本来の応答が空だった場合も下書きは残さない
+        if draft is not None:
+            record_draft(draft[0], draft[1], api_messages, ttft_ms, result.ttft_ms)
+
+        if flight is None:
+            usage_ledger.record(
+                current_session_id(), provider, request.model, "chat", result.usage,
+                prompt_tokens=None if "input_tokens" in result.usage else count_prompt_tokens(request.full_system_prompt, api_messages),
+                completion_text=result.text,
+                ttft_ms=result.ttft_ms,
+                total_ms=result.total_ms,
             )
-
-            # --- レスポンスを処理（Gemini） ---
-            if hasattr(stream, "candidates") and stream.candidates:
-                candidate = stream.candidates[0]  # 最上位候補のみ採用
-                if getattr(candidate, "content", None):
-                    for part in (candidate.content.parts or []):
-                        text = getattr(part, "text", None)
-                        if text:
-                            answer_text += text
-                            await msg.stream_token(text)
-
-            # 会話履歴を更新
-            if answer_text:
-                conversation_history.append(AIMessage(content=answer_text))
-                cl.user_session.set("conversation_history", conversation_history)
-            await msg.update()
-
-        # --- Claude Models ---
-        elif model_info["type"] == "claude":
-            if not anthropic_client:
-                answer_text = "エラー: ANTHROPIC_API_KEYが設定されていません。"
-                await msg.stream_token(answer_text)
-                await msg.update()
-                return
-                
-            stream = await anthropic_client.messages.create(
-                model=model_info["value"],
-                system=system_prompt,
-                messages=[{"role": "user" if isinstance(m, HumanMessage) else "assistant", "content": m.content} for m in api_messages],
-                max_tokens=4096,
-                stream=True,
+        elif not leader:
+            # 相乗りした側は上流の料金がかからないので 0 トークンで記録する（レイテンシは自分の待ち時間）
+            usage_ledger.record(
+                current_session_id(), provider, request.model, "chat (coalesced)",
+                {"input_tokens": 0, "output_tokens": 0},
+                ttft_ms=ttft_ms,
+                total_ms=(time.perf_counter() - started) * 1000,
             )
-            async for chunk in stream:
-                if chunk.type == "content_block_delta":
-                    token = chunk.delta.text or ""
-                    answer_text += token
-                    await msg.stream_token(token)
-            # Claude: 出力コードの自動反映
+            # OpenAI は次のターンを同じ応答につなぐ（Gemini / Grok は次のターンで履歴から作り直される）
+            if provider == "openai" and result.response_id:
+                request.state["previous_response_id"] = result.response_id
+
+        # 正常終了後、会話履歴を更新
+        if result.text:
+            conversation_history.append(AIMessage(content=result.text))
+            cl.user_session.set("conversation_history", conversation_history)
+        await msg.update()
+        index_turn([
+            ("user", message.content),
+            ("assistant", result.text),
+            *(("code", m.group(2)) for m in FENCE_ANY_RE.finditer(result.text or "")),
+        ])
+
+        # Claude: 出力コードの自動反映
+        if provider == "claude":
             try:
-                html = extract_html_code(answer_text)
+                html = extract_html_code(result.text)
                 if html:
                     await open_code_workbench(code=html, title="Canvas: Code Workbench (from LLM)")
             except Exception as e:
                 print(f"extract_html_code(Claude) error: {e}")
 
-        # --- Grok Models ---
-        elif model_info["type"] == "grok":
-            if not xai_client:
-                answer_text = "エラー: XAI_API_KEYが設定されていません。"
-                await msg.stream_token(answer_text)
-                await msg.update()
-                return
-
-            system_prompt = system(system_prompt)
-            prompt = user(message.content)
-
-            # 応答生成
-            chat = xai_client.chat.create(
-                model=model_info["value"],
-                messages=[system_prompt, prompt],
-                search_parameters=SearchParameters(mode="auto"),
+    except asyncio.CancelledError:
+        # 停止ボタン / 切断: 上流のストリームはキャンセルの伝播で閉じられる。表示済みの部分応答は履歴に残す
+        partial = "" if drafted and not refined else msg.content or ""  # 下書きは本来のモデルの応答ではないので残さない
+        if partial:
+            conversation_history.append(AIMessage(content=partial))
+            cl.user_session.set("conversation_history", conversation_history)
+        elif conversation_history and isinstance(conversation_history[-1], HumanMessage):
+            cl.user_session.set("conversation_history", conversation_history[:-1])
+        if leader and request is not None and flight is None:
+            usage_ledger.record(
+                current_session_id(), provider, request.model, "chat (stopped)", result.usage,
+                prompt_tokens=None if "input_tokens" in result.usage else count_prompt_tokens(request.full_system_prompt, api_messages),
+                completion_text=partial,
+                ttft_ms=result.ttft_ms,
+                total_ms=result.total_ms,
             )
-            
-            for response, chunk in chat.stream():
-                answer_text += chunk.content
-                await msg.stream_token(chunk.content)
-                await msg.update()
-                #print(chunk.content, end="", flush=True)  # Each chunk's content
-
-            # 会話履歴を更新
-            if answer_text:
-                conversation_history.append(AIMessage(content=answer_text))
-                cl.user_session.set("conversation_history", conversation_history)
-            await msg.update()
-
-
+        elif leader and flight is not None and not flight.done and flight.subscribers > 0:
+            # 相乗りした側のために上流は続く。料金は上流が終わったときに record_flight_usage で記録するので、ここはレイテンシだけ
+            usage_ledger.record(
+                current_session_id(), provider, request.model, "chat (stopped)",
+                {"input_tokens": 0, "output_tokens": 0},
+                ttft_ms=result.ttft_ms,
+                total_ms=(time.perf_counter() - started) * 1000,
+            )
+        if draft is not None:
+            record_draft(draft[0], draft[1], api_messages, None, result.ttft_ms)
+        print(f"[Turn] stopped provider={provider} partial_chars={len(partial)}")
+        raise
     except Exception as e:
         error_message = f"エラーが発生しました: {str(e)}"
         print(f"詳細エラー: {e}")
@@ -823,6 +1200,160 @@ async def on_message(message: cl.Message):
             cl.user_session.set("conversation_history", conversation_history[:-1])
         msg.content = error_message
         await msg.update()
+    finally:
+        status.clear()
+
+def record_flight_usage(flight, session_id: str, request: TurnRequest, api_messages: list) -> None:
+    """まとめた上流1本分の使用量を、上流を開いたセッションに1回だけ記録する（途中で止まった場合は届いた分）。"""
+    result = flight.result
+    stopped = isinstance(flight.error, asyncio.CancelledError) or not flight.done
+    usage_ledger.record(
+        session_id, request.provider, request.model, "chat (stopped)" if stopped else "chat", result.usage,
+        prompt_tokens=None if "input_tokens" in result.usage else count_prompt_tokens(request.full_system_prompt, api_messages),
+        completion_text=result.text,
+        ttft_ms=result.ttft_ms,
+        total_ms=result.total_ms,
+    )
+
+
+def record_draft(draft_req: TurnRequest, draft_result: TurnResult, api_messages: list, perceived_ms, actual_ms) -> None:
+    """下書きの分の使用量を記録し、体感の TTFT（下書き込み）と本来の TTFT、追加コストを出力する。"""
+    rec = usage_ledger.record(
+        current_session_id(), draft_req.provider, draft_req.model, "chat (draft)", draft_result.usage,
+        prompt_tokens=None if "input_tokens" in draft_result.usage else count_prompt_tokens(draft_req.full_system_prompt, api_messages),
+        completion_text=draft_result.text,
+        ttft_ms=perceived_ms,
+        total_ms=draft_result.total_ms,
+    )
+    perceived = "-" if perceived_ms is None else f"{perceived_ms:.0f}ms"
+    extra = "-" if rec.cost_usd is None else f"${rec.cost_usd:.6f}"
+    print(
+        f"[Draft] model={draft_req.model} perceived_ttft={perceived} actual_ttft={actual_ms}ms "
+        f"draft_ttft={draft_result.ttft_ms}ms extra_cost={extra}" + (" cancelled" if draft_result.cancelled else "")
+    )
+
+
+async def send_voice_chunk(track: str, data: bytes) -> None:
+    await cl.context.emitter.send_audio_chunk(cl.OutputAudioChunk(mimeType="pcm16", data=data, track=track))
+
+
+async def stop_speaking() -> None:
+    """読み上げ中なら止め、クライアントに再生中の音声を捨てさせる（話し始めたとき・停止ボタン）。"""
+    speaker = cl.user_session.get("voice_speaker")
+    if speaker is not None:
+        speaker.cancel()
+        await cl.context.emitter.send_audio_interrupt()
+
+
+async def run_voice_turn(utterance, stt_provider: str, stt_model: str) -> None:
+    """文字起こしした発話を通常のメッセージとして処理し、応答を読み上げる。"""
+    usage_ledger.record(
+        current_session_id(), stt_provider, stt_model, "voice (transcribe)", None,
+        completion_text=utterance.text, total_ms=utterance.stt_ms,
+    )
+    if not utterance.text:
+        return
+    user_msg = cl.Message(content=utterance.text, author="user", type="user_message")
+    await user_msg.send()
+    speaker = None
+    if VOICE_TTS_ENABLED and openai_async_client is not None:
+        track = f"voice-{user_msg.id}"
+        speaker = Speaker(openai_async_client, lambda data: send_voice_chunk(track, data))
+    cl.user_session.set("voice_speaker", speaker)
+    try:
+        await on_message(user_msg)
+    finally:
+        if speaker is not None:
+            speaker.close()
+    if speaker is not None:
+        await speaker.wait()
+        cl.user_session.set("voice_speaker", None)
+        spoken = "".join(speaker.spoken)
+        if spoken:
+            usage_ledger.record(
+                current_session_id(), "openai", VOICE_TTS_MODEL, "voice (speech)", None,
+                prompt_tokens=count_prompt_tokens("", [spoken]),
+                ttft_ms=None if speaker.stats.first_audio_at is None else round((speaker.stats.first_audio_at - utterance.speech_end_at) * 1000, 1),
+            )
+    else:
+        cl.user_session.set("voice_speaker", None)
+    report = latency_report(utterance, None if speaker is None else speaker.stats.first_text_at, speaker)
+    print("[Voice] " + " ".join(f"{k}={v}" for k, v in report.items()))
+
+
+@cl.on_audio_start
+async def on_audio_start():
+    model_info = cl.user_session.get("model") or AVAILABLE_MODELS[DEFAULT_MODEL_INDEX]
+    stt = pick_transcriber(provider_clients, model_info["type"])
+    if stt is None:
+        await cl.Message("音声入力には OPENAI_API_KEY または GOOGLE_API_KEY が必要です。", author="system").send()
+        return False
+    await stop_speaking()
+    previous = cl.user_session.get("voice_input")
+    if previous is not None:
+        previous.cancel()
+    cl.user_session.set("voice_input", VoiceInput(
+        stt,
+        on_turn=lambda utterance: run_voice_turn(utterance, stt[0], stt[2]),
+        on_speech=stop_speaking,
+    ))
+    return True
+
+
+@cl.on_audio_chunk
+async def on_audio_chunk(chunk: cl.InputAudioChunk):
+    # チャンクごとにタスクが作られるので、await を挟まずに積む（順番を保つ）
+    voice = cl.user_session.get("voice_input")
+    if voice is not None:
+        voice.feed(chunk.data)
+
+
+@cl.on_audio_end
+async def on_audio_end():
+    voice = cl.user_session.get("voice_input")
+    if voice is None:
+        return
+    cl.user_session.set("voice_task", asyncio.current_task())
+    try:
+        await voice.finish()
+    finally:
+        cl.user_session.set("voice_input", None)
+        cl.user_session.set("voice_task", None)
+
+
+def cancel_session_tasks(reason: str) -> None:
+    """このセッションで実行中の応答生成・コード実行・音声の処理をキャンセルする（上流の接続とワーカーを解放する）。"""
+    voice = cl.user_session.get("voice_input")
+    if voice is not None:
+        voice.cancel()
+    speaker = cl.user_session.get("voice_speaker")
+    if speaker is not None:
+        speaker.cancel()
+    tasks = [cl.context.session.current_task, cl.user_session.get("exec_task"), cl.user_session.get("voice_task")]
+    cancelled = 0
+    for task in tasks:
+        if task is not None and not task.done() and task is not asyncio.current_task():
+            task.cancel()
+            cancelled += 1
+    if cancelled:
+        print(f"[Session] {reason}: cancelled {cancelled} task(s)")
+
+
+@cl.on_stop
+async def on_stop():
+    # 応答生成（current_task）は Chainlit が止めるので、ここではそれ以外（コード実行・音声）も止める
+    await stop_speaking()
+    cancel_session_tasks("stop")
+
+
+@cl.on_chat_end
+async def on_chat_end():
+    # タブを閉じた・切断した場合、Chainlit は実行中のタスクを止めないのでここで止める
+    cancel_session_tasks("disconnect")
+    # 未ログインの検索はセッション単位なので、終わったセッションの行はもう誰も引けない
+    if SEARCH_INDEX_ENABLED and not current_user_id():
+        await search_index.delete_owner(current_owner())
+
 
 @cl.set_starters
 async def set_starters():
@@ -0,0 +1,336 @@
+"""プロバイダの Batch API（OpenAI Batch / Anthropic Message Batches）を使うオフライン一括処理のジョブキュー。
+
+- enqueue() で積んだプロンプトを flush() でプロバイダ・モデル・システムプロンプトごとに1つのバッチへまとめて投入する
+- ジョブの状態は BATCH_JOBS_DIR に JSON で保存し、アプリを再起動しても未完了のジョブのポーリングを再開する
+- 完了したら結果を投入順に並べ直して <job_id>.results.jsonl に書き出す
+- ジョブには投入した利用者（owner）を記録し、一覧・結果の取得はその利用者の分だけに絞る
+- BATCH_OPENAI_BASE_URL / BATCH_ANTHROPIC_BASE_URL でローカルのスタブ（samplecode/batch_stub_server.py）に向けられる
+"""
+import asyncio
+import json
+import os
+import time
+import uuid
+from dataclasses import asdict, dataclass, field
+from typing import Optional
+
+BATCH_JOBS_DIR = os.getenv("BATCH_JOBS_DIR", os.path.join(".files", "batch_jobs"))
+BATCH_POLL_SEC = float(os.getenv("BATCH_POLL_SEC", "30"))
+BATCH_MAX_TOKENS = int(os.getenv("BATCH_MAX_TOKENS", "4096"))
+# 1バッチあたりのリクエスト数の上限（超えた分は別のジョブに分ける）
+BATCH_MAX_REQUESTS = {"openai": 50_000, "claude": 100_000}
+SUPPORTED_PROVIDERS = tuple(BATCH_MAX_REQUESTS)
+
+# ジョブの状態
+QUEUED, SUBMITTED, COMPLETED, FAILED, CANCELLED = "queued", "submitted", "completed", "failed", "cancelled"
+TERMINAL = (COMPLETED, FAILED, CANCELLED)
+
+
+@dataclass
+class BatchJob:
+    job_id: str
+    provider: str
+    model: str
+    system_prompt: str
+    items: list  # [{"custom_id": ..., "prompt": ...}]
+    owner: str = ""  # 投入した利用者（ユーザー ID / 未ログインならセッション）。空のジョブは誰にも見せない
+    status: str = QUEUED
+    remote_id: Optional[str] = None
+    remote_status: Optional[str] = None
+    error: Optional[str] = None
+    counts: dict = field(default_factory=dict)  # succeeded / errored
+    created_at: float = field(default_factory=time.time)
+    updated_at: float = field(default_factory=time.time)
+
+    def summary(self) -> str:
+        counts = ", ".join(f"{k}={v}" for k, v in self.counts.items())
+        return (
+            f"{self.job_id} [{self.provider}/{self.model}] {self.status}"
+            f"{f' ({self.remote_status})' if self.remote_status and self.status == SUBMITTED else ''}"
+            f" items={len(self.items)}{f' {counts}' if counts else ''}{f' error={self.error}' if self.error else ''}"
+        )
+
+
+def batch_clients_from_env(openai_client=None, anthropic_client=None) -> dict:
+    """Batch API 用のクライアント。*_BASE_URL が指定されていればそちら（ローカルスタブなど）を使う。"""
+    clients = {"openai": openai_client, "claude": anthropic_client}
+    if os.getenv("BATCH_OPENAI_BASE_URL"):
+        from openai import AsyncOpenAI
+        clients["openai"] = AsyncOpenAI(
+            api_key=os.getenv("OPENAI_API_KEY") or "local", base_url=os.getenv("BATCH_OPENAI_BASE_URL")
+        )
+    if os.getenv("BATCH_ANTHROPIC_BASE_URL"):
+        from anthropic import AsyncAnthropic
+        clients["claude"] = AsyncAnthropic(
+            api_key=os.getenv("ANTHROPIC_API_KEY") or "local", base_url=os.getenv("BATCH_ANTHROPIC_BASE_URL")
+        )
+    return {k: v for k, v in clients.items() if v is not None}
+
+
+# --- プロバイダごとの投入・状態確認・結果取得 ---
+async def _submit_openai(client, job: BatchJob) -> None:
+    lines = []
+    for item in job.items:
+        body = {"model": job.model, "input": [{"role": "user", "content": item["prompt"]}]}
+        if job.system_prompt:
+            body["instructions"] = job.system_prompt
+        lines.append(json.dumps({"custom_id": item["custom_id"], "method": "POST", "url": "/v1/responses", "body": body}, ensure_ascii=False))
+    payload = ("\n".join(lines) + "\n").encode("utf-8")
+    uploaded = await client.files.create(file=(f"{job.job_id}.jsonl", payload, "application/jsonl"), purpose="batch")
+    batch = await client.batches.create(input_file_id=uploaded.id, endpoint="/v1/responses", completion_window="24h")
+    job.remote_id = batch.id
+    job.remote_status = batch.status
+
+
+async def _poll_openai(client, job: BatchJob) -> Optional[list]:
+    """完了していれば結果の行（custom_id, text, usage, error）を返す。"""
+    batch = await client.batches.retrieve(job.remote_id)
+    job.remote_status = batch.status
+    if batch.status in ("failed", "expired", "cancelled"):
+        errors = getattr(getattr(batch, "errors", None), "data", None) or []
+        job.error = "; ".join(getattr(e, "message", "") or "" for e in errors) or batch.status
+        job.status = CANCELLED if batch.status == "cancelled" else FAILED
+        if not (batch.output_file_id or batch.error_file_id):
+            return None
+    elif batch.status != "completed":
+        return None
+
+    rows = []
+    for file_id in (batch.output_file_id, batch.error_file_id):
+        if not file_id:
+            continue
+        content = await client.files.content(file_id)
+        for line in content.text.splitlines():
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            response = record.get("response") or {}
+            body = response.get("body") or {}
+            text = "".join(
+                part.get("text", "")
+                for output in body.get("output", []) if output.get("type") == "message"
+                for part in output.get("content", []) if part.get("type") == "output_text"
+            )
+            error = record.get("error") or (body.get("error") if response.get("status_code", 200) >= 400 else None)
+            usage = body.get("usage") or {}
+            rows.append({
+                "custom_id": record.get("custom_id"),
+                "text": text,
+                "usage": {k: usage[k] for k in ("input_tokens", "output_tokens") if k in usage},
+                "error": (error.get("message") or json.dumps(error, ensure_ascii=False)) if isinstance(error, dict) else error,
+            })
+    return rows
+
+
+async def _submit_claude(client, job: BatchJob) -> None:
+    requests = []
+    for item in job.items:
+        params = {
+            "model": job.model,
+            "max_tokens": BATCH_MAX_TOKENS,
+            "messages": [{"role": "user", "content": item["prompt"]}],
+        }
+        if job.system_prompt:
+            params["system"] = job.system_prompt
+        requests.append({"custom_id": item["custom_id"], "params": params})
+    batch = await client.messages.batches.create(requests=requests)
+    job.remote_id = batch.id
+    job.remote_status = batch.processing_status
+
+
+async def _poll_claude(client, job: BatchJob) -> Optional[list]:
+    batch = await client.messages.batches.retrieve(job.remote_id)
+    job.remote_status = batch.processing_status
+    if batch.processing_status != "ended":
+        return None
+    rows = []
+    async for entry in await client.messages.batches.results(job.remote_id):
+        result = entry.result
+        if result.type == "succeeded":
+            message = result.message
+            rows.append({
+                "custom_id": entry.custom_id,
+                "text": "".join(getattr(b, "text", "") for b in message.content if getattr(b, "type", None) == "text"),
+                "usage": {"input_tokens": message.usage.input_tokens, "output_tokens": message.usage.output_tokens},
+                "error": None,
+            })
+        else:
+            error = getattr(getattr(result, "error", None), "error", None)
+            rows.append({
+                "custom_id": entry.custom_id,
+                "text": "",
+                "usage": {},
+                "error": getattr(error, "message", None) or result.type,
+            })
+    return rows
+
+
+_SUBMIT = {"openai": _submit_openai, "claude": _submit_claude}
+_POLL = {"openai": _poll_openai, "claude": _poll_claude}
+
+
+class BatchJobQueue:
+    """Batch API ジョブの投入・永続化・ポーリング・結果の組み立て。"""
+
+    def __init__(self, clients: dict, jobs_dir: str = BATCH_JOBS_DIR, poll_interval: float = BATCH_POLL_SEC):
+        self.clients = clients
+        self.jobs_dir = jobs_dir
+        self.poll_interval = poll_interval
+        self.jobs: dict[str, BatchJob] = {}
+        self._pending: dict[tuple[str, str, str, str], list] = {}
+        self._task: Optional[asyncio.Task] = None
+        self._wake = asyncio.Event()
+        self._loaded = False
+
+    # --- 永続化 ---
+    def _path(self, job_id: str, suffix: str = ".json") -> str:
+        return os.path.join(self.jobs_dir, f"{job_id}{suffix}")
+
+    def _write_job(self, job: BatchJob) -> None:
+        os.makedirs(self.jobs_dir, exist_ok=True)
+        tmp = self._path(job.job_id, ".json.tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(asdict(job), f, ensure_ascii=False)
+        os.replace(tmp, self._path(job.job_id))  # 書き込み途中で落ちても壊れたファイルを残さない
+
+    async def _save(self, job: BatchJob) -> None:
+        job.updated_at = time.time()
+        await asyncio.to_thread(self._write_job, job)
+
+    def load(self) -> None:
+        """保存済みのジョブを読み込む（起動時に1回）。"""
+        self._loaded = True
+        if not os.path.isdir(self.jobs_dir):
+            return
+        for name in os.listdir(self.jobs_dir):
+            if not name.endswith(".json"):
+                continue
+            try:
+                with open(os.path.join(self.jobs_dir, name), encoding="utf-8") as f:
+                    job = BatchJob(**json.load(f))
+                self.jobs[job.job_id] = job
+            except Exception as e:
+                print(f"[BatchJobs] {name} を読み込めませんでした: {e}")
+
+    def results_path(self, job_id: str) -> str:
+        return self._path(job_id, ".results.jsonl")
+
+    # --- 投入 ---
+    def enqueue(
+        self, provider: str, model: str, prompt: str, system_prompt: str = "", custom_id: Optional[str] = None, owner: str = ""
+    ) -> str:
+        """プロンプトを投入待ちに積む。同じ利用者・プロバイダ・モデル・システムプロンプトのものは1つのバッチにまとめる。"""
+        if provider not in SUPPORTED_PROVIDERS:
+            raise ValueError(f"Batch API に対応していないプロバイダです: {provider}")
+        items = self._pending.setdefault((owner, provider, model, system_prompt), [])
+        custom_id = custom_id or f"req-{len(items)}-{uuid.uuid4().hex[:8]}"
+        items.append({"custom_id": custom_id, "prompt": prompt})
+        return custom_id
+
+    async def flush(self) -> list[BatchJob]:
+        """投入待ちのプロンプトをバッチとして送信する。"""
+        pending, self._pending = self._pending, {}
+        jobs = []
+        for (owner, provider, model, system_prompt), items in pending.items():
+            limit = BATCH_MAX_REQUESTS[provider]
+            for start in range(0, len(items), limit):
+                job = BatchJob(
+                    job_id=f"batch-{uuid.uuid4().hex[:10]}",
+                    provider=provider,
+                    model=model,
+                    system_prompt=system_prompt,
+                    items=items[start:start + limit],
+                    owner=owner,
+                )
+                self.jobs[job.job_id] = job
+                await self._submit(job)
+                jobs.append(job)
+        self.start()
+        self._wake.set()
+        return jobs
+
+    async def _submit(self, job: BatchJob) -> None:
+        client = self.clients.get(job.provider)
+        try:
+            if client is None:
+                raise RuntimeError(f"{job.provider} のクライアントが設定されていません")
+            await _SUBMIT[job.provider](client, job)
+            job.status = SUBMITTED
+        except Exception as e:
+            job.status, job.error = FAILED, str(e)
+        await self._save(job)
+        print(f"[BatchJobs] submitted {job.summary()}")
+
+    # --- ポーリング ---
+    def start(self) -> None:
+        if not self._loaded:
+            self.load()
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run(), name="batch-job-poller")
+
+    async def poll_once(self) -> None:
+        """投入済みのジョブの状態を確認し、完了したものは結果を書き出す。"""
+        for job in list(self.jobs.values()):
+            if job.status != SUBMITTED:
+                continue
+            client = self.clients.get(job.provider)
+            if client is None:
+                continue
+            before = (job.status, job.remote_status)
+            try:
+                rows = await _POLL[job.provider](client, job)
+            except Exception as e:
+                print(f"[BatchJobs] poll failed {job.job_id}: {e}")
+                continue
+            if rows is not None:
+                await asyncio.to_thread(self._write_results, job, rows)
+                if job.status == SUBMITTED:
+                    job.status = COMPLETED
+            if (job.status, job.remote_status) != before or rows is not None:
+                await self._save(job)
+                print(f"[BatchJobs] {job.summary()}")
+
+    def _write_results(self, job: BatchJob, rows: list) -> None:
+        """結果は順不同で返るので、custom_id で投入順に並べ直して書き出す。"""
+        by_id = {row["custom_id"]: row for row in rows}
+        succeeded = errored = 0
+        tmp = self.results_path(job.job_id) + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            for item in job.items:
+                row = by_id.get(item["custom_id"]) or {"text": "", "usage": {}, "error": "missing result"}
+                if row.get("error"):
+                    errored += 1
+                else:
+                    succeeded += 1
+                f.write(json.dumps({
+                    "custom_id": item["custom_id"],
+                    "prompt": item["prompt"],
+                    "text": row.get("text", ""),
+                    "usage": row.get("usage", {}),
+                    "error": row.get("error"),
+                }, ensure_ascii=False) + "\n")
+        os.replace(tmp, self.results_path(job.job_id))
+        job.counts = {"succeeded": succeeded, "errored": errored}
+
+    async def _run(self) -> None:
+        while any(job.status == SUBMITTED for job in self.jobs.values()):
+            await self.poll_once()
+            self._wake.clear()
+            try:
+                await asyncio.wait_for(self._wake.wait(), self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    def list_jobs(self, owner: str, limit: int = 20) -> list[BatchJob]:
+        """owner が投入したジョブを新しい順に返す。"""
+        if not self._loaded:
+            self.load()
+        jobs = [job for job in self.jobs.values() if owner and job.owner == owner]
+        return sorted(jobs, key=lambda j: j.created_at, reverse=True)[:limit]
+
+    def get_job(self, job_id: str, owner: str) -> Optional[BatchJob]:
+        """owner が投入したジョブなら返す（他の利用者のジョブは無いものとして扱う）。"""
+        if not self._loaded:
+            self.load()
+        job = self.jobs.get(job_id)
+        return job if job is not None and owner and job.owner == owner else None
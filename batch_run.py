@@ -0,0 +1,235 @@
+"""JSONL のプロンプトをブラウザなしでまとめて実行するバッチランナー。
+
+チャット画面と同じ providers.stream_turn() を使い、プロバイダごとに同時実行数を制限して流す。
+結果（テキスト・使用量・所要時間）は1件終わるごとに出力 JSONL に追記するので、中断しても
+同じコマンドで再実行すれば終わっていないものだけを続きから実行する。
+
+使い方:
+    python batch_run.py prompts.jsonl -o results.jsonl --model gpt-4o-mini
+    python batch_run.py prompts.jsonl -o results.jsonl --concurrency openai=8,claude=4 --retry-errors
+    python batch_run.py prompts.jsonl -o results.jsonl --model gpt-4o --tools
+
+ツールはチャット画面と同じ tool_router.select_tool_kinds() で選ぶ。既定は画面の Tools OFF と同じ
+（Grok は Live Search が "auto"、ほかはツールなし）。--tools（または行の "tools": true）で Tools ON と同じく
+メッセージごとにルーターが選ぶ。
+
+入力の各行: {"id": ..., "prompt": ..., "model"?: ..., "provider"?: ..., "system_prompt"?: ..., "tools"?: bool}
+（id / prompt が無い場合は request_id / body も見る。id も無ければ行番号を使う）
+--retry-errors で再実行した id は出力に複数行残るので、集計では同じ id の最後の行を使う。
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+from typing import Optional
+
+from dotenv import load_dotenv
+from langchain_core.messages import HumanMessage
+
+from providers import ProviderClients, TurnRequest, TurnResult, infer_provider, stream_turn
+from tool_router import openai_tools_for, select_tool_kinds
+
+# プロバイダごとの既定の同時実行数
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "4"))
+
+
+def parse_concurrency(spec: Optional[str]) -> dict:
+    """"openai=8,claude=4" → {"openai": 8, "claude": 4}"""
+    limits = {}
+    for part in (spec or "").split(","):
+        if "=" in part:
+            name, value = part.split("=", 1)
+            limits[name.strip()] = max(1, int(value))
+    return limits
+
+
+def load_items(path: str, default_model: Optional[str], default_system: str, default_tools: bool = False) -> list[dict]:
+    items = []
+    with open(path, encoding="utf-8") as f:
+        for lineno, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            row = json.loads(line)
+            prompt = row.get("prompt") or row.get("body")
+            if not prompt:
+                print(f"[batch] line {lineno}: prompt がないためスキップします", file=sys.stderr)
+                continue
+            if row.get("title") and "prompt" not in row:
+                prompt = f"{row['title']}\n\n{prompt}"
+            model = row.get("model") or default_model
+            provider = row.get("provider") or infer_provider(model)
+            if not model or not provider:
+                print(f"[batch] line {lineno}: model / provider を決められないためスキップします", file=sys.stderr)
+                continue
+            items.append({
+                "id": str(row.get("id") or row.get("request_id") or f"line-{lineno}"),
+                "prompt": prompt,
+                "model": model,
+                "provider": provider,
+                "system_prompt": row.get("system_prompt", default_system),
+                "tools": bool(row.get("tools", default_tools)),
+            })
+    return items
+
+
+def load_finished(path: str, retry_errors: bool) -> set:
+    """出力 JSONL から完了済みの id を集める（再開用）。途中で切れた最終行は無視する。"""
+    finished = set()
+    if not os.path.exists(path):
+        return finished
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                row = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if retry_errors and row.get("error"):
+                continue
+            finished.add(row.get("id"))
+    return finished
+
+
+class ResultWriter:
+    """結果を1行ずつ追記して即座に書き出す（中断しても完了分は残る）。"""
+
+    def __init__(self, path: str):
+        # 前回の中断で最終行が途中で切れていたら改行して区切る
+        if os.path.exists(path) and os.path.getsize(path):
+            with open(path, "rb") as f:
+                f.seek(-1, os.SEEK_END)
+                broken = f.read(1) != b"\n"
+        else:
+            broken = False
+        self._file = open(path, "a", encoding="utf-8")
+        if broken:
+            self._file.write("\n")
+        self._lock = asyncio.Lock()
+
+    async def write(self, record: dict) -> None:
+        line = json.dumps(record, ensure_ascii=False) + "\n"
+        async with self._lock:
+            self._file.write(line)
+            self._file.flush()
+
+    def close(self) -> None:
+        self._file.close()
+
+
+async def run_item(clients: ProviderClients, item: dict, retries: int) -> dict:
+    """1件を実行する。一時的なエラーは指数バックオフで retries 回まで再試行する。"""
+    error = None
+    if clients.for_provider(item["provider"]) is None:
+        retries = 0  # API キーが無いものは再試行しても変わらない
+    # チャット画面と同じ規則でツールを選ぶ（MCP はプールを持たないので OpenAI の hosted mcp ツールで呼ぶ）
+    tool_kinds = select_tool_kinds(item["provider"], item["prompt"], item.get("tools", False))
+    for attempt in range(retries + 1):
+        result = TurnResult()
+        request = TurnRequest(
+            provider=item["provider"],
+            model=item["model"],
+            history=[HumanMessage(content=item["prompt"])],
+            system_prompt=item["system_prompt"],
+            tool_kinds=tool_kinds,
+            openai_tools=openai_tools_for(tool_kinds),
+        )
+        try:
+            async for _ in stream_turn(clients, request, result):
+                pass
+            return {
+                "id": item["id"], "provider": item["provider"], "model": item["model"],
+                "text": result.text, "usage": result.usage,
+                "ttft_ms": result.ttft_ms, "total_ms": result.total_ms,
+                "attempts": attempt + 1, "error": None,
+            }
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+            if attempt < retries:
+                await asyncio.sleep(min(30.0, 2 ** attempt))
+    return {
+        "id": item["id"], "provider": item["provider"], "model": item["model"],
+        "text": "", "usage": {}, "ttft_ms": None, "total_ms": None,
+        "attempts": retries + 1, "error": error,
+    }
+
+
+async def run_batch(
+    items: list[dict],
+    output: str,
+    clients: ProviderClients,
+    limits: dict,
+    default_limit: int = BATCH_CONCURRENCY,
+    retries: int = 2,
+    retry_errors: bool = False,
+) -> dict:
+    finished = load_finished(output, retry_errors)
+    pending = [item for item in items if item["id"] not in finished]
+    print(f"[batch] total={len(items)} done={len(items) - len(pending)} pending={len(pending)}", file=sys.stderr)
+
+    providers = {i["provider"] for i in pending}
+    semaphores = {p: asyncio.Semaphore(limits.get(p, default_limit)) for p in providers}
+    # 全件を一度にタスク化しないよう、投入数も同時実行数の合計の2倍までに抑える
+    admission = asyncio.Semaphore(max(1, 2 * sum(limits.get(p, default_limit) for p in providers)))
+    writer = ResultWriter(output)
+    stats = {"ok": 0, "error": 0}
+    started = time.monotonic()
+
+    async def worker(item: dict) -> None:
+        try:
+            async with semaphores[item["provider"]]:
+                record = await run_item(clients, item, retries)
+            await writer.write(record)
+            stats["error" if record["error"] else "ok"] += 1
+            done = stats["ok"] + stats["error"]
+            if done % 10 == 0 or done == len(pending):
+                rate = done / max(1e-9, time.monotonic() - started)
+                print(f"[batch] {done}/{len(pending)} ok={stats['ok']} error={stats['error']} {rate:.2f} items/s", file=sys.stderr)
+        finally:
+            admission.release()
+
+    tasks = []
+    try:
+        for item in pending:
+            await admission.acquire()
+            tasks.append(asyncio.create_task(worker(item)))
+        await asyncio.gather(*tasks)
+    finally:
+        for task in tasks:
+            task.cancel()
+        writer.close()
+    return stats
+
+
+def main(argv: Optional[list] = None) -> int:
+    parser = argparse.ArgumentParser(description="JSONL のプロンプトをプロバイダ API でまとめて実行する")
+    parser.add_argument("input", help="入力 JSONL")
+    parser.add_argument("-o", "--output", required=True, help="結果を追記する JSONL（既存の完了分はスキップ）")
+    parser.add_argument("--model", help="行に model が無い場合に使うモデル")
+    parser.add_argument("--system", default="", help="行に system_prompt が無い場合のシステムプロンプト（@path でファイル）")
+    parser.add_argument("--concurrency", help="プロバイダごとの同時実行数（例: openai=8,claude=4）")
+    parser.add_argument("--tools", action="store_true", help="画面の Tools ON と同じくメッセージごとにツールを選ぶ（行の tools が優先）")
+    parser.add_argument("--retries", type=int, default=2, help="1件あたりの再試行回数")
+    parser.add_argument("--retry-errors", action="store_true", help="前回エラーになったものも再実行する")
+    args = parser.parse_args(argv)
+
+    load_dotenv()
+    system = args.system
+    if system.startswith("@"):
+        with open(system[1:], encoding="utf-8") as f:
+            system = f.read()
+    items = load_items(args.input, args.model, system, args.tools)
+    try:
+        stats = asyncio.run(run_batch(
+            items, args.output, ProviderClients.from_env(), parse_concurrency(args.concurrency),
+            retries=args.retries, retry_errors=args.retry_errors,
+        ))
+    except KeyboardInterrupt:
+        print("[batch] 中断しました。同じコマンドで続きから再開できます。", file=sys.stderr)
+        return 130
+    return 1 if stats["error"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
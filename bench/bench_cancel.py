@@ -0,0 +1,156 @@
+# 停止ボタン / 切断時の上流解放までの時間を測る（API キー不要）
+# ローカルの疑似 SSE サーバーに OpenAI / Anthropic SDK をつなぎ、providers.stream_turn() を途中でキャンセルして
+#   release = キャンセルしてから呼び出し側のタスクが終わるまで
+#   closed  = キャンセルしてからサーバー側で接続が切れたのを検知するまで
+# を計測する。Grok（同期ストリームをスレッドで回す経路）は、1チャンクに時間のかかる同期ジェネレーターで代用する。
+# 使い方: python bench/bench_cancel.py [回数]
+import asyncio
+import json
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from anthropic import AsyncAnthropic
+from langchain_core.messages import HumanMessage
+from openai import AsyncOpenAI
+
+from providers import ProviderClients, TurnRequest, TurnResult, _iterate_in_thread, stream_turn
+
+RUNS = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+TOKEN_INTERVAL_SEC = 0.05
+TOKENS = 400  # キャンセルしなければ 20 秒流れ続ける
+CANCEL_AFTER_TOKENS = 5
+
+closed_at: list[float] = []
+
+
+def openai_events():
+    for i in range(TOKENS):
+        yield "response.output_text.delta", {
+            "type": "response.output_text.delta", "delta": f"t{i} ", "item_id": "msg_1",
+            "output_index": 0, "content_index": 0, "sequence_number": i,
+        }
+
+
+def anthropic_events():
+    yield "message_start", {"type": "message_start", "message": {
+        "id": "msg_1", "type": "message", "role": "assistant", "model": "claude-bench", "content": [],
+        "stop_reason": None, "stop_sequence": None, "usage": {"input_tokens": 10, "output_tokens": 0},
+    }}
+    yield "content_block_start", {"type": "content_block_start", "index": 0, "content_block": {"type": "text", "text": ""}}
+    for i in range(TOKENS):
+        yield "content_block_delta", {"type": "content_block_delta", "index": 0, "delta": {"type": "text_delta", "text": f"t{i} "}}
+
+
+async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+    head = await reader.readuntil(b"\r\n\r\n")
+    path = head.split(b" ", 2)[1].decode()
+    length = next((int(line.split(b":")[1]) for line in head.split(b"\r\n") if line.lower().startswith(b"content-length")), 0)
+    await reader.readexactly(length)
+    writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nTransfer-Encoding: chunked\r\n\r\n")
+
+    async def watch_eof() -> None:
+        await reader.read()  # クライアントが接続を閉じると b"" が返る
+        closed_at.append(time.perf_counter())
+
+    watcher = asyncio.create_task(watch_eof())
+    events = anthropic_events() if path.endswith("/messages") else openai_events()
+    try:
+        for name, data in events:
+            if watcher.done():
+                return
+            payload = f"event: {name}\ndata: {json.dumps(data)}\n\n".encode()
+            writer.write(f"{len(payload):x}\r\n".encode() + payload + b"\r\n")
+            await writer.drain()
+            await asyncio.sleep(TOKEN_INTERVAL_SEC)
+    except ConnectionError:
+        pass
+    finally:
+        await watcher
+        writer.close()
+
+
+async def measure(clients: ProviderClients, provider: str, model: str) -> tuple[float, float]:
+    closed_at.clear()
+    request = TurnRequest(provider=provider, model=model, history=[HumanMessage(content="hello")], system_prompt="bench")
+    result = TurnResult()
+    received = asyncio.Event()
+
+    async def consume() -> None:
+        tokens = 0
+        async for kind, _ in stream_turn(clients, request, result):
+            tokens += kind == "token"
+            if tokens == CANCEL_AFTER_TOKENS:
+                received.set()
+
+    task = asyncio.create_task(consume())
+    await received.wait()
+    cancelled = time.perf_counter()
+    task.cancel()
+    await asyncio.gather(task, return_exceptions=True)
+    release = (time.perf_counter() - cancelled) * 1000
+    for _ in range(200):
+        if closed_at:
+            break
+        await asyncio.sleep(0.005)
+    assert result.cancelled, "TurnResult.cancelled が立っていない"
+    closed = (closed_at[0] - cancelled) * 1000 if closed_at else float("nan")
+    return release, closed
+
+
+async def measure_thread_stream() -> tuple[float, float]:
+    # 1チャンクの受信に TOKEN_INTERVAL_SEC かかる同期ストリーム（xai_sdk の chat.stream() の代わり）
+    closed = []
+
+    def sync_stream():
+        try:
+            for i in range(TOKENS):
+                time.sleep(TOKEN_INTERVAL_SEC)
+                yield i
+        finally:
+            closed.append(time.perf_counter())
+
+    received = asyncio.Event()
+
+    async def consume() -> None:
+        async for i in _iterate_in_thread(sync_stream()):
+            if i == CANCEL_AFTER_TOKENS:
+                received.set()
+
+    task = asyncio.create_task(consume())
+    await received.wait()
+    cancelled = time.perf_counter()
+    task.cancel()
+    await asyncio.gather(task, return_exceptions=True)
+    release = (time.perf_counter() - cancelled) * 1000
+    while not closed:
+        await asyncio.sleep(0.005)
+    return release, (closed[0] - cancelled) * 1000
+
+
+def report(label: str, samples: list[tuple[float, float]]) -> None:
+    release = sorted(s[0] for s in samples)
+    closed = sorted(s[1] for s in samples)
+    print(f"{label:<16} release p50={statistics.median(release):6.2f} ms max={release[-1]:6.2f} ms   "
+          f"upstream closed p50={statistics.median(closed):6.2f} ms max={closed[-1]:6.2f} ms")
+
+
+async def main() -> None:
+    server = await asyncio.start_server(handle, "127.0.0.1", 0)
+    base = f"http://127.0.0.1:{server.sockets[0].getsockname()[1]}"
+    clients = ProviderClients(
+        openai=AsyncOpenAI(api_key="bench", base_url=f"{base}/v1", max_retries=0),
+        anthropic=AsyncAnthropic(api_key="bench", base_url=base, max_retries=0),
+    )
+    print(f"runs={RUNS} cancel after {CANCEL_AFTER_TOKENS} tokens (stream would otherwise run {TOKENS * TOKEN_INTERVAL_SEC:.0f}s)")
+    report("openai (http)", [await measure(clients, "openai", "gpt-bench") for _ in range(RUNS)])
+    report("claude (http)", [await measure(clients, "claude", "claude-bench") for _ in range(RUNS)])
+    report("grok (thread)", [await measure_thread_stream() for _ in range(RUNS)])
+    server.close()
+    await server.wait_closed()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
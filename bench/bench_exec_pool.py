@@ -0,0 +1,58 @@
+# Code コマンドの Python 実行: 毎回プロセスを起動する場合（cold）と実行プール（warm）の実行時間を比較する
+# 使い方: python bench/bench_exec_pool.py [回数]
+import asyncio
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from exec_pool import EXEC_PREIMPORT, ExecPool
+
+RUNS = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+REFILL_WAIT_SEC = 0.5
+CODE = "import math, statistics\nprint(sum(math.sqrt(i) for i in range(10000)))\nprint(statistics.mean([1, 2, 3]))\n"
+
+
+def report(label: str, samples: list[float]) -> None:
+    samples = sorted(samples)
+    p95 = samples[max(0, int(len(samples) * 0.95) - 1)]
+    print(f"{label:<6} p50={statistics.median(samples):7.1f} ms  p95={p95:7.1f} ms  max={samples[-1]:7.1f} ms")
+
+
+def run_cold() -> list[float]:
+    # 同じ事前 import をしてからコードを実行する新しいプロセスを毎回起動する
+    prelude = "".join(f"import {m}\n" for m in EXEC_PREIMPORT)
+    samples = []
+    for _ in range(RUNS):
+        started = time.perf_counter()
+        subprocess.run([sys.executable, "-c", prelude + CODE], check=True, capture_output=True)
+        samples.append((time.perf_counter() - started) * 1000)
+    return samples
+
+
+async def run_warm() -> tuple[float, list[float]]:
+    pool = ExecPool(size=2)
+    started = time.perf_counter()
+    await pool.start()
+    startup = (time.perf_counter() - started) * 1000
+    samples = []
+    for _ in range(RUNS):
+        # ワーカーは1回ごとに捨てて補充されるので、補充を待ってから計る（実際の Run の間隔はこれより長い）
+        await asyncio.sleep(REFILL_WAIT_SEC)
+        started = time.perf_counter()
+        async for kind, payload in pool.run(CODE):
+            if kind == "exit" and not payload["ok"]:
+                raise RuntimeError(payload["error"])
+        samples.append((time.perf_counter() - started) * 1000)
+    await pool.close()
+    return startup, samples
+
+
+if __name__ == "__main__":
+    print(f"runs={RUNS} preimport={','.join(EXEC_PREIMPORT)}")
+    report("cold", run_cold())
+    startup, warm = asyncio.run(run_warm())
+    report("warm", warm)
+    print(f"pool startup (2 workers, in background at chat start) = {startup:.0f} ms")
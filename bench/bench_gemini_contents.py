@@ -0,0 +1,66 @@
+# Gemini: 従来の連結プロンプトと role 付き contents（＋任意のコンテキストキャッシュ）を比較する
+# 使い方: python bench/bench_gemini_contents.py [ターン数] [モデル]
+#   GOOGLE_API_KEY があればプロンプトトークン数と TTFT を実測し、無ければ送信文字数のみを比較する
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from dotenv import load_dotenv
+from google import genai
+from google.genai.types import GenerateContentConfig
+from langchain_core.messages import AIMessage, HumanMessage
+
+from gemini_contents import GeminiContextCache, GeminiConversation, flatten_prompt
+
+load_dotenv()
+TURNS = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+MODEL = sys.argv[2] if len(sys.argv) > 2 else "gemini-2.5-flash-lite"
+SYSTEM = "You are a helpful assistant. Answer concisely."
+
+
+def synthetic_history(turns: int) -> list:
+    history = []
+    for i in range(turns):
+        history.append(HumanMessage(content=f"質問{i}: Pythonのリスト内包表記の例を{i % 5 + 1}個示して。"))
+        history.append(AIMessage(content=f"回答{i}: " + "[x * x for x in range(10)] " * 20))
+    return history
+
+
+async def ttft(client, contents, config) -> float:
+    started = time.monotonic()
+    stream = await client.aio.models.generate_content_stream(model=MODEL, contents=contents, config=config)
+    async for chunk in stream:
+        if chunk.text:
+            return (time.monotonic() - started) * 1000
+    return (time.monotonic() - started) * 1000
+
+
+async def main():
+    history = synthetic_history(TURNS)
+    api_key = os.getenv("GOOGLE_API_KEY")
+    client = genai.Client(api_key=api_key) if api_key else None
+    conversation = GeminiConversation()
+    cache = GeminiContextCache()
+
+    for turn in (1, TURNS // 2, TURNS):
+        messages = history[: turn * 2 - 1]
+        flat = flatten_prompt(SYSTEM, messages)
+        contents = list(conversation.sync(messages))
+        print(f"turn={turn}: flat_chars={len(flat)} structured_messages={len(contents)}")
+        if client is None:
+            continue
+        flat_tokens = (await client.aio.models.count_tokens(model=MODEL, contents=flat)).total_tokens
+        flat_ttft = await ttft(client, flat, GenerateContentConfig())
+        structured_ttft = await ttft(client, contents, GenerateContentConfig(system_instruction=SYSTEM))
+        name, rest = await cache.prepare(client, MODEL, SYSTEM, contents)
+        cached_ttft = await ttft(client, rest, GenerateContentConfig(cached_content=name)) if name else None
+        print(
+            f"  flat: tokens={flat_tokens} ttft={flat_ttft:.0f}ms | structured: ttft={structured_ttft:.0f}ms"
+            + (f" | cached: sent_messages={len(rest)} ttft={cached_ttft:.0f}ms" if cached_ttft else "")
+        )
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
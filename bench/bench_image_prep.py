@@ -0,0 +1,96 @@
+# 添付画像の前処理: プロバイダごとの送信バイト数（原寸 vs 縮小後）と処理時間（初回 / キャッシュ）を測る
+# --live を付けると API キーのあるプロバイダで、原寸と縮小後の画像を添付したときの TTFT も比べる
+# 使い方: python bench/bench_image_prep.py [--live]
+import asyncio
+import base64
+import os
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from PIL import Image, ImageDraw
+
+import uploads
+from image_prep import IMAGE_TARGETS, ImagePreprocessor
+from uploads import sha256_file
+
+LIVE = "--live" in sys.argv
+MODELS = {"openai": "gpt-4o-mini", "claude": "claude-sonnet-4-5-20250929", "gemini": "gemini-2.5-flash", "grok": "grok-4-fast-non-reasoning-latest"}
+
+
+def make_samples(tmp: str) -> list[tuple[str, str]]:
+    # スマートフォンの写真相当（12MP の JPEG）と、画面キャプチャ相当（文字の多い PNG）
+    photo = Image.radial_gradient("L").resize((4032, 3024)).convert("RGB")
+    noise = Image.effect_noise((4032, 3024), 40).convert("RGB")
+    photo = Image.blend(photo, noise, 0.35)
+    photo_path = os.path.join(tmp, "photo.jpg")
+    photo.save(photo_path, "JPEG", quality=95)
+
+    shot = Image.new("RGB", (2560, 1600), "white")
+    draw = ImageDraw.Draw(shot)
+    for y in range(20, 1600, 22):
+        draw.text((20, y), "def handler(message): return stream_turn(clients, request, result)  # " + str(y), fill="black")
+    shot_path = os.path.join(tmp, "screenshot.png")
+    shot.save(shot_path, "PNG")
+    return [(photo_path, "image/jpeg"), (shot_path, "image/png")]
+
+
+async def measure_prep(samples, tmp: str) -> None:
+    prep = ImagePreprocessor(cache_dir=os.path.join(tmp, "cache"))
+    print(f"{'image':<16}{'provider':<8}{'size':>22}{'bytes':>24}{'base64':>12}{'cold':>10}{'cached':>9}")
+    for path, mime in samples:
+        digest, _ = sha256_file(path)
+        for provider in IMAGE_TARGETS:
+            cold = await prep.prepare(path, mime, digest, provider)
+            started = time.perf_counter()
+            await prep.prepare(path, mime, digest, provider)
+            cached_ms = (time.perf_counter() - started) * 1000
+            b64 = len(base64.b64encode(open(cold.path, "rb").read()))
+            size = f"{cold.original_size[0]}x{cold.original_size[1]}->{cold.size[0]}x{cold.size[1]}"
+            print(f"{os.path.basename(path):<16}{provider:<8}{size:>22}{cold.original_bytes:>12,} ->{cold.bytes:>9,}"
+                  f"{b64:>12,}{cold.elapsed_ms:>8.0f}ms{cached_ms:>7.2f}ms")
+    prep.close()
+
+
+async def measure_ttft(samples) -> None:
+    from dotenv import load_dotenv
+    from langchain_core.messages import HumanMessage
+    from providers import ProviderClients, TurnRequest, TurnResult, stream_turn
+
+    load_dotenv()
+    clients = ProviderClients.from_env()
+    upload_clients = {"openai": clients.openai, "claude": clients.anthropic, "gemini": clients.gemini, "grok": clients.xai}
+    path, mime = samples[0]
+    element = SimpleNamespace(path=path, name=os.path.basename(path), mime=mime)
+    for provider, client in upload_clients.items():
+        if client is None:
+            print(f"{provider:<8} skipped (API キーなし)")
+            continue
+        for label, enabled in (("original", False), ("resized", True)):
+            uploads.IMAGE_PREP_ENABLED = enabled
+            uploads.file_upload_cache = uploads.FileUploadCache()  # 毎回アップロードから測る
+            started = time.perf_counter()
+            refs, _ = await uploads.upload_elements([element], provider, client)
+            upload_ms = (time.perf_counter() - started) * 1000
+            result = TurnResult()
+            request = TurnRequest(
+                provider=provider, model=MODELS[provider], history=[HumanMessage(content="この画像を一文で説明して")],
+                system_prompt="", attachments=refs,
+            )
+            async for _ in stream_turn(clients, request, result):
+                pass
+            print(f"{provider:<8}{label:<10} upload={upload_ms:7.0f} ms  ttft={result.ttft_ms} ms  total={result.total_ms} ms  usage={result.usage}")
+
+
+async def main() -> None:
+    with tempfile.TemporaryDirectory() as tmp:
+        samples = make_samples(tmp)
+        await measure_prep(samples, tmp)
+        if LIVE:
+            await measure_ttft(samples)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,48 @@
+# MCPClientManager をローカルのスタブサーバー（stdio）に対して計測する
+# 使い方: python bench/bench_mcp_pool.py
+import asyncio
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+from mcp_pool import MCPClientManager, MCPServerConfig
+
+
+async def main():
+    manager = MCPClientManager([
+        MCPServerConfig(
+            name="stub",
+            transport="stdio",
+            command=sys.executable,
+            args=[os.path.join(ROOT, "samplecode", "mcp_stub_server.py")],
+        )
+    ])
+    try:
+        t0 = time.perf_counter()
+        tools = await manager.list_tools("stub")
+        print(f"cold list_tools: {(time.perf_counter() - t0) * 1000:.1f}ms ({[t.name for t in tools]})")
+
+        t0 = time.perf_counter()
+        await manager.list_tools("stub")
+        print(f"cached list_tools: {(time.perf_counter() - t0) * 1000:.3f}ms")
+
+        manager.invalidate("stub")
+        t0 = time.perf_counter()
+        await manager.list_tools("stub")
+        print(f"warm list_tools (after invalidate): {(time.perf_counter() - t0) * 1000:.1f}ms")
+
+        t0 = time.perf_counter()
+        results = await manager.call_tools([("stub", "sleep", {"seconds": 0.5}) for _ in range(4)])
+        print(f"4 x sleep(0.5) concurrently: {(time.perf_counter() - t0) * 1000:.0f}ms")
+        assert not any(isinstance(r, Exception) for r in results), results
+
+        result = await manager.call_tool("stub", "add", {"a": 2, "b": 3})
+        print("add(2, 3) ->", result.content[0].text)
+    finally:
+        await manager.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,80 @@
+# @profiled の無効時のオーバーヘッドと、有効時（sampler / cprofile / tracemalloc）の1ターンあたりのコストを測る
+# 使い方: python bench/bench_profiling.py [呼び出し回数]
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import profiling
+from profiling import profiled
+
+CALLS = int(sys.argv[1]) if len(sys.argv) > 1 else 200_000
+
+
+def helper(text: str) -> int:
+    return len(text)
+
+
+async def handler(text: str) -> int:
+    return helper(text)
+
+
+wrapped_helper = profiled("helper")(helper)
+
+
+@profiled("handler")
+async def wrapped_handler(text: str) -> int:
+    return wrapped_helper(text)
+
+
+async def per_call_ns(fn) -> float:
+    started = time.perf_counter()
+    for _ in range(CALLS):
+        await fn("hello")
+    return (time.perf_counter() - started) / CALLS * 1e9
+
+
+@profiled("turn")
+async def turn() -> None:
+    # 上流待ち（sleep）と CPU 処理（抽出ヘルパー相当）が混ざった1ターン
+    for _ in range(20):
+        await asyncio.sleep(0.005)
+        wrapped_helper("x" * 10_000)
+        sum(i * i for i in range(20_000))
+
+
+async def enabled_turn_ms(mode: str) -> float:
+    profiling.PROFILE_MODE = mode
+    started = time.perf_counter()
+    await turn()
+    return (time.perf_counter() - started) * 1000
+
+
+async def main() -> None:
+    bare = await per_call_ns(handler)
+    disabled = await per_call_ns(wrapped_handler)
+    print(f"disabled: bare={bare:.0f} ns/call  @profiled={disabled:.0f} ns/call  overhead={disabled - bare:.0f} ns/call")
+
+    profiling.PROFILE_SAMPLE_RATE = 0.0
+    started = time.perf_counter()
+    await turn()
+    baseline_ms = (time.perf_counter() - started) * 1000
+    profiling.PROFILE_SAMPLE_RATE = 1.0
+    with tempfile.TemporaryDirectory() as tmp:
+        profiling.PROFILE_DIR = tmp
+        for mode in ("sampler", "cprofile"):
+            ms = await enabled_turn_ms(mode)
+            print(f"enabled ({mode:<8}) turn={ms:6.1f} ms  (unprofiled {baseline_ms:6.1f} ms)")
+        profiling.PROFILE_TRACEMALLOC = True
+        ms = await enabled_turn_ms("sampler")
+        print(f"enabled (sampler + tracemalloc) turn={ms:6.1f} ms")
+        files = sorted(os.listdir(tmp))
+        print("written:", ", ".join(f.split("_", 2)[-1] for f in files))
+        sampled = next(f for f in files if f.endswith(".folded"))
+        print(open(os.path.join(tmp, sampled.replace(".folded", ".summary.txt")), encoding="utf-8").read()[:800])
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,40 @@
+# BM25 インデックスの検索レイテンシを計測する（既定: 10万チャンク）
+# 使い方: python bench/bench_retrieval.py [チャンク数]
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from retrieval import BM25Index, tokenize
+
+N_CHUNKS = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+WORDS = [f"w{i}" for i in range(50_000)] + ["生成", "モデル", "検索", "推論", "画像", "音声"]
+QUERIES = ["生成モデル の 推論", "w12 w345 w6789", "検索 画像 w42", "音声 w1000 w2000 w3000"]
+
+random.seed(0)
+index = BM25Index()
+t0 = time.perf_counter()
+batch = []
+for i in range(N_CHUNKS):
+    text = " ".join(random.choices(WORDS, k=120))
+    batch.append((text, tokenize(text)))
+    if len(batch) == 10_000:
+        index.add_chunks(f"doc{i}", "bench", batch)
+        batch = []
+if batch:
+    index.add_chunks("doc-last", "bench", batch)
+print(f"add: {N_CHUNKS} chunks in {time.perf_counter() - t0:.2f}s")
+
+t0 = time.perf_counter()
+index.search("warmup")
+print(f"build (first query): {time.perf_counter() - t0:.2f}s")
+
+latencies = []
+for _ in range(50):
+    for q in QUERIES:
+        t0 = time.perf_counter()
+        index.search(q, k=4)
+        latencies.append((time.perf_counter() - t0) * 1000)
+latencies.sort()
+print(f"query: p50={latencies[len(latencies) // 2]:.2f}ms p95={latencies[int(len(latencies) * 0.95)]:.2f}ms max={latencies[-1]:.2f}ms")
@@ -0,0 +1,82 @@
+# 会話の全文検索: 100万メッセージを索引に入れたときの書き込み速度・DB サイズ・/search の応答時間を測る
+# ターン側のコスト（add() でキューに積むだけ）と、よくある語・まれな語・2文字の語（部分一致）の検索時間を比べる。
+# 使い方: python bench/bench_search_index.py [メッセージ数]
+import asyncio
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from search_index import SearchIndex, format_hits, owner_key
+
+MESSAGES = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+BATCH = 20_000
+USERS = 50
+WORDS = (
+    "非同期 ストリーミング 応答 モデル プロバイダ 添付 画像 スライド 検索 インデックス 設定 エラー 再試行 "
+    "キャッシュ 会話 履歴 トークン 料金 レイテンシ 接続 タイムアウト コード 実行 ワーカー 関数 クラス "
+    "asyncio python sqlite chainlit openai gemini claude grok websocket json markdown docker"
+).split()
+RARE = "ユニコーン検索語"
+QUERIES = ["ストリーミング", "asyncio タイムアウト", "sqlite インデックス 設定", RARE, "料金", "画像 js"]
+
+
+def make_text(rng: random.Random, i: int) -> str:
+    words = rng.choices(WORDS, k=rng.randint(8, 30))
+    if i % 100_000 == 7:
+        words.insert(rng.randrange(len(words)), RARE)
+    return "".join(w + ("。" if rng.random() < 0.15 else " ") for w in words)
+
+
+def fill(index: SearchIndex) -> float:
+    rng = random.Random(0)
+    kinds = ("user", "assistant", "assistant", "code")
+    started = time.perf_counter()
+    now = time.time()
+    owners = [owner_key(f"user{u}") for u in range(USERS)]
+    for offset in range(0, MESSAGES, BATCH):
+        rows = [
+            (owners[i % USERS], f"thread{i // 40}", f"session{i // 40}", kinds[i % 4], now - (MESSAGES - i) * 1.3, make_text(rng, i))
+            for i in range(offset, min(MESSAGES, offset + BATCH))
+        ]
+        index.write(rows)
+    return time.perf_counter() - started
+
+
+async def measure_add(index: SearchIndex) -> None:
+    # ターンの終わりに呼ぶ add() のコスト（書き込みはバックグラウンド）
+    entries = [("user", "質問 " * 20), ("assistant", "回答 " * 300), ("code", "print('x')\n" * 20)]
+    started = time.perf_counter()
+    for _ in range(1000):
+        index.add("user0", "thread-bench", "session-bench", entries)
+    per_turn_us = (time.perf_counter() - started) / 1000 * 1e6
+    await asyncio.sleep(index.interval * 2)
+    while index._queue.qsize():
+        await asyncio.sleep(0.1)
+    print(f"add() per turn: {per_turn_us:.1f} µs (3 entries, background writes={index.stats['batches']} batches)")
+
+
+async def main() -> None:
+    with tempfile.TemporaryDirectory() as tmp:
+        index = SearchIndex(path=os.path.join(tmp, "search.db"))
+        elapsed = fill(index)
+        size_mb = sum(os.path.getsize(os.path.join(tmp, f)) for f in os.listdir(tmp)) / 1e6
+        print(f"indexed {MESSAGES:,} messages in {elapsed:.1f} s ({MESSAGES / elapsed:,.0f} msg/s), db={size_mb:,.0f} MB")
+        await measure_add(index)
+
+        for query in QUERIES:
+            times = []
+            for i in range(20):
+                hits, ms = await index.search(f"user{i % USERS}", query)
+                times.append(ms)
+            times.sort()
+            print(f"{query:<24} hits={len(hits):>2}  p50={statistics.median(times):7.2f} ms  p95={times[int(len(times) * 0.95) - 1]:7.2f} ms")
+        hits, ms = await index.search("user7", RARE)
+        print("\n" + format_hits(hits[:3], ms))
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,94 @@
+# スターターの一斉クリック: 同じプロンプトが同時に来たときの上流呼び出し数と、各セッションの TTFT / 完了時間を比較する
+# 上流はトークンを一定間隔で返す疑似ストリーム（API キー不要）。別々のセッションのクリックをまとめるので SINGLEFLIGHT_SCOPE=global 相当。
+# 使い方: python bench/bench_singleflight.py [クリック数] [クリックが散らばる秒数]
+import asyncio
+import os
+import random
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from langchain_core.messages import HumanMessage
+
+from providers import TurnRequest, TurnResult
+from singleflight import SingleFlight, coalesce_key
+
+CLICKS = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+SPREAD_SEC = float(sys.argv[2]) if len(sys.argv) > 2 else 1.0
+UPSTREAM_TTFT_SEC = 0.4
+TOKENS = 200
+TOKEN_INTERVAL_SEC = 0.01
+# 上流の同時接続数の上限（レート制限の代わり）。まとめない場合はここで待たされる
+UPSTREAM_CONCURRENCY = 8
+
+upstream = asyncio.Semaphore(UPSTREAM_CONCURRENCY)
+calls = 0
+
+
+async def fake_stream(result: TurnResult):
+    global calls
+    calls += 1
+    async with upstream:
+        await asyncio.sleep(UPSTREAM_TTFT_SEC)
+        for i in range(TOKENS):
+            yield "token", f"t{i} "
+            await asyncio.sleep(TOKEN_INTERVAL_SEC)
+    result.text = "".join(f"t{i} " for i in range(TOKENS))
+
+
+def request() -> TurnRequest:
+    # 新しいチャットでスターターを押した直後と同じ（履歴はその1発話だけ）
+    return TurnRequest(
+        provider="openai",
+        model="gpt-4o-mini",
+        history=[HumanMessage(content="今日発表された情報を元に生成AIの最新ニュースを教えて")],
+        system_prompt="あなたは優秀なアシスタントです。",
+        tool_kinds={"web_search"},
+    )
+
+
+async def click(delay: float, flights) -> tuple[float, float, int]:
+    await asyncio.sleep(delay)
+    started = time.perf_counter()
+    if flights is not None:
+        flight, _ = flights.join(coalesce_key(request()), fake_stream)
+        events = flight.subscribe()
+    else:
+        events = fake_stream(TurnResult())
+    ttft = None
+    tokens = 0
+    async for kind, _ in events:
+        if kind == "token":
+            tokens += 1
+            if ttft is None:
+                ttft = time.perf_counter() - started
+    return ttft * 1000, (time.perf_counter() - started) * 1000, tokens
+
+
+def report(label: str, samples: list[float]) -> str:
+    samples = sorted(samples)
+    p95 = samples[max(0, int(len(samples) * 0.95) - 1)]
+    return f"{label} p50={statistics.median(samples):7.1f} ms  p95={p95:7.1f} ms"
+
+
+async def run(coalesce: bool) -> None:
+    global calls
+    calls = 0
+    random.seed(0)
+    delays = [random.uniform(0, SPREAD_SEC) for _ in range(CLICKS)]
+    flights = SingleFlight(linger=0) if coalesce else None
+    started = time.perf_counter()
+    results = await asyncio.gather(*(click(d, flights) for d in delays))
+    wall = (time.perf_counter() - started) * 1000
+    assert all(tokens == TOKENS for _, _, tokens in results), "受け取ったトークン数が足りないセッションがある"
+    label = "single-flight" if coalesce else "per-click"
+    print(f"{label:<14} upstream_calls={calls:3d}  {report('ttft', [r[0] for r in results])}  "
+          f"{report('total', [r[1] for r in results])}  wall={wall:.0f} ms")
+
+
+if __name__ == "__main__":
+    print(f"clicks={CLICKS} spread={SPREAD_SEC}s upstream: ttft={UPSTREAM_TTFT_SEC * 1000:.0f} ms, "
+          f"{TOKENS} tokens x {TOKEN_INTERVAL_SEC * 1000:.0f} ms, concurrency={UPSTREAM_CONCURRENCY}")
+    asyncio.run(run(coalesce=False))
+    asyncio.run(run(coalesce=True))
@@ -0,0 +1,109 @@
+# 下書きモード: 遅いモデル（最初のトークンまで数秒）だけの場合と、高速モデルの下書きを先に流す場合の
+# 体感の TTFT（最初に何か表示されるまで）・本来の TTFT・最終テキストの一致・下書きの打ち切りを確認する。
+# --live を付けると API キーのあるプロバイダで実際のモデル（DRAFT_TARGETS の先頭と下書きモデル）を使う。
+# 使い方: python bench/bench_speculative.py [遅いモデルの TTFT 秒] [--live]
+import asyncio
+import os
+import sys
+import time
+from contextlib import aclosing
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from speculative import draft_then_refine
+from stream_pipe import StreamPipe
+
+LIVE = "--live" in sys.argv
+ARGS = [a for a in sys.argv[1:] if not a.startswith("--")]
+SLOW_TTFT_SEC = float(ARGS[0]) if ARGS else 8.0
+LIVE_MODELS = [("openai", "gpt-5-pro-2025-10-06"), ("claude", "claude-opus-4-1-202508054"), ("grok", "grok-4-0709")]
+
+
+class FakeModel:
+    def __init__(self, name: str, ttft: float, tokens: int, interval: float, fail: bool = False):
+        self.name, self.ttft, self.tokens, self.interval, self.fail = name, ttft, tokens, interval, fail
+        self.sent = 0
+        self.closed = False
+
+    async def events(self):
+        try:
+            yield "status", f"{self.name}: 考え中..."
+            await asyncio.sleep(self.ttft)
+            if self.fail:
+                raise RuntimeError(f"{self.name} failed")
+            for i in range(self.tokens):
+                self.sent += 1
+                yield "token", f"{self.name}{i} "
+                await asyncio.sleep(self.interval)
+            yield "status", ""
+        finally:
+            self.closed = True
+
+
+async def consume(events) -> dict:
+    """on_message と同じ表示の手順（最初の本来のトークンで下書きを置き換える）で読み、時間と表示内容を返す。"""
+    started = time.perf_counter()
+    shown, perceived, actual, draft_chars = "", None, None, 0
+    refined = False
+    async with aclosing(events) as piped:
+        async for kind, text in piped:
+            now = (time.perf_counter() - started) * 1000
+            if kind in ("token", "draft") and perceived is None:
+                perceived = now
+            if kind == "draft":
+                shown += text
+                draft_chars += len(text)
+            elif kind == "token":
+                if actual is None:
+                    actual = now
+                if draft_chars and not refined:
+                    refined, shown = True, text
+                else:
+                    shown += text
+    return {"perceived": perceived, "actual": actual, "shown": shown, "draft_chars": draft_chars,
+            "total": (time.perf_counter() - started) * 1000}
+
+
+async def run_fake() -> None:
+    expected = "".join(f"slow{i} " for i in range(200))
+    slow = FakeModel("slow", SLOW_TTFT_SEC, 200, 0.005)
+    base = await consume(StreamPipe(slow.events()).stream())
+    print(f"slow only      perceived={base['perceived']:7.0f} ms  actual={base['actual']:7.0f} ms  total={base['total']:7.0f} ms")
+
+    for label, draft in (("with draft", FakeModel("fast", 0.3, 400, 0.01)), ("draft fails", FakeModel("fast", 0.3, 0, 0, fail=True))):
+        slow = FakeModel("slow", SLOW_TTFT_SEC, 200, 0.005)
+        r = await consume(draft_then_refine(StreamPipe(draft.events()).stream(), StreamPipe(slow.events()).stream()))
+        print(f"{label:<14} perceived={r['perceived'] or float('nan'):7.0f} ms  actual={r['actual']:7.0f} ms  total={r['total']:7.0f} ms"
+              f"  draft_chars={r['draft_chars']}  draft_tokens={draft.sent}/{draft.tokens}  draft_closed={draft.closed}"
+              f"  final_text_ok={r['shown'] == expected}")
+
+
+async def run_live() -> None:
+    from dotenv import load_dotenv
+    from langchain_core.messages import HumanMessage
+    from accounting import usage_ledger
+    from providers import ProviderClients, TurnRequest, TurnResult, stream_turn
+    from speculative import draft_request, pick_draft_model
+
+    load_dotenv()
+    clients = ProviderClients.from_env()
+    for provider, model in LIVE_MODELS:
+        if clients.for_provider(provider) is None:
+            print(f"{model:<28} skipped (API キーなし)")
+            continue
+        draft_model = pick_draft_model(clients, model)
+        request = TurnRequest(provider=provider, model=model, history=[HumanMessage(content="TCP と UDP の違いを説明して")])
+        result, draft_result = TurnResult(), TurnResult()
+        draft_req = draft_request(request, *draft_model, {})
+        r = await consume(draft_then_refine(
+            StreamPipe(stream_turn(clients, draft_req, draft_result)).stream(),
+            StreamPipe(stream_turn(clients, request, result)).stream(),
+        ))
+        rec = usage_ledger.record("bench", draft_req.provider, draft_req.model, "chat (draft)", draft_result.usage,
+                                  completion_text=draft_result.text)
+        main = usage_ledger.record("bench", provider, model, "chat", result.usage, completion_text=result.text)
+        print(f"{model:<28} draft={draft_req.model:<34} perceived={r['perceived']:7.0f} ms  actual={result.ttft_ms} ms"
+              f"  extra_cost=${rec.cost_usd or 0:.6f} (+{(rec.cost_usd or 0) / (main.cost_usd or 1):.1%})")
+
+
+if __name__ == "__main__":
+    asyncio.run(run_live() if LIVE else run_fake())
@@ -0,0 +1,65 @@
+# 速いプロバイダ × 遅いクライアント: 受信と送信が同じループの場合と StreamPipe で分けた場合の比較
+# 上流の読み終わり（接続を握っている時間）・送信回数・全体の時間・最終テキストの一致を確認する。
+# 使い方: python bench/bench_stream_pipe.py [トークン数] [1回の送信にかかる ms]
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from stream_pipe import StreamPipe
+
+TOKENS = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+EMIT_MS = float(sys.argv[2]) if len(sys.argv) > 2 else 20.0
+TOKEN_INTERVAL_SEC = 0.002  # 上流は 500 tokens/s
+
+
+class Upstream:
+    def __init__(self):
+        self.finished_at = None
+
+    async def events(self):
+        yield "status", "応答生成中..."
+        for i in range(TOKENS):
+            if i % 200 == 0:
+                yield "status", f"ツール実行中: {i}"
+            yield "token", f"t{i} "
+            await asyncio.sleep(TOKEN_INTERVAL_SEC)
+        yield "status", ""
+        self.finished_at = time.perf_counter()
+
+
+class SlowClient:
+    def __init__(self):
+        self.text = ""
+        self.emits = 0
+
+    async def send(self, text: str) -> None:
+        self.emits += 1
+        self.text += text
+        await asyncio.sleep(EMIT_MS / 1000)
+
+
+async def run(piped: bool) -> None:
+    upstream, client = Upstream(), SlowClient()
+    started = time.perf_counter()
+    if piped:
+        pipe = StreamPipe(upstream.events())
+        events = pipe.stream()
+    else:
+        events = upstream.events()
+    async for kind, text in events:
+        if kind == "token":
+            await client.send(text)
+    total = (time.perf_counter() - started) * 1000
+    upstream_ms = (upstream.finished_at - started) * 1000
+    expected = "".join(f"t{i} " for i in range(TOKENS))
+    assert client.text == expected, "最終テキストが一致しない"
+    label = "StreamPipe" if piped else "direct loop"
+    print(f"{label:<12} upstream read={upstream_ms:7.0f} ms  total={total:7.0f} ms  emits={client.emits:5d}")
+
+
+if __name__ == "__main__":
+    print(f"tokens={TOKENS} upstream={1 / TOKEN_INTERVAL_SEC:.0f} tokens/s client emit={EMIT_MS:.0f} ms")
+    asyncio.run(run(piped=False))
+    asyncio.run(run(piped=True))
@@ -0,0 +1,147 @@
+# 音声モード: 話し終わりから最初の音声を返すまで（mouth-to-ear）をローカルの疑似音声エンドポイントで測る（API キー不要）
+# 疑似サーバーは OpenAI の /audio/transcriptions（音声の長さに比例して遅れる）と /audio/speech（PCM を少しずつ返す）を真似る。
+# 比べるもの:
+#   whole    = マイクを止めるまで待ち、録音全体を文字起こしし、応答を最後まで待ってから全文をまとめて音声にする
+#   pipeline = voice.VoiceInput（無音で区間を切って順に文字起こし、無音が続いたらターンを送る）+ Speaker（文ごとに読み上げ）
+# 使い方: python bench/bench_voice.py [回数]
+import asyncio
+import json
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import numpy as np
+from openai import AsyncOpenAI
+
+import voice
+from voice import Speaker, VoiceInput, latency_report, transcribe
+
+RUNS = int(sys.argv[1]) if len(sys.argv) > 1 else 3
+RATE = voice.VOICE_SAMPLE_RATE
+CHUNK_MS = 100  # ブラウザから届く1チャンク
+STOP_CLICK_SEC = 1.2  # 話し終わってからマイクを止めるまで（whole の場合）
+STT_BASE_SEC, STT_PER_AUDIO_SEC = 0.15, 0.08
+TTS_FIRST_BYTE_SEC, TTS_SPEED, TTS_SEC_PER_CHAR = 0.12, 4.0, 0.12
+LLM_TTFT_SEC, LLM_TOKEN_SEC = 0.5, 0.04
+ANSWER = "音声モードのテストです。最初の文を読み上げている間に、続きの文を生成しています。" * 3
+
+
+def synth_speech() -> bytes:
+    """発話 1.2 秒 + 息継ぎ 0.5 秒 + 発話 1.0 秒 + 無音 2 秒（低い雑音）。"""
+    rng = np.random.default_rng(0)
+
+    def tone(sec):
+        t = np.arange(int(RATE * sec)) / RATE
+        return 0.3 * np.sin(2 * np.pi * 220 * t) * (1 + 0.3 * np.sin(2 * np.pi * 3 * t)) + rng.normal(0, 0.02, t.size)
+
+    def quiet(sec):
+        return rng.normal(0, 0.0005, int(RATE * sec))
+
+    audio = np.concatenate([quiet(0.3), tone(1.2), quiet(0.5), tone(1.0), quiet(2.0)])
+    return (np.clip(audio, -1, 1) * 32767).astype("<i2").tobytes()
+
+
+SPEECH_END_SEC = 0.3 + 1.2 + 0.5 + 1.0
+
+
+async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+    try:
+        head = await reader.readuntil(b"\r\n\r\n")
+        path = head.split(b" ", 2)[1].decode()
+        length = next((int(line.split(b":")[1]) for line in head.split(b"\r\n") if line.lower().startswith(b"content-length")), 0)
+        body = await reader.readexactly(length)
+        if path.endswith("/audio/transcriptions"):
+            audio_sec = len(body) / 2 / RATE
+            await asyncio.sleep(STT_BASE_SEC + STT_PER_AUDIO_SEC * audio_sec)
+            payload = json.dumps({"text": f"（{audio_sec:.1f}秒の発話）"}).encode()
+            writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: application/json\r\nContent-Length: %d\r\n\r\n" % len(payload) + payload)
+        else:
+            text = json.loads(body)["input"]
+            total = int(len(text) * TTS_SEC_PER_CHAR * RATE) * 2
+            writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: audio/pcm\r\nTransfer-Encoding: chunked\r\n\r\n")
+            await asyncio.sleep(TTS_FIRST_BYTE_SEC)
+            step = voice.VOICE_TTS_CHUNK_BYTES
+            for offset in range(0, total, step):
+                data = bytes(min(step, total - offset))
+                writer.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+                await writer.drain()
+                await asyncio.sleep(len(data) / 2 / RATE / TTS_SPEED)
+            writer.write(b"0\r\n\r\n")
+        await writer.drain()
+    except (ConnectionError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        writer.close()
+
+
+async def llm_tokens():
+    await asyncio.sleep(LLM_TTFT_SEC)
+    for i in range(0, len(ANSWER), 4):
+        yield ANSWER[i:i + 4]
+        await asyncio.sleep(LLM_TOKEN_SEC)
+
+
+async def play_mic(pcm: bytes, on_chunk) -> float:
+    """実時間でチャンクを送り、最後の有声サンプルを送った時刻を返す。"""
+    step = RATE * CHUNK_MS // 1000 * 2
+    started = time.perf_counter()
+    for i, offset in enumerate(range(0, len(pcm), step)):
+        await asyncio.sleep(max(0.0, started + i * CHUNK_MS / 1000 - time.perf_counter()))
+        on_chunk(pcm[offset:offset + step])
+    return started + SPEECH_END_SEC
+
+
+async def run_whole(client, pcm: bytes) -> float:
+    recorded = bytearray()
+    started = time.perf_counter()
+    await play_mic(pcm[: int((SPEECH_END_SEC + STOP_CLICK_SEC) * RATE) * 2], recorded.extend)
+    speech_end = started + SPEECH_END_SEC
+    await transcribe("openai", client, "mock-transcribe", bytes(recorded))
+    answer = "".join([t async for t in llm_tokens()])
+    resp = await client.audio.speech.create(model="mock-tts", voice="alloy", input=answer, response_format="pcm")
+    assert resp.content
+    return (time.perf_counter() - speech_end) * 1000
+
+
+async def run_pipeline(client, pcm: bytes) -> dict:
+    done = asyncio.Event()
+    reports = []
+
+    async def send(chunk: bytes) -> None:
+        pass  # 画面へ送る代わり（Chainlit の send_audio_chunk）
+
+    async def on_turn(utterance) -> None:
+        speaker = Speaker(client, send)
+        async for token in llm_tokens():
+            speaker.feed(token)
+        speaker.close()
+        await speaker.wait()
+        reports.append(latency_report(utterance, speaker.stats.first_text_at, speaker))
+        done.set()
+
+    voice_input = VoiceInput(("openai", client, "mock-transcribe"), on_turn)
+    await play_mic(pcm, voice_input.feed)
+    await asyncio.wait_for(done.wait(), 30)
+    await voice_input.finish()
+    return reports[0]
+
+
+async def main() -> None:
+    server = await asyncio.start_server(handle, "127.0.0.1", 0)
+    port = server.sockets[0].getsockname()[1]
+    client = AsyncOpenAI(api_key="bench", base_url=f"http://127.0.0.1:{port}/v1", max_retries=0)
+    pcm = synth_speech()
+    whole, pipeline = [], []
+    for _ in range(RUNS):
+        whole.append(await run_whole(client, pcm))
+        pipeline.append(await run_pipeline(client, pcm))
+    print(f"whole    mouth_to_ear p50={statistics.median(whole):6.0f} ms  (stop click {STOP_CLICK_SEC * 1000:.0f} ms included)")
+    print(f"pipeline mouth_to_ear p50={statistics.median(r['mouth_to_ear'] for r in pipeline):6.0f} ms")
+    print("pipeline breakdown (ms after speech end):", pipeline[-1])
+    server.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
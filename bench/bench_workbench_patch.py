@@ -0,0 +1,78 @@
+# CodeWorkbench: 全文送信と差分送信の1更新あたりの送信バイト数を比較する
+# あわせて、ユーザーが編集した後に届いた差分でエディタの内容が上書きされないこと（CodeWorkbench.jsx と同じ規則）を確かめる
+# 使い方: python bench/bench_workbench_patch.py [更新回数]
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from workbench import apply_patch, make_patch
+
+UPDATES = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+META = {"title": "Canvas", "filename": "index.html", "language": "html", "readOnly": False, "autoPreview": True}
+
+
+def page(n: int) -> str:
+    sections = "\n".join(f'    <section id="s{i}"><h2>セクション {i}</h2><p>{"本文 " * 40}</p></section>' for i in range(n))
+    return f"<!doctype html>\n<html lang=\"ja\">\n  <body>\n{sections}\n  </body>\n</html>"
+
+
+full_total = patch_total = 0
+client_text = ""
+prev = ""
+for step in range(1, UPDATES + 1):
+    code = page(step)
+    if step % 10 == 0:
+        # 途中の1セクションだけを書き換える更新も混ぜる
+        code = code.replace("セクション 3<", f"セクション 3 (rev {step})<")
+    full_total += len(json.dumps({**META, "code": code}, ensure_ascii=False).encode("utf-8"))
+    patch = make_patch(prev, code) if prev else {"op": "reset", "text": code}
+    patch_total += len(json.dumps({**META, "docId": "x", "seq": step, "patch": patch}, ensure_ascii=False).encode("utf-8"))
+    client_text = apply_patch(client_text, patch)
+    assert client_text == code
+    prev = code
+
+print(f"updates={UPDATES} final_size={len(prev.encode('utf-8'))} bytes")
+print(f"full:  total={full_total:,} bytes  avg/update={full_total // UPDATES:,}")
+print(f"patch: total={patch_total:,} bytes  avg/update={patch_total // UPDATES:,}  ({full_total / patch_total:.1f}x less)")
+
+
+class ClientDoc:
+    """CodeWorkbench.jsx の正本（DOC_STORE）とエディタの扱いを写したもの。"""
+
+    def __init__(self, text: str):
+        self.text = text  # サーバーの正本
+        self.editor = text  # エディタの内容（= codeRef）
+        self.dirty = False
+
+    def user_edit(self, new: str) -> None:
+        # onChange（applyingRef が false のとき）
+        self.editor = new
+        self.dirty = True
+
+    def receive(self, patch: dict) -> None:
+        self.text = apply_patch(self.text, patch)
+        if not self.dirty:
+            self.editor = apply_patch(self.editor, patch)
+
+    def load_latest(self) -> None:
+        self.editor, self.dirty = self.text, False
+
+
+# 同じ長さの編集（1文字の上書き）の後に差分が届いても、エディタ（= Run / プレビューの内容）はユーザーの編集のまま
+base = "print('hello')\nx = 1\n"
+client = ClientDoc(base)
+client.user_edit(base.replace("x = 1", "x = 2"))
+assert len(client.editor) == len(base)
+client.receive(make_patch(base, base + "print(x)\n"))
+assert client.editor == base.replace("x = 1", "x = 2"), client.editor
+assert client.text == base + "print(x)\n"
+# 長さの変わる編集でも同じ
+client.user_edit(client.editor + "# mine\n")
+client.receive(make_patch(client.text, client.text.replace("hello", "hi")))
+assert client.editor.endswith("# mine\n") and "hello" in client.editor
+# 「Load latest」で最新版に戻した後は、差分がそのまま反映される
+client.load_latest()
+client.receive(make_patch(client.text, client.text + "y = 3\n"))
+assert client.editor == client.text
+print("edited editor is kept while patches arrive: ok")
@@ -0,0 +1,369 @@
+"""Code コマンド用のローカル Python 実行プール（事前起動・事前 import 済みのワーカープロセス）。
+
+ワーカーは API キーなどを含まない最小限の環境変数で起動し、コードを受け取る前に OS レベルで隔離する:
+- ネットワーク名前空間（外部への通信ができない）とマウント名前空間（アプリのディレクトリと /proc を空の tmpfs で隠す）
+- root で起動している場合は EXEC_SANDBOX_USER（既定 nobody）に切り替え、no_new_privs を立てる
+- メモリ（RLIMIT_AS）・CPU 時間（RLIMIT_CPU）・子プロセスの生成（RLIMIT_NPROC）を制限する
+隔離できない環境では EXEC_REQUIRE_ISOLATION=0 にしない限りワーカーを起動しない。
+ワーカーは1回の実行ごとに捨てる（セッション間で使い回さない）。空きは事前に起動しておく。
+標準出力 / 標準エラーはパイプ経由で逐次親プロセスへ送る。
+"""
+import asyncio
+import multiprocessing as mp
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from dataclasses import dataclass
+from typing import AsyncIterator, Optional
+
+EXEC_POOL_SIZE = int(os.getenv("EXEC_POOL_SIZE", "2"))
+EXEC_TIMEOUT_SEC = float(os.getenv("EXEC_TIMEOUT_SEC", "10"))
+EXEC_CPU_SEC = int(os.getenv("EXEC_CPU_SEC", "10"))
+EXEC_MEMORY_MB = int(os.getenv("EXEC_MEMORY_MB", "512"))
+# ワーカーごとの一時ディレクトリ（tmpfs）の大きさ
+EXEC_TMP_MB = int(os.getenv("EXEC_TMP_MB", "64"))
+# ワーカー起動時に import しておくモジュール（カンマ区切り）
+EXEC_PREIMPORT = [m for m in os.getenv("EXEC_PREIMPORT", "math,json,re,random,statistics,datetime,collections,itertools").split(",") if m]
+# root で起動している場合に切り替えるユーザー
+EXEC_SANDBOX_USER = os.getenv("EXEC_SANDBOX_USER", "nobody")
+# 名前空間による隔離（と root からの切り替え）ができなければワーカーを起動しない
+EXEC_REQUIRE_ISOLATION = os.getenv("EXEC_REQUIRE_ISOLATION", "1") != "0"
+# ワーカーに渡す環境変数（これ以外は渡さない）
+EXEC_ENV_PASSTHROUGH = [k for k in os.getenv("EXEC_ENV_PASSTHROUGH", "PATH,LANG,LC_ALL,LC_CTYPE,TZ").split(",") if k]
+# ワーカーから見えなくするディレクトリ（既定はアプリのディレクトリ。.env やアップロードされたファイルを含む）
+_APP_DIR = os.path.dirname(os.path.abspath(__file__))
+EXEC_HIDE_PATHS = [p for p in os.getenv("EXEC_HIDE_PATHS", _APP_DIR).split(",") if p]
+# 出力をまとめて送る単位
+_FLUSH_BYTES = 4096
+
+# unshare(2) / mount(2) / prctl(2) の定数
+_CLONE_NEWNS = 0x00020000
+_CLONE_NEWUSER = 0x10000000
+_CLONE_NEWNET = 0x40000000
+_MS_NOSUID = 0x2
+_MS_NODEV = 0x4
+_MS_NOEXEC = 0x8
+_MS_REC = 0x4000
+_MS_PRIVATE = 0x40000
+_PR_SET_NO_NEW_PRIVS = 38
+
+
+# --- ワーカープロセス側 ---
+class _PipeWriter:
+    """sys.stdout / sys.stderr の代わりに、改行ごと（または一定量ごと）に親へ送る。"""
+
+    def __init__(self, conn, stream: str):
+        self.conn = conn
+        self.stream = stream
+        self._buf: list[str] = []
+        self._size = 0
+
+    def write(self, text: str) -> int:
+        if not text:
+            return 0
+        self._buf.append(text)
+        self._size += len(text)
+        if "\n" in text or self._size >= _FLUSH_BYTES:
+            self.flush()
+        return len(text)
+
+    def flush(self) -> None:
+        if self._buf:
+            self.conn.send((self.stream, "".join(self._buf)))
+            self._buf, self._size = [], 0
+
+    def isatty(self) -> bool:
+        return False
+
+
+def _mount_tmpfs(libc, path: str, options: str) -> bool:
+    flags = _MS_NOSUID | _MS_NODEV | _MS_NOEXEC
+    return os.path.isdir(path) and libc.mount(b"tmpfs", path.encode(), b"tmpfs", flags, options.encode()) == 0
+
+
+def _isolate(config: dict) -> dict:
+    """名前空間を分けてファイルを隠し、root なら権限を落とす。できたことを返す。"""
+    import ctypes
+    import pwd
+
+    libc = ctypes.CDLL(None, use_errno=True)
+    done: dict = {"root": os.geteuid() == 0}
+    workdir = config["workdir"]
+    # root でなければユーザー名前空間も作る（その中でだけネットワーク / マウント名前空間を作れる）
+    flags = _CLONE_NEWNET | _CLONE_NEWNS | (0 if done["root"] else _CLONE_NEWUSER)
+    if libc.unshare(flags) == 0:
+        done["network"] = True
+        # 以降のマウントを元の名前空間へ伝えない
+        if libc.mount(b"none", b"/", None, _MS_REC | _MS_PRIVATE, None) == 0:
+            done["hidden"] = [p for p in config["hide_paths"] if _mount_tmpfs(libc, p, "size=64k,mode=555")]
+            # 一時ディレクトリもワーカーごとの tmpfs にする（同じユーザーで動く他のワーカーから見えないように）
+            done["tmp"] = [p for p in ("/tmp", "/var/tmp", "/dev/shm") if _mount_tmpfs(libc, p, f"size={config['tmp_mb']}m,mode=1777")]
+            if "/tmp" in done["tmp"]:
+                workdir = "/tmp"
+                os.environ.update(HOME=workdir, TMPDIR=workdir)
+    os.chdir(workdir)
+    if done["root"] and config["user"]:
+        pw = pwd.getpwnam(config["user"])
+        os.setgroups([])
+        os.setgid(pw.pw_gid)
+        os.setuid(pw.pw_uid)
+        done["user"] = config["user"]
+    done["no_new_privs"] = libc.prctl(_PR_SET_NO_NEW_PRIVS, 1, 0, 0, 0) == 0
+    return done
+
+
+def _apply_limits(memory_mb: int) -> None:
+    import resource
+    mem = memory_mb * 1024 * 1024
+    resource.setrlimit(resource.RLIMIT_AS, (mem, mem))
+    # 子プロセスの生成を防ぐ
+    try:
+        resource.setrlimit(resource.RLIMIT_NPROC, (0, 0))
+    except (ValueError, OSError):
+        pass
+
+
+def _disable_network() -> None:
+    # 名前空間を作れなかった場合（EXEC_REQUIRE_ISOLATION=0）の最低限の抑止
+    import socket
+
+    def _blocked(*args, **kwargs):
+        raise PermissionError("network access is disabled in the sandbox")
+
+    socket.socket = _blocked  # type: ignore[assignment]
+    socket.create_connection = _blocked  # type: ignore[assignment]
+    socket.getaddrinfo = _blocked  # type: ignore[assignment]
+
+
+def _worker_main(conn) -> None:
+    import importlib
+    import resource
+    import traceback
+
+    # 設定は環境変数ではなくパイプで受け取る（ワーカーの環境変数は最小限にしてある）
+    config = conn.recv()
+    for name in config["preimport"]:
+        try:
+            importlib.import_module(name.strip())
+        except Exception:
+            pass
+    try:
+        isolation = _isolate(config)
+    except Exception as e:
+        conn.send(("failed", f"isolation: {e}"))
+        return
+    _apply_limits(config["memory_mb"])
+    _disable_network()
+    conn.send(("ready", isolation))
+
+    try:
+        code = conn.recv()
+    except EOFError:
+        return
+    if code is None:
+        return
+    # このジョブの CPU 時間上限（起動と事前 import に使った分 + 上限）。超えると SIGXCPU で終了する
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    soft = int(usage.ru_utime + usage.ru_stime) + config["cpu_sec"]
+    resource.setrlimit(resource.RLIMIT_CPU, (soft, soft + 1))
+
+    out, err = _PipeWriter(conn, "stdout"), _PipeWriter(conn, "stderr")
+    sys.stdout, sys.stderr = out, err
+    started = time.perf_counter()
+    ok, error = True, None
+    try:
+        exec(compile(code, "<workbench>", "exec"), {"__name__": "__main__"})
+    except BaseException:
+        ok = False
+        etype, value, tb = sys.exc_info()
+        # 先頭のフレーム（このワーカー自身）は表示しない
+        formatted = "".join(traceback.format_exception(etype, value, tb.tb_next))
+        err.write(formatted)
+        error = formatted.strip().splitlines()[-1]
+    finally:
+        out.flush()
+        err.flush()
+        sys.stdout, sys.stderr = sys.__stdout__, sys.__stderr__
+    conn.send(("exit", {"ok": ok, "error": error, "duration_ms": round((time.perf_counter() - started) * 1000, 1)}))
+
+
+# --- 親プロセス側 ---
+def _hide_paths() -> list[str]:
+    # Python 本体（venv を含む）がある場所を隠すと、実行中の import が失敗するので除く
+    prefixes = {os.path.realpath(sys.prefix), os.path.realpath(sys.base_prefix)}
+    paths = []
+    for path in [os.path.realpath(p) for p in EXEC_HIDE_PATHS] + ["/proc"]:
+        if any(prefix == path or prefix.startswith(path + os.sep) for prefix in prefixes):
+            print(f"[ExecPool] {path} contains the Python installation; not hidden from workers")
+            continue
+        paths.append(path)
+    return paths
+
+
+def _isolated_enough(info: dict) -> bool:
+    return bool(info.get("network") and info.get("hidden") and info.get("tmp") and (not info.get("root") or info.get("user")))
+
+
+@dataclass
+class _Worker:
+    process: subprocess.Popen
+    conn: object
+    workdir: str
+
+
+class ExecPool:
+    """事前に起動したワーカーで Python コードを1回ずつ実行するプール（実行後のワーカーは捨てて補充する）。"""
+
+    def __init__(self, size: int = EXEC_POOL_SIZE):
+        self.size = max(1, size)
+        self._idle: Optional[asyncio.Queue] = None
+        self._started = False
+        self._logged = False
+
+    def _config(self, workdir: str) -> dict:
+        return {
+            "preimport": EXEC_PREIMPORT,
+            "memory_mb": EXEC_MEMORY_MB,
+            "tmp_mb": EXEC_TMP_MB,
+            "cpu_sec": EXEC_CPU_SEC,
+            "user": EXEC_SANDBOX_USER,
+            "hide_paths": _hide_paths(),
+            "workdir": workdir,
+        }
+
+    async def _spawn(self) -> _Worker:
+        workdir = tempfile.mkdtemp(prefix="exec-")
+        if os.geteuid() == 0 and EXEC_SANDBOX_USER:
+            import pwd
+            pw = pwd.getpwnam(EXEC_SANDBOX_USER)
+            os.chown(workdir, pw.pw_uid, pw.pw_gid)
+        env = {k: os.environ[k] for k in EXEC_ENV_PASSTHROUGH if k in os.environ}
+        env.update(HOME=workdir, TMPDIR=workdir, PYTHONDONTWRITEBYTECODE="1")
+        parent, child = mp.Pipe()
+        # multiprocessing の spawn は親の環境変数をそのまま渡すので、環境を指定できる subprocess で起動する
+        process = subprocess.Popen(
+            [sys.executable, "-I", os.path.abspath(__file__), str(child.fileno())],
+            pass_fds=(child.fileno(),),
+            env=env,
+            cwd=workdir,
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        child.close()
+        worker = _Worker(process=process, conn=parent, workdir=workdir)
+        try:
+            parent.send(self._config(workdir))
+            kind, info = await self._recv(worker, timeout=30)
+        except (EOFError, OSError, asyncio.TimeoutError):
+            kind, info = None, None
+        if kind != "ready":
+            self._kill(worker)
+            raise RuntimeError(f"exec worker failed to start: {info or 'no response'}")
+        if not self._logged:
+            self._logged = True
+            print(f"[ExecPool] worker isolation: {info}")
+        if EXEC_REQUIRE_ISOLATION and not _isolated_enough(info):
+            self._kill(worker)
+            raise RuntimeError(f"exec worker is not isolated ({info}); set EXEC_REQUIRE_ISOLATION=0 to run anyway")
+        return worker
+
+    async def _fill(self) -> None:
+        try:
+            self._idle.put_nowait(await self._spawn())
+        except Exception as e:
+            print(f"[ExecPool] spawn failed: {e}")
+
+    async def start(self) -> None:
+        """ワーカーを起動しておく（アプリ起動時にバックグラウンドで呼ぶ）。"""
+        if self._started:
+            return
+        self._started = True
+        self._idle = asyncio.Queue()
+        await asyncio.gather(*(self._fill() for _ in range(self.size)))
+
+    async def _recv(self, worker: _Worker, timeout: Optional[float]):
+        """パイプにデータが来るまでイベントループ上で待つ（スレッドを使わない）。"""
+        loop = asyncio.get_running_loop()
+        conn = worker.conn
+        if not conn.poll():
+            ready = loop.create_future()
+            fd = conn.fileno()
+            loop.add_reader(fd, lambda: ready.done() or ready.set_result(None))
+            try:
+                await asyncio.wait_for(ready, timeout)
+            finally:
+                loop.remove_reader(fd)
+        return conn.recv()
+
+    def _kill(self, worker: _Worker) -> None:
+        try:
+            worker.process.kill()
+            worker.process.wait(timeout=1)
+        except Exception:
+            pass
+        try:
+            worker.conn.close()
+        except Exception:
+            pass
+        shutil.rmtree(worker.workdir, ignore_errors=True)
+
+    async def _take(self) -> _Worker:
+        while not self._idle.empty():
+            worker = self._idle.get_nowait()
+            if worker.process.poll() is None:
+                return worker
+            self._kill(worker)
+        # 空きが無い（補充中 / 起動に失敗した）ときはその場で起動する。失敗したら呼び出し元へ伝える
+        return await self._spawn()
+
+    async def run(self, code: str, timeout: float = EXEC_TIMEOUT_SEC) -> AsyncIterator[tuple[str, object]]:
+        """コードを実行し、("stdout" | "stderr", text) を逐次、最後に ("exit", info) を返す。"""
+        await self.start()
+        try:
+            worker = await self._take()
+        except RuntimeError as e:
+            yield "exit", {"ok": False, "error": str(e), "duration_ms": None}
+            return
+        deadline = time.monotonic() + timeout
+        try:
+            worker.conn.send(code)
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise asyncio.TimeoutError
+                try:
+                    kind, payload = await self._recv(worker, remaining)
+                except EOFError:
+                    yield "exit", {"ok": False, "error": "worker terminated (CPU / memory limit)", "duration_ms": None}
+                    return
+                yield kind, payload
+                if kind == "exit":
+                    return
+        except asyncio.TimeoutError:
+            yield "exit", {"ok": False, "error": f"timeout after {timeout:.0f}s", "duration_ms": round(timeout * 1000)}
+        finally:
+            # 実行したワーカーは次のジョブ（別のセッションかもしれない）に使わず、捨てて補充する
+            self._kill(worker)
+            if self._idle.qsize() < self.size:
+                asyncio.create_task(self._fill())
+
+    async def close(self) -> None:
+        if not self._idle:
+            return
+        while not self._idle.empty():
+            worker = self._idle.get_nowait()
+            try:
+                worker.conn.send(None)
+            except Exception:
+                pass
+            self._kill(worker)
+
+
+if __name__ == "__main__":
+    # ExecPool._spawn からワーカーとして起動された。引数はパイプのファイル記述子
+    from multiprocessing.connection import Connection
+    _worker_main(Connection(int(sys.argv[1])))
@@ -0,0 +1,131 @@
+"""Gemini 用の会話 contents 構築（role 付き・差分追記）と任意のコンテキストキャッシュ。"""
+import hashlib
+import os
+import time
+from typing import Optional
+
+from google.genai import types
+from langchain_core.messages import AIMessage, HumanMessage, SystemMessage
+
+# コンテキストキャッシュ（長く安定したプレフィックスのみ）。既定は無効
+GEMINI_CONTEXT_CACHE = os.getenv("GEMINI_CONTEXT_CACHE", "0") == "1"
+# キャッシュを作る最小プレフィックス長（文字数の概算。モデルごとの最小トークン数を下回らないように）
+GEMINI_CACHE_MIN_CHARS = int(os.getenv("GEMINI_CACHE_MIN_CHARS", "16000"))
+# キャッシュ外の新しいメッセージがこの件数を超えたらキャッシュを作り直す
+GEMINI_CACHE_REFRESH_MESSAGES = int(os.getenv("GEMINI_CACHE_REFRESH_MESSAGES", "20"))
+GEMINI_CACHE_TTL = os.getenv("GEMINI_CACHE_TTL", "900s")
+
+
+def to_gemini_content(message) -> Optional[types.Content]:
+    """LangChain のメッセージを Gemini の Content に変換する（System は system_instruction 側で渡す）。"""
+    if isinstance(message, SystemMessage):
+        return None
+    role = "model" if isinstance(message, AIMessage) else "user"
+    return types.Content(role=role, parts=[types.Part(text=message.content or "")])
+
+
+def flatten_prompt(system_prompt: str, messages: list) -> str:
+    """（比較用）従来の「System: ...」＋本文連結のプロンプト。"""
+    lines = [f"System: {system_prompt}"] if system_prompt else []
+    lines.extend(m.content for m in messages if not isinstance(m, SystemMessage))
+    return "\n".join(lines)
+
+
+def _message_key(message) -> tuple:
+    # content は履歴と同じ str を参照するので、同じメッセージなら比較は同一性の確認だけで済む
+    return type(message).__name__, message.content
+
+
+class GeminiConversation:
+    """会話履歴から変換済みの contents を保持し、新しいメッセージ分だけ追記する。
+
+    変換済みの各メッセージの (型, 本文) を覚えておき、履歴が書き換わった（エラー・停止でのロールバック後に
+    同じ位置へ別の発話が来たなど）ら最初に食い違った位置から作り直す。
+    """
+
+    def __init__(self):
+        self.contents: list[types.Content] = []
+        self._keys: list[tuple] = []  # 変換済みの履歴メッセージごとのキー
+        self._ends: list[int] = []  # そのメッセージまで変換したときの len(contents)
+        # 直近の sync で作り直した contents の位置（追記だけなら None）。コンテキストキャッシュの無効化に使う
+        self.rewritten_from: Optional[int] = None
+
+    def sync(self, history: list) -> list[types.Content]:
+        keep = 0
+        for key, m in zip(self._keys, history):
+            if key != _message_key(m):
+                break
+            keep += 1
+        self.rewritten_from = None
+        if keep < len(self._keys):
+            end = self._ends[keep - 1] if keep else 0
+            del self.contents[end:], self._keys[keep:], self._ends[keep:]
+            self.rewritten_from = end
+        for m in history[keep:]:
+            content = to_gemini_content(m)
+            if content is not None:
+                self.contents.append(content)
+            self._keys.append(_message_key(m))
+            self._ends.append(len(self.contents))
+        return self.contents
+
+
+def _prefix_chars(contents: list[types.Content]) -> int:
+    return sum(len(p.text or "") for c in contents for p in (c.parts or []))
+
+
+class GeminiContextCache:
+    """system_instruction ＋ 会話プレフィックスを Gemini のコンテキストキャッシュに載せる。
+
+    会話は追記のみなので、一度キャッシュしたプレフィックスはその後のターンでも使い回せる。
+    キャッシュ外のメッセージが増えたら作り直す。
+    """
+
+    def __init__(self):
+        self.name: Optional[str] = None
+        self.key: Optional[str] = None
+        self.cached_len = 0
+        self.expires_at = 0.0
+        self._stale: Optional[str] = None  # 会話が書き換わって使えなくなったキャッシュ（次に作るときに消す）
+
+    def truncate(self, length: int) -> None:
+        """contents の length 以降が書き換わった。キャッシュがその範囲を含むなら使わない。"""
+        if self.name and self.cached_len > length:
+            self._stale, self.name, self.cached_len = self._stale or self.name, None, 0
+
+    @staticmethod
+    def _key(model: str, system_prompt: str) -> str:
+        return hashlib.sha256(f"{model}\0{system_prompt}".encode("utf-8")).hexdigest()
+
+    async def prepare(self, client, model: str, system_prompt: str, contents: list[types.Content]) -> tuple[Optional[str], list[types.Content]]:
+        """(cached_content 名, キャッシュ以降に送る contents) を返す。キャッシュしない場合は (None, contents)。"""
+        key = self._key(model, system_prompt)
+        # 最後のユーザー発話はキャッシュに含めない
+        prefix = contents[:-1]
+        valid = self.name and self.key == key and time.time() < self.expires_at and self.cached_len <= len(prefix)
+        if valid and len(prefix) - self.cached_len < GEMINI_CACHE_REFRESH_MESSAGES:
+            return self.name, contents[self.cached_len:]
+        if _prefix_chars(prefix) + len(system_prompt or "") < GEMINI_CACHE_MIN_CHARS:
+            return (self.name, contents[self.cached_len:]) if valid else (None, contents)
+        try:
+            cache = await client.aio.caches.create(
+                model=model,
+                config=types.CreateCachedContentConfig(
+                    system_instruction=system_prompt,
+                    contents=prefix,
+                    ttl=GEMINI_CACHE_TTL,
+                ),
+            )
+        except Exception as e:
+            print(f"[Gemini] context cache create failed: {e}")
+            return (self.name, contents[self.cached_len:]) if valid else (None, contents)
+        old = [name for name in (self.name, self._stale) if name]
+        self.name, self.key, self.cached_len, self._stale = cache.name, key, len(prefix), None
+        self.expires_at = time.time() + float(GEMINI_CACHE_TTL.rstrip("s")) - 30
+        for name in old:
+            try:
+                await client.aio.caches.delete(name=name)
+            except Exception:
+                pass
+        print(f"[Gemini] context cache created: {cache.name} ({len(prefix)} messages)")
+        return self.name, contents[self.cached_len:]
@@ -0,0 +1,84 @@
+"""Grok（xAI）のチャットオブジェクトをセッションごとに保持し、ターンを差分で追記する。"""
+import os
+from typing import Optional
+
+from langchain_core.messages import AIMessage, HumanMessage, SystemMessage
+from xai_sdk.chat import assistant, image, system, user
+from xai_sdk.search import SearchParameters
+
+# 1 のとき会話をサーバー側に保存し、previous_response_id で続きから送る（送信量が最小になる）
+GROK_SERVER_STATE = os.getenv("GROK_SERVER_STATE", "0") == "1"
+
+
+def _to_xai(message):
+    if isinstance(message, AIMessage):
+        return assistant(message.content)
+    return user(message.content)
+
+
+class GrokChatHandle:
+    """長寿命の xAI チャットハンドル。
+
+    モデル・システムプロンプト・検索モードが同じで、履歴が前回から1件（今回のユーザー発話）だけ
+    増えている場合はそのまま追記する。それ以外（モデル切替・再接続後など）は履歴から作り直す。
+    """
+
+    def __init__(self):
+        self.chat = None
+        self.key: Optional[tuple] = None
+        self.synced = 0
+        self.response_id: Optional[str] = None
+
+    def prepare(
+        self, client, model: str, system_prompt: str, history: list, user_text: str, search_mode: str, images: tuple = ()
+    ) -> str:
+        """今回のターンを送れる状態にし、"append" / "server" / "rebuild" のいずれかを返す。
+
+        history は今回のユーザー発話を含む会話履歴、user_text は実際に送る本文（検索結果の差し込み後）。
+        images は今回の発話に添える画像の data URL。
+        """
+        turn = user(user_text, *(image(url) for url in images))
+        key = (model, system_prompt, search_mode)
+        history = [m for m in history if not isinstance(m, SystemMessage)]
+        reusable = self.chat is not None and self.key == key and self.synced == len(history) - 1
+        search = SearchParameters(mode=search_mode)
+
+        if reusable and GROK_SERVER_STATE and self.response_id:
+            # サーバー側の会話に今回の発話だけを送る
+            self.chat = client.chat.create(
+                model=model,
+                messages=[turn],
+                search_parameters=search,
+                previous_response_id=self.response_id,
+                store_messages=True,
+            )
+            return "server"
+        if reusable:
+            self.chat.append(turn)
+            return "append"
+
+        messages = [system(system_prompt)] if system_prompt else []
+        messages.extend(_to_xai(m) for m in history[:-1])
+        messages.append(turn)
+        self.chat = client.chat.create(
+            model=model,
+            messages=messages,
+            search_parameters=search,
+            store_messages=True if GROK_SERVER_STATE else None,
+        )
+        self.key = key
+        self.response_id = None
+        return "rebuild"
+
+    def request_bytes(self) -> int:
+        try:
+            return self.chat.proto.ByteSize()
+        except Exception:
+            return -1
+
+    def commit(self, response, history_len: int) -> None:
+        """応答をハンドルに追記し、同期済みの履歴件数を記録する。"""
+        if response is not None:
+            self.chat.append(response)
+            self.response_id = getattr(response, "id", None) or self.response_id
+        self.synced = history_len
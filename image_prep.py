@@ -0,0 +1,194 @@
+"""添付画像の前処理（プロセスプールで縮小・再エンコードし、内容ハッシュでキャッシュする）。
+
+アップロードされた画像をそのまま送ると、数十MBの原寸画像をアップロード・送信することになる。
+モデル側は決まった解像度に縮小してから処理するので、プロバイダごとの推奨サイズに合わせて先に縮小し、
+WebP（Grok は JPEG/PNG のみ対応のため JPEG）に再エンコードしてから添付する。
+- デコード・縮小・エンコードは CPU を使うので、イベントループではなく別プロセスで行う
+- 結果は (元画像の SHA-256, プロバイダ) ごとに IMAGE_CACHE_DIR に保存し、再起動後も使い回す
+- 縮小も形式変換も不要で、再エンコードしても小さくならない画像は元のファイルをそのまま使う
+"""
+import asyncio
+import hashlib
+import multiprocessing
+import os
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from dataclasses import dataclass
+from typing import Optional
+
+IMAGE_PREP_ENABLED = os.getenv("IMAGE_PREP_ENABLED", "1") != "0"
+IMAGE_POOL_SIZE = int(os.getenv("IMAGE_POOL_SIZE", "2"))
+IMAGE_CACHE_DIR = os.getenv("IMAGE_CACHE_DIR", os.path.join(".files", "image_cache"))
+IMAGE_QUALITY = int(os.getenv("IMAGE_QUALITY", "85"))
+# これを超える画素数の画像はデコードしない（展開すると数GBになる画像への対策）
+IMAGE_MAX_PIXELS = int(os.getenv("IMAGE_MAX_PIXELS", str(200_000_000)))
+# メモリ上に持つ変換結果の上限件数（ファイル自体は IMAGE_CACHE_DIR に残るので、溢れても再変換はしない）
+IMAGE_RESULT_CACHE_SIZE = int(os.getenv("IMAGE_RESULT_CACHE_SIZE", "1024"))
+
+
+@dataclass(frozen=True)
+class ImageTarget:
+    max_long: int  # 長辺の上限
+    max_short: Optional[int] = None  # 短辺の上限
+    max_pixels: Optional[int] = None  # 総画素数の上限
+    format: str = "WEBP"  # "WEBP" / "JPEG"
+    accepts: tuple = ("image/jpeg", "image/png", "image/webp", "image/gif")  # 変換せずに送れる形式
+
+
+# 各社のドキュメントの推奨サイズ（これより大きい画像はサーバー側で縮小されるだけ）
+IMAGE_TARGETS = {
+    # detail=high は 2048 四方に収めたあと短辺 768 に縮小して 512px タイルで処理する
+    "openai": ImageTarget(max_long=2048, max_short=768),
+    # 長辺 1568px・約 1.15MP を超えると縮小される
+    "claude": ImageTarget(max_long=1568, max_pixels=1_150_000),
+    # 768px タイル単位で処理される（2x2 タイルまで）
+    "gemini": ImageTarget(max_long=1536, accepts=("image/jpeg", "image/png", "image/webp", "image/heic", "image/heif")),
+    # 10MiB まで、JPEG / PNG のみ。リクエストに base64 で埋め込むので小さめにする
+    "grok": ImageTarget(max_long=1024, format="JPEG", accepts=("image/jpeg", "image/png")),
+}
+
+_EXT = {"WEBP": ("webp", "image/webp"), "JPEG": ("jpg", "image/jpeg")}
+
+
+@dataclass
+class PreparedImage:
+    path: str
+    mime: str
+    digest: str  # 元画像のハッシュとターゲットから決まる（同じ元画像なら毎回同じ）
+    original_bytes: int
+    bytes: int
+    original_size: tuple
+    size: tuple
+    elapsed_ms: float
+    cached: bool = False
+
+
+def _fit(width: int, height: int, target: ImageTarget) -> tuple[int, int]:
+    scale = min(1.0, target.max_long / max(width, height))
+    if target.max_short:
+        scale = min(scale, target.max_short / min(width, height))
+    if target.max_pixels:
+        scale = min(scale, (target.max_pixels / (width * height)) ** 0.5)
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+def _process(src: str, dst: str, mime: str, target: ImageTarget, quality: int, max_pixels: int) -> dict:
+    """（ワーカープロセスで実行）縮小・再エンコードして dst に書き、結果の情報を返す。"""
+    from PIL import Image, ImageOps
+
+    Image.MAX_IMAGE_PIXELS = max_pixels
+    with Image.open(src) as img:
+        original_size = img.size
+        size = _fit(*img.size, target)
+        if img.format == "JPEG" and size != img.size:
+            img.draft("RGB", size)  # JPEG は縮小しながらデコードできる（大きな写真で数倍速い）
+        img = ImageOps.exif_transpose(img)
+        # exif_transpose で縦横が入れ替わることがあるので、向きを直した後の大きさで計算し直す
+        size = _fit(*img.size, target)
+        resized = size != img.size
+        if resized:
+            img = img.resize(size, Image.Resampling.LANCZOS, reducing_gap=3.0)
+        if target.format == "JPEG" or img.mode not in ("RGB", "RGBA"):
+            if img.mode in ("RGBA", "LA", "P") and target.format == "JPEG":
+                rgba = img.convert("RGBA")
+                flat = Image.new("RGB", rgba.size, (255, 255, 255))
+                flat.paste(rgba, mask=rgba.getchannel("A"))
+                img = flat
+            else:
+                img = img.convert("RGBA" if img.mode in ("LA", "P", "PA") else "RGB")
+        tmp = f"{dst}.{os.getpid()}.tmp"
+        if target.format == "JPEG":
+            img.save(tmp, "JPEG", quality=quality, optimize=True, progressive=True)
+        else:
+            img.save(tmp, "WEBP", quality=quality, method=4)
+    original_bytes = os.path.getsize(src)
+    if not resized and mime in target.accepts and os.path.getsize(tmp) >= original_bytes:
+        os.remove(tmp)
+        return {"path": src, "mime": mime, "original_size": original_size, "size": original_size}
+    os.replace(tmp, dst)
+    return {"path": dst, "mime": _EXT[target.format][1], "original_size": original_size, "size": size}
+
+
+class ImagePreprocessor:
+    """プロセスプールと、(元画像のハッシュ, プロバイダ) → PreparedImage のキャッシュ。"""
+
+    def __init__(self, cache_dir: str = IMAGE_CACHE_DIR, pool_size: int = IMAGE_POOL_SIZE, quality: int = IMAGE_QUALITY):
+        self.cache_dir = cache_dir
+        self.pool_size = pool_size
+        self.quality = quality
+        self._pool: Optional[ProcessPoolExecutor] = None
+        self._results: "OrderedDict[tuple[str, str], PreparedImage]" = OrderedDict()
+        self._inflight: dict[tuple[str, str], asyncio.Future] = {}
+
+    def _executor(self) -> ProcessPoolExecutor:
+        if self._pool is None:
+            # イベントループのスレッドを抱えたプロセスを fork しないよう spawn で起動する
+            self._pool = ProcessPoolExecutor(self.pool_size, mp_context=multiprocessing.get_context("spawn"))
+        return self._pool
+
+    def _dst(self, digest: str, provider: str) -> str:
+        ext = _EXT[IMAGE_TARGETS[provider].format][0]
+        return os.path.join(self.cache_dir, f"{digest[:32]}_{provider}_q{self.quality}.{ext}")
+
+    async def prepare(self, path: str, mime: str, digest: str, provider: str) -> PreparedImage:
+        """path（SHA-256 が digest の画像）を provider 向けに変換する。同じ画像・プロバイダは1回だけ処理する。"""
+        key = (digest, provider)
+        cached = self._results.get(key)
+        if cached is not None and os.path.exists(cached.path):
+            self._results.move_to_end(key)
+            return PreparedImage(**{**cached.__dict__, "cached": True, "elapsed_ms": 0.0})
+        if key in self._inflight:
+            return await asyncio.shield(self._inflight[key])
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            result = await self._prepare(path, mime, digest, provider)
+            self._results[key] = result
+            if len(self._results) > IMAGE_RESULT_CACHE_SIZE:
+                self._results.popitem(last=False)
+            future.set_result(result)
+            return result
+        except BaseException as e:
+            future.set_exception(e)
+            future.exception()  # 待っている人がいなくても警告を出さない
+            raise
+        finally:
+            del self._inflight[key]
+
+    async def _prepare(self, path: str, mime: str, digest: str, provider: str) -> PreparedImage:
+        target = IMAGE_TARGETS[provider]
+        dst = self._dst(digest, provider)
+        original_bytes = os.path.getsize(path)
+        started = time.perf_counter()
+        prepared_digest = hashlib.sha256(f"{digest}:{provider}:{self.quality}".encode()).hexdigest()
+        if os.path.exists(dst):  # 前回の起動時に変換済み
+            return PreparedImage(
+                path=dst, mime=_EXT[target.format][1], digest=prepared_digest, original_bytes=original_bytes,
+                bytes=os.path.getsize(dst), original_size=(0, 0), size=(0, 0), elapsed_ms=0.0, cached=True,
+            )
+        os.makedirs(self.cache_dir, exist_ok=True)
+        try:
+            info = await asyncio.wrap_future(
+                self._executor().submit(_process, path, dst, mime, target, self.quality, IMAGE_MAX_PIXELS)
+            )
+        except BrokenProcessPool:
+            # ワーカーが落ちた（メモリ不足など）プールは使えないので、次の画像では作り直す
+            self._pool = None
+            raise
+        if info["path"] == path:
+            prepared_digest = digest  # 元のファイルをそのまま使う
+        return PreparedImage(
+            path=info["path"], mime=info["mime"], digest=prepared_digest, original_bytes=original_bytes,
+            bytes=os.path.getsize(info["path"]), original_size=tuple(info["original_size"]), size=tuple(info["size"]),
+            elapsed_ms=round((time.perf_counter() - started) * 1000, 1),
+        )
+
+    def close(self) -> None:
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+
+image_preprocessor = ImagePreprocessor()
@@ -0,0 +1,276 @@
+"""MCP クライアントのプロセス共通マネージャー（接続プール + tools/list キャッシュ + 並列ツール実行）。
+
+応答の生成では、設定済みサーバーのツールを OpenAI の function ツールとして渡し（function_tools）、
+モデルが要求した呼び出しをこのマネージャーの接続で並列に実行して結果を返す（call_functions）。
+"""
+import asyncio
+import itertools
+import json
+import os
+import re
+import time
+from dataclasses import dataclass, field
+from typing import Any, Optional
+
+from mcp import ClientSession, StdioServerParameters, types
+from mcp.client.sse import sse_client
+from mcp.client.stdio import stdio_client
+from mcp.client.streamable_http import streamablehttp_client
+
+# tools/list のキャッシュ有効期間（秒）。list_changed 通知が来たら期限前でも破棄する
+MCP_TOOLS_TTL_SEC = float(os.getenv("MCP_TOOLS_TTL_SEC", "600"))
+# サーバーごとに保持するセッション数
+MCP_POOL_SIZE = int(os.getenv("MCP_POOL_SIZE", "1"))
+MCP_CONNECT_TIMEOUT_SEC = float(os.getenv("MCP_CONNECT_TIMEOUT_SEC", "15"))
+# モデルに返すツール結果の最大文字数
+MCP_TOOL_OUTPUT_MAX_CHARS = int(os.getenv("MCP_TOOL_OUTPUT_MAX_CHARS", "20000"))
+
+_FUNCTION_NAME_RE = re.compile(r"[^a-zA-Z0-9_-]")
+
+
+@dataclass
+class MCPServerConfig:
+    """接続先 MCP サーバーの設定。transport は "streamable-http" / "sse" / "stdio"。"""
+    name: str
+    transport: str
+    url: Optional[str] = None
+    command: Optional[str] = None
+    args: list = field(default_factory=list)
+    env: Optional[dict] = None
+    headers: Optional[dict] = None
+
+
+def load_server_configs(default_servers: Optional[list[dict]] = None) -> list[MCPServerConfig]:
+    """MCP_SERVERS（JSONファイルのパス）からサーバー設定を読み込む。未指定なら default_servers を使う。"""
+    path = os.getenv("MCP_SERVERS")
+    raw = default_servers or []
+    if path:
+        with open(path, "r", encoding="utf-8") as f:
+            raw = json.load(f)
+    return [MCPServerConfig(**item) for item in raw]
+
+
+class _PooledSession:
+    """1本の MCP セッション。
+
+    MCP クライアントのコンテキスト（anyio のキャンセルスコープ）は開始したタスクで閉じる必要があるため、
+    接続ごとに専用のタスクを持ち、close 要求が来るまでセッションを開いたまま保持する。
+    """
+
+    def __init__(self, config: MCPServerConfig, on_tools_changed):
+        self.config = config
+        self.session: Optional[ClientSession] = None
+        self._on_tools_changed = on_tools_changed
+        self._ready = asyncio.Event()
+        self._closing = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._error: Optional[BaseException] = None
+
+    def _transport(self):
+        cfg = self.config
+        if cfg.transport == "stdio":
+            # stdio サーバーは長寿命のサブプロセスとして維持する
+            return stdio_client(StdioServerParameters(command=cfg.command, args=cfg.args, env=cfg.env))
+        if cfg.transport == "sse":
+            return sse_client(cfg.url, headers=cfg.headers)
+        return streamablehttp_client(cfg.url, headers=cfg.headers)
+
+    async def _message_handler(self, message) -> None:
+        if isinstance(message, types.ServerNotification) and isinstance(message.root, types.ToolListChangedNotification):
+            self._on_tools_changed(self.config.name)
+
+    async def _run(self) -> None:
+        try:
+            async with self._transport() as streams:
+                read, write = streams[0], streams[1]
+                async with ClientSession(read, write, message_handler=self._message_handler) as session:
+                    await session.initialize()
+                    self.session = session
+                    self._ready.set()
+                    await self._closing.wait()
+        except Exception as e:  # キャンセル（終了処理）はそのまま伝える
+            self._error = e
+        finally:
+            self.session = None
+            self._ready.set()
+
+    async def start(self) -> None:
+        self._task = asyncio.create_task(self._run(), name=f"mcp:{self.config.name}")
+        try:
+            await asyncio.wait_for(self._ready.wait(), timeout=MCP_CONNECT_TIMEOUT_SEC)
+        except BaseException:
+            # 接続待ちのタイムアウト・キャンセルでは、接続中のタスク（stdio ならサブプロセス）を残さない
+            self._task.cancel()
+            raise
+        if self.session is None:
+            raise ConnectionError(f"MCP server '{self.config.name}' に接続できませんでした: {self._error}")
+
+    @property
+    def alive(self) -> bool:
+        return self.session is not None and self._task is not None and not self._task.done()
+
+    async def close(self) -> None:
+        self._closing.set()
+        if self._task:
+            try:
+                await asyncio.wait_for(self._task, timeout=5)
+            except asyncio.CancelledError:
+                if not self._task.cancelled():
+                    raise  # close() 自体がキャンセルされた
+            except Exception:
+                self._task.cancel()
+
+
+class MCPClientManager:
+    """設定済み MCP サーバーへのウォームな接続を保持するプロセス共通マネージャー。"""
+
+    def __init__(self, configs: Optional[list[MCPServerConfig]] = None, pool_size: int = MCP_POOL_SIZE):
+        self.configs: dict[str, MCPServerConfig] = {c.name: c for c in (configs or [])}
+        self.pool_size = max(1, pool_size)
+        self._pools: dict[str, list[_PooledSession]] = {}
+        self._rr: dict[str, itertools.count] = {}
+        self._locks: dict[str, asyncio.Lock] = {}
+        self._tools_cache: dict[str, tuple[list, float]] = {}
+        self._functions: dict[str, tuple[str, str]] = {}  # function ツール名 -> (サーバー名, ツール名)
+
+    def add_server(self, config: MCPServerConfig) -> None:
+        self.configs[config.name] = config
+
+    # --- 接続プール ---
+    async def _get_session(self, name: str) -> ClientSession:
+        pool = self._pools.get(name)
+        if not pool or not all(p.alive for p in pool):
+            lock = self._locks.setdefault(name, asyncio.Lock())
+            async with lock:
+                pool = [p for p in self._pools.get(name, []) if p.alive]
+                while len(pool) < self.pool_size:
+                    conn = _PooledSession(self.configs[name], self.invalidate)
+                    await conn.start()
+                    pool.append(conn)
+                self._pools[name] = pool
+                self._rr.setdefault(name, itertools.count())
+        idx = next(self._rr[name]) % len(pool)
+        return pool[idx].session
+
+    async def warm_up(self) -> None:
+        """全サーバーへ接続し、ツール一覧をキャッシュしておく。"""
+        results = await asyncio.gather(*(self.list_tools(name) for name in self.configs), return_exceptions=True)
+        for name, result in zip(self.configs, results):
+            if isinstance(result, Exception):
+                print(f"[MCP] warm-up failed: {name}: {result}")
+            else:
+                print(f"[MCP] warm: {name} ({len(result)} tools)")
+
+    async def _drop(self, name: str) -> None:
+        for conn in self._pools.pop(name, []):
+            await conn.close()
+
+    # --- tools/list キャッシュ ---
+    def invalidate(self, name: Optional[str] = None) -> None:
+        """ツール一覧のキャッシュを破棄する（name 省略時は全サーバー）。"""
+        if name is None:
+            self._tools_cache.clear()
+        else:
+            self._tools_cache.pop(name, None)
+
+    def cache_tools(self, name: str, tools: list) -> None:
+        self._tools_cache[name] = (tools, time.monotonic())
+
+    def cached_tools(self, name: str) -> Optional[list]:
+        entry = self._tools_cache.get(name)
+        if entry and time.monotonic() - entry[1] < MCP_TOOLS_TTL_SEC:
+            return entry[0]
+        return None
+
+    async def list_tools(self, name: str) -> list:
+        cached = self.cached_tools(name)
+        if cached is not None:
+            return cached
+        session = await self._get_session(name)
+        result = await session.list_tools()
+        self.cache_tools(name, result.tools)
+        return result.tools
+
+    # --- ツール実行 ---
+    async def call_tool(self, name: str, tool: str, arguments: Optional[dict] = None) -> Any:
+        try:
+            session = await self._get_session(name)
+            return await session.call_tool(tool, arguments or {})
+        except (ConnectionError, OSError, asyncio.TimeoutError):
+            # 接続が切れていたら作り直して1回だけ再試行
+            await self._drop(name)
+            session = await self._get_session(name)
+            return await session.call_tool(tool, arguments or {})
+
+    async def call_tools(self, calls: list[tuple[str, str, Optional[dict]]]) -> list:
+        """モデルが同時に要求した複数のツール呼び出しを並列に実行する。失敗は例外オブジェクトとして返す。"""
+        return await asyncio.gather(
+            *(self.call_tool(server, tool, args) for server, tool, args in calls),
+            return_exceptions=True,
+        )
+
+    # --- モデルの function calling との接続 ---
+    @staticmethod
+    def function_name(server: str, tool: str) -> str:
+        # OpenAI の関数名は英数字・_・- で64文字まで
+        return _FUNCTION_NAME_RE.sub("_", f"{server}__{tool}")[:64]
+
+    async def function_tools(self) -> list[dict]:
+        """設定済みサーバーのツール一覧（キャッシュ）を Responses API の function ツールとして返す。取得できないサーバーは除く。"""
+        names = list(self.configs)
+        results = await asyncio.gather(*(self.list_tools(name) for name in names), return_exceptions=True)
+        specs = []
+        for server, tools in zip(names, results):
+            if isinstance(tools, Exception):
+                print(f"[MCP] list_tools failed: {server}: {tools}")
+                continue
+            for tool in tools:
+                fname = self.function_name(server, tool.name)
+                self._functions[fname] = (server, tool.name)
+                specs.append({
+                    "type": "function",
+                    "name": fname,
+                    "description": f"[{server}] {tool.description or tool.name}",
+                    "parameters": tool.inputSchema or {"type": "object", "properties": {}},
+                    "strict": False,
+                })
+        return specs
+
+    async def call_functions(self, calls: list[tuple[str, str]]) -> list[str]:
+        """モデルが要求した (関数名, JSON 引数) を並列に実行し、モデルに返す文字列を順に返す。"""
+        targets, outputs = [], [""] * len(calls)
+        for i, (fname, arguments) in enumerate(calls):
+            target = self._functions.get(fname)
+            try:
+                args = json.loads(arguments or "{}")
+            except json.JSONDecodeError as e:
+                outputs[i] = f"error: invalid arguments: {e}"
+                continue
+            if target is None:
+                outputs[i] = f"error: unknown tool {fname}"
+                continue
+            targets.append((i, (*target, args)))
+        results = await self.call_tools([call for _, call in targets])
+        for (i, _), result in zip(targets, results):
+            outputs[i] = _result_text(result)
+        return outputs
+
+    async def close(self) -> None:
+        for name in list(self._pools):
+            await self._drop(name)
+
+
+def _result_text(result: Any) -> str:
+    """tools/call の結果（または例外）をモデルに返す文字列にする。"""
+    if isinstance(result, BaseException):
+        return f"error: {result}"
+    parts = []
+    for part in getattr(result, "content", None) or []:
+        text = getattr(part, "text", None)
+        parts.append(text if text is not None else f"[{getattr(part, 'type', 'content')}]")
+    text = "\n".join(parts)
+    if not text and getattr(result, "structuredContent", None) is not None:
+        text = json.dumps(result.structuredContent, ensure_ascii=False)
+    if getattr(result, "isError", False):
+        text = f"error: {text}"
+    return text[:MCP_TOOL_OUTPUT_MAX_CHARS]
@@ -0,0 +1,255 @@
+"""ターン単位のプロファイリング（オペレーター向け・既定は無効）。
+
+@profiled("on_message") のように付けたハンドラーを、サンプリング（PROFILE_SAMPLE_RATE）または
+セッションのフラグ（/profile on、PROFILE_COMMAND=1 のときだけ使える）で選ばれたときだけ計測する。
+- sampler: イベントループのスレッドのスタックを一定間隔で記録する（壁時計時間。select で待っている = 上流やI/O待ち）
+- cprofile: cProfile による関数ごとの集計（ループ上で同時に動いている他のセッションの処理も含む）
+- tracemalloc: 開始時と終了時のスナップショットの差分（PROFILE_TRACEMALLOC=1。確保の多い処理は数倍〜数十倍遅くなるので別に有効にする）
+計測中のハンドラーの中で呼ばれた @profiled の関数は、区間（名前と所要時間）としてサマリーに記録する。
+結果は PROFILE_DIR に <時刻>_<種類>_<プロバイダ>_<モデル>_<ターンID>.* として書き出す。
+無効時のコストは ContextVar の参照と乱数1回だけ。
+"""
+import asyncio
+import cProfile
+import functools
+import inspect
+import io
+import os
+import pstats
+import random
+import re
+import sys
+import threading
+import time
+import tracemalloc
+import uuid
+from collections import Counter
+from contextvars import ContextVar
+from typing import Optional
+
+import chainlit as cl
+
+# 全ターンのうち計測する割合（0 で無効）
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+# /profile on|off でセッション単位の計測を許可する
+PROFILE_COMMAND = os.getenv("PROFILE_COMMAND", "0") == "1"
+PROFILE_DIR = os.getenv("PROFILE_DIR", os.path.join(".files", "profiles"))
+# "sampler"（既定）または "cprofile"
+PROFILE_MODE = os.getenv("PROFILE_MODE", "sampler")
+PROFILE_SAMPLE_INTERVAL_MS = float(os.getenv("PROFILE_SAMPLE_INTERVAL_MS", "5"))
+PROFILE_TRACEMALLOC = os.getenv("PROFILE_TRACEMALLOC", "0") == "1"
+PROFILE_TRACEMALLOC_FRAMES = int(os.getenv("PROFILE_TRACEMALLOC_FRAMES", "1"))
+PROFILE_TOP = int(os.getenv("PROFILE_TOP", "40"))
+
+_current: ContextVar[Optional["TurnProfile"]] = ContextVar("turn_profile", default=None)
+_active_lock = threading.Lock()  # cProfile / サンプラーはプロセスで同時に1つだけ
+
+
+def session_enabled() -> bool:
+    try:
+        return PROFILE_COMMAND and bool(cl.user_session.get("profile"))
+    except Exception:  # Chainlit のコンテキスト外（ベンチ・バッチ実行）
+        return False
+
+
+def _should_profile() -> bool:
+    return (PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE) or session_enabled()
+
+
+class _StackSampler(threading.Thread):
+    """指定スレッドのスタックを interval ごとに記録し、折りたたみ形式（flamegraph 用）で集計する。"""
+
+    def __init__(self, thread_id: int, interval: float):
+        super().__init__(name="profile-sampler", daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks: Counter = Counter()
+        self._halt = threading.Event()
+
+    def run(self) -> None:
+        # 既定の切り替え間隔（5ms）のままだと、ループが select で GIL を手放した瞬間ばかり記録されて待ち時間が多く見える
+        switch = sys.getswitchinterval()
+        sys.setswitchinterval(min(switch, self.interval / 10))
+        try:
+            self._sample()
+        finally:
+            sys.setswitchinterval(switch)
+
+    def _sample(self) -> None:
+        while not self._halt.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None and len(stack) < 64:
+                code = frame.f_code
+                stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                frame = frame.f_back
+            if stack:
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def stop(self) -> None:
+        self._halt.set()
+        self.join()
+
+
+class TurnProfile:
+    def __init__(self, kind: str, meta: dict):
+        self.kind = kind
+        self.meta = meta
+        self.spans: list[tuple[str, float]] = []
+        self.started = time.perf_counter()
+        self.elapsed_ms = 0.0
+        self._profiler: Optional[cProfile.Profile] = None
+        self._sampler: Optional[_StackSampler] = None
+        self._snapshot: Optional[tracemalloc.Snapshot] = None
+        self._own_tracemalloc = False
+
+    def start(self) -> None:
+        if PROFILE_TRACEMALLOC:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start(PROFILE_TRACEMALLOC_FRAMES)
+                self._own_tracemalloc = True
+            self._snapshot = tracemalloc.take_snapshot()
+        if PROFILE_MODE == "cprofile":
+            self._profiler = cProfile.Profile()
+            self._profiler.enable()
+        else:
+            self._sampler = _StackSampler(threading.get_ident(), PROFILE_SAMPLE_INTERVAL_MS / 1000)
+            self._sampler.start()
+        self.started = time.perf_counter()
+
+    def stop(self) -> dict:
+        """計測を止め、書き出す内容（ファイル名の拡張子 → 中身）を返す。"""
+        self.elapsed_ms = (time.perf_counter() - self.started) * 1000
+        outputs = {}
+        if self._profiler is not None:
+            self._profiler.disable()
+            buf = io.StringIO()
+            stats = pstats.Stats(self._profiler, stream=buf)
+            stats.sort_stats("cumulative").print_stats(PROFILE_TOP)
+            outputs["cprofile.txt"] = buf.getvalue()
+            outputs["prof"] = self._profiler  # pstats 形式（snakeviz などで開ける）
+        if self._sampler is not None:
+            self._sampler.stop()
+            outputs["folded"] = "".join(f"{stack} {n}\n" for stack, n in self._sampler.stacks.most_common())
+        if self._snapshot is not None:
+            diff = tracemalloc.take_snapshot().compare_to(self._snapshot, "lineno")
+            if self._own_tracemalloc:
+                tracemalloc.stop()
+            outputs["memory.txt"] = "".join(f"{d}\n" for d in diff[:PROFILE_TOP])
+        outputs["summary.txt"] = self._summary()
+        return outputs
+
+    def _summary(self) -> str:
+        lines = [f"{k}: {v}" for k, v in {"kind": self.kind, **self.meta, "elapsed_ms": round(self.elapsed_ms, 1)}.items()]
+        if self.spans:
+            totals: dict[str, list] = {}
+            for name, ms in self.spans:
+                entry = totals.setdefault(name, [0, 0.0, 0.0])
+                entry[0] += 1
+                entry[1] += ms
+                entry[2] = max(entry[2], ms)
+            lines.append("\n# spans: name, calls, total ms, max ms")
+            lines.extend(
+                f"{name}\t{n}\t{total:.1f}\t{peak:.1f}"
+                for name, (n, total, peak) in sorted(totals.items(), key=lambda kv: -kv[1][1])
+            )
+        if self._sampler is not None and self._sampler.stacks:
+            total = sum(self._sampler.stacks.values())
+            # ループがセレクターで待っている時間 = 上流の応答や I/O を待っている時間
+            idle = sum(n for stack, n in self._sampler.stacks.items() if stack.endswith("selectors.py:select"))
+            leaf = Counter()
+            for stack, n in self._sampler.stacks.items():
+                leaf[stack.rsplit(";", 1)[-1]] += n
+            lines.append(f"\n# sampler: {total} samples every {PROFILE_SAMPLE_INTERVAL_MS} ms, waiting on I/O {idle / total:.0%}")
+            lines.extend(f"{n / total:6.1%}  {frame}" for frame, n in leaf.most_common(PROFILE_TOP))
+        return "\n".join(lines) + "\n"
+
+
+def _write(base: str, outputs: dict) -> None:
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    for ext, content in outputs.items():
+        path = os.path.join(PROFILE_DIR, f"{base}.{ext}")
+        if isinstance(content, cProfile.Profile):
+            content.dump_stats(path)
+        else:
+            with open(path, "w", encoding="utf-8") as f:
+                f.write(content)
+
+
+def _safe(value) -> str:
+    return re.sub(r"[^A-Za-z0-9_.-]+", "-", str(value or "none"))[:60]
+
+
+def _turn_meta(args) -> tuple[str, dict]:
+    """ハンドラーの引数とセッションから、種類の接尾辞とプロバイダ・モデル・ターンIDを取り出す。"""
+    message = args[0] if args else None
+    suffix = f":{message.command}" if getattr(message, "command", None) else ""
+    try:
+        model = cl.user_session.get("model") or {}
+    except Exception:
+        model = {}
+    turn_id = getattr(message, "id", None) or uuid.uuid4().hex[:12]
+    return suffix, {"provider": model.get("type"), "model": model.get("value"), "turn_id": turn_id}
+
+
+async def _finish(profile: TurnProfile) -> None:
+    outputs = profile.stop()
+    meta = profile.meta
+    base = "_".join(_safe(v) for v in (
+        time.strftime("%Y%m%d-%H%M%S"), profile.kind, meta["provider"], meta["model"], meta["turn_id"],
+    ))
+    try:
+        await asyncio.to_thread(_write, base, outputs)
+        print(f"[Profile] {profile.kind} {profile.elapsed_ms:.0f}ms -> {os.path.join(PROFILE_DIR, base)}.*")
+    except Exception as e:
+        print(f"[Profile] write failed: {e}")
+
+
+def profiled(kind: str):
+    """ハンドラー（async）やヘルパー（sync / async）に付けるデコレーター。
+
+    計測中のターンの中で呼ばれた場合は区間として記録し、そうでなければ最外のハンドラーでだけ計測を始める。
+    """
+
+    def decorate(fn):
+        if inspect.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def async_wrapper(*args, **kwargs):
+                parent = _current.get()
+                if parent is not None:
+                    started = time.perf_counter()
+                    try:
+                        return await fn(*args, **kwargs)
+                    finally:
+                        parent.spans.append((kind, (time.perf_counter() - started) * 1000))
+                if not _should_profile() or not _active_lock.acquire(blocking=False):
+                    return await fn(*args, **kwargs)
+                suffix, meta = _turn_meta(args)
+                profile = TurnProfile(kind + suffix, meta)
+                token = _current.set(profile)
+                profile.start()
+                try:
+                    return await fn(*args, **kwargs)
+                finally:
+                    _current.reset(token)
+                    try:
+                        await _finish(profile)
+                    finally:
+                        _active_lock.release()
+
+            return async_wrapper
+
+        @functools.wraps(fn)
+        def sync_wrapper(*args, **kwargs):
+            parent = _current.get()
+            if parent is None:
+                return fn(*args, **kwargs)
+            started = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                parent.spans.append((kind, (time.perf_counter() - started) * 1000))
+
+        return sync_wrapper
+
+    return decorate
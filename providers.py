@@ -0,0 +1,438 @@
+"""プロバイダごとの応答ストリーミング（チャット画面の on_message とバッチ実行で共通）。
+
+stream_turn() は ("token", text) / ("status", text) を逐次返す非同期ジェネレーター。
+最終的なテキスト・トークン使用量・所要時間は TurnResult に記録される。
+途中で抜けた場合（停止ボタン・切断によるキャンセル）は上流のストリームをその場で閉じ、TurnResult.cancelled を立てる。
+会話をまたいで持つ状態（previous_response_id、Gemini の変換済み履歴、Grok のチャットなど）は TurnRequest.state に置く。
+"""
+import asyncio
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+from typing import AsyncIterator, Iterable, Optional
+
+from google.genai.types import Content, GenerateContentConfig, GoogleSearch, Part, Tool, UrlContext
+from langchain_core.messages import HumanMessage
+
+from gemini_contents import GEMINI_CONTEXT_CACHE, GeminiContextCache, GeminiConversation
+from grok_chat import GrokChatHandle
+from tool_router import CODE, URL_CONTEXT, WEB_SEARCH
+from uploads import claude_file_blocks, gemini_file_parts, grok_image_urls, openai_file_parts
+
+# Claude の Files API（beta）
+CLAUDE_FILES_BETA = "files-api-2025-04-14"
+CLAUDE_MAX_TOKENS = 4096
+# MCP ツールの呼び出しを返して応答を続けさせる最大回数（最後の回はツールなしで答えさせる）
+MCP_MAX_ROUNDS = int(os.getenv("MCP_MAX_ROUNDS", "5"))
+
+# プロバイダごとの API キー未設定時のメッセージ
+MISSING_KEY_MESSAGES = {
+    "openai": "エラー: OPENAI_API_KEYが設定されていません。",
+    "gemini": "エラー: GOOGLE_API_KEYが設定されていません。",
+    "claude": "エラー: ANTHROPIC_API_KEYが設定されていません。",
+    "grok": "エラー: XAI_API_KEYが設定されていません。",
+}
+
+
+@dataclass
+class ProviderClients:
+    """各プロバイダのクライアント（キーが無いものは None）。"""
+    openai: object = None
+    anthropic: object = None
+    gemini: object = None
+    xai: object = None
+
+    @classmethod
+    def from_env(cls) -> "ProviderClients":
+        from anthropic import AsyncAnthropic
+        from google import genai
+        from openai import AsyncOpenAI
+        from xai_sdk import Client
+
+        return cls(
+            openai=AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY")) if os.getenv("OPENAI_API_KEY") else None,
+            anthropic=AsyncAnthropic(api_key=os.getenv("ANTHROPIC_API_KEY")) if os.getenv("ANTHROPIC_API_KEY") else None,
+            gemini=genai.Client(api_key=os.getenv("GOOGLE_API_KEY")) if os.getenv("GOOGLE_API_KEY") else None,
+            xai=Client(api_key=os.getenv("XAI_API_KEY")) if os.getenv("XAI_API_KEY") else None,
+        )
+
+    def for_provider(self, provider: str):
+        return {"openai": self.openai, "claude": self.anthropic, "gemini": self.gemini, "grok": self.xai}.get(provider)
+
+
+def infer_provider(model: str) -> Optional[str]:
+    """モデル名からプロバイダを推定する（バッチ実行で provider の指定が無い場合）。"""
+    name = (model or "").lower()
+    if name.startswith(("gpt", "o1", "o3", "o4", "chatgpt")):
+        return "openai"
+    for prefix, provider in (("gemini", "gemini"), ("claude", "claude"), ("grok", "grok")):
+        if name.startswith(prefix):
+            return provider
+    return None
+
+
+@dataclass
+class TurnRequest:
+    provider: str
+    model: str
+    history: list  # 今回のユーザー発話（HumanMessage）を末尾に含む会話履歴
+    system_prompt: str = ""
+    doc_context: str = ""  # 検索で見つかった文書の抜粋（OpenAI / Claude はシステムプロンプト、Gemini / Grok は発話側に入れる）
+    attachments: list = field(default_factory=list)
+    tool_kinds: set = field(default_factory=set)
+    openai_tools: list = field(default_factory=list)
+    mcp: object = None  # MCP のツールを使うターンなら MCPClientManager（OpenAI のみ）
+    state: dict = field(default_factory=dict)
+
+    @property
+    def user_text(self) -> str:
+        last = self.history[-1] if self.history else None
+        return last.content if isinstance(last, HumanMessage) else ""
+
+    @property
+    def full_system_prompt(self) -> str:
+        return f"{self.system_prompt}\n\n{self.doc_context}" if self.doc_context else self.system_prompt
+
+
+@dataclass
+class TurnResult:
+    text: str = ""
+    usage: dict = field(default_factory=dict)  # input_tokens / output_tokens / cached_tokens
+    ttft_ms: Optional[float] = None
+    total_ms: Optional[float] = None
+    response_id: Optional[str] = None
+    cancelled: bool = False
+
+
+def _usage(input_tokens=None, output_tokens=None, cached_tokens=None) -> dict:
+    return {k: v for k, v in (("input_tokens", input_tokens), ("output_tokens", output_tokens), ("cached_tokens", cached_tokens)) if v is not None}
+
+
+def _add_usage(total: dict, usage: dict) -> dict:
+    """ツール呼び出しで複数回に分かれた応答の使用量を足し合わせる。"""
+    return {k: total.get(k, 0) + usage.get(k, 0) for k in {*total, *usage}}
+
+
+# 同期ストリームの next() を回すスレッド（キャンセル後に実行中の next() を待ってから閉じるため専用にする）
+_STREAM_THREADS = ThreadPoolExecutor(max_workers=32, thread_name_prefix="stream")
+
+
+def _close_quietly(close) -> None:
+    try:
+        close()
+    except Exception as e:
+        print(f"[Turn] stream close error: {e}")
+
+
+async def _iterate_in_thread(iterable: Iterable) -> AsyncIterator:
+    """同期イテレーター（xai_sdk のストリームなど）をイベントループを止めずに回す。
+
+    途中で抜けたときは待たずに戻り、実行中の next() が返りしだいスレッド側でイテレーターを閉じて上流を切る。
+    """
+    iterator = iter(iterable)
+    done = object()
+    pending = None
+    try:
+        while True:
+            pending = _STREAM_THREADS.submit(next, iterator, done)
+            item = await asyncio.wrap_future(pending)
+            if item is done:
+                return
+            yield item
+    finally:
+        close = getattr(iterator, "close", None)
+        if close is not None:
+            if pending is not None and not pending.done():
+                pending.add_done_callback(lambda _: _close_quietly(close))
+            else:
+                _STREAM_THREADS.submit(_close_quietly, close)
+
+
+@asynccontextmanager
+async def _closing(stream):
+    """SDK のストリームを、途中で抜けた場合も含めて必ず閉じる（HTTP 接続をプールへすぐ返す）。"""
+    try:
+        yield stream
+    finally:
+        close = getattr(stream, "aclose", None) or getattr(stream, "close", None)
+        if close is not None:
+            await close()
+
+
+async def _stream_openai(client, req: TurnRequest, result: TurnResult) -> AsyncIterator[tuple[str, str]]:
+    tools = list(req.openai_tools)
+    if req.mcp is not None:
+        # MCP のツールはプロセス共通のプール経由で実行する（ツール一覧はキャッシュから）
+        tools.extend(await req.mcp.function_tools())
+    input_items = [
+        {"role": "system", "content": req.full_system_prompt},
+        {
+            "role": "user",
+            "content": (
+                [{"type": "input_text", "text": req.user_text}, *openai_file_parts(req.attachments)]
+                if req.attachments else req.user_text
+            ),
+        },
+    ]
+    previous_response_id = req.state.get("previous_response_id")
+    for round_ in range(MCP_MAX_ROUNDS + 1):
+        extra = {"tool_choice": "none"} if req.mcp is not None and round_ == MCP_MAX_ROUNDS else {}
+        calls = []
+        response_id = None
+        stream = await client.responses.create(
+            model=req.model,
+            input=input_items,
+            previous_response_id=previous_response_id,
+            tools=tools,
+            stream=True,
+            **extra,
+        )
+        async with _closing(stream):
+            async for event in stream:
+                etype = getattr(event, "type", None)
+
+                # テキストトークン（増分）
+                if etype == "response.output_text.delta":
+                    token = getattr(event, "delta", "") or ""
+                    if token:
+                        yield "token", token
+
+                # ツール呼び出しの進捗（Responses API）
+                elif etype == "response.tool_call.delta":
+                    delta = getattr(event, "delta", None)
+                    tool_name = None
+                    if delta is not None:
+                        tool_name = (
+                            getattr(delta, "name", None)
+                            or getattr(delta, "tool_name", None)
+                            or (getattr(getattr(delta, "function", None), "name", None))
+                        )
+                    yield "status", (f"ツール実行中: {tool_name}" if tool_name else "ツール実行中...")
+
+                # ツール呼び出し完了（実装差異に対応）
+                elif etype in ("response.tool_call.completed", "response.tool_calls.done"):
+                    yield "status", "応答生成中..."
+
+                # こちらで実行する function ツール（MCP）の呼び出し
+                elif etype == "response.output_item.done":
+                    item = getattr(event, "item", None)
+                    if getattr(item, "type", None) == "function_call":
+                        calls.append(item)
+
+                # 応答全体が完成
+                elif etype == "response.completed":
+                    resp = getattr(event, "response", None)
+                    response_id = getattr(resp, "id", None)
+                    usage = getattr(resp, "usage", None)
+                    if usage is not None:
+                        details = getattr(usage, "input_tokens_details", None)
+                        result.usage = _add_usage(result.usage, _usage(
+                            getattr(usage, "input_tokens", None),
+                            getattr(usage, "output_tokens", None),
+                            getattr(details, "cached_tokens", None),
+                        ))
+                    yield "status", ""
+
+                # エラーイベント
+                elif etype == "response.error":
+                    err = getattr(event, "error", None)
+                    raise RuntimeError(str(err) if err else "OpenAI streaming error")
+
+        if not calls or req.mcp is None:
+            # 次のターンはこの応答につなぐ（ツールの結果を返していない応答にはつながない）
+            if response_id:
+                req.state["previous_response_id"] = response_id
+                result.response_id = response_id
+            return
+        yield "status", "ツール実行中: " + ", ".join(call.name for call in calls)
+        outputs = await req.mcp.call_functions([(call.name, call.arguments) for call in calls])
+        print(f"[MCP] round={round_ + 1} calls={[call.name for call in calls]}")
+        input_items = [
+            {"type": "function_call_output", "call_id": call.call_id, "output": output}
+            for call, output in zip(calls, outputs)
+        ]
+        previous_response_id = response_id
+        yield "status", "応答生成中..."
+
+
+async def _stream_gemini(client, req: TurnRequest, result: TurnResult) -> AsyncIterator[tuple[str, str]]:
+    # --- ツール設定（ルーターが必要と判断したもののみ） ---
+    tools = []
+    if URL_CONTEXT in req.tool_kinds:
+        tools.append(Tool(url_context=UrlContext()))
+    if WEB_SEARCH in req.tool_kinds:
+        tools.append(Tool(google_search=GoogleSearch()))
+    if CODE in req.tool_kinds:
+        tools.append(Tool(code_execution={}))
+
+    # 履歴は role 付きの contents として差分だけ変換して保持する
+    conversation = req.state.get("gemini_conversation")
+    if conversation is None:
+        conversation = req.state["gemini_conversation"] = GeminiConversation()
+    contents = list(conversation.sync(req.history))
+
+    # 今回のユーザー発話にだけ検索結果・添付ファイルを足す（system_instruction とキャッシュは安定させる）
+    extra_parts = []
+    if req.doc_context:
+        extra_parts.append(Part(text=req.doc_context))
+    if req.attachments:
+        extra_parts.extend(gemini_file_parts(req.attachments))
+    if extra_parts:
+        contents[-1] = Content(role="user", parts=[*extra_parts, *(contents[-1].parts or [])])
+
+    # 長く安定したプレフィックスはコンテキストキャッシュへ（ツール使用時は対象外）
+    cached_content = None
+    if GEMINI_CONTEXT_CACHE and not tools:
+        context_cache = req.state.get("gemini_context_cache")
+        if context_cache is None:
+            context_cache = req.state["gemini_context_cache"] = GeminiContextCache()
+        if conversation.rewritten_from is not None:
+            context_cache.truncate(conversation.rewritten_from)
+        cached_content, contents = await context_cache.prepare(client, req.model, req.system_prompt, contents)
+    if cached_content:
+        config = GenerateContentConfig(cached_content=cached_content)
+    else:
+        config = GenerateContentConfig(system_instruction=req.system_prompt or None, tools=tools)
+
+    usage = None
+    stream = await client.aio.models.generate_content_stream(model=req.model, contents=contents, config=config)
+    async with _closing(stream):
+        async for chunk in stream:
+            usage = getattr(chunk, "usage_metadata", None) or usage
+            if not getattr(chunk, "candidates", None):
+                continue
+            candidate = chunk.candidates[0]  # 最上位候補のみ採用
+            if getattr(candidate, "content", None):
+                for part in (candidate.content.parts or []):
+                    text = getattr(part, "text", None)
+                    if text:
+                        yield "token", text
+
+    if usage is not None:
+        result.usage = _usage(
+            getattr(usage, "prompt_token_count", None),
+            getattr(usage, "candidates_token_count", None),
+            getattr(usage, "cached_content_token_count", None),
+        )
+    print(
+        f"[Gemini] messages={len(req.history)} sent_contents={len(contents)} "
+        f"prompt_tokens={result.usage.get('input_tokens')} cached_tokens={result.usage.get('cached_tokens')}"
+    )
+
+
+async def _stream_claude(client, req: TurnRequest, result: TurnResult) -> AsyncIterator[tuple[str, str]]:
+    claude_messages = [
+        {"role": "user" if isinstance(m, HumanMessage) else "assistant", "content": m.content} for m in req.history
+    ]
+    if req.attachments:
+        # 今回のユーザーメッセージにのみファイルを添付
+        claude_messages[-1]["content"] = [*claude_file_blocks(req.attachments), {"type": "text", "text": req.user_text}]
+        stream = await client.beta.messages.create(
+            model=req.model,
+            system=req.full_system_prompt,
+            messages=claude_messages,
+            max_tokens=CLAUDE_MAX_TOKENS,
+            stream=True,
+            betas=[CLAUDE_FILES_BETA],
+        )
+    else:
+        stream = await client.messages.create(
+            model=req.model,
+            system=req.full_system_prompt,
+            messages=claude_messages,
+            max_tokens=CLAUDE_MAX_TOKENS,
+            stream=True,
+        )
+    input_tokens = cached_tokens = output_tokens = None
+    async with _closing(stream):
+        async for chunk in stream:
+            if chunk.type == "content_block_delta":
+                token = getattr(chunk.delta, "text", None) or ""
+                if token:
+                    yield "token", token
+            elif chunk.type == "message_start":
+                usage = getattr(chunk.message, "usage", None)
+                input_tokens = getattr(usage, "input_tokens", None)
+                cached_tokens = getattr(usage, "cache_read_input_tokens", None)
+                result.response_id = getattr(chunk.message, "id", None)
+            elif chunk.type == "message_delta":
+                output_tokens = getattr(getattr(chunk, "usage", None), "output_tokens", None)
+    # Claude の input_tokens はキャッシュから読んだ分を含まないので、他のプロバイダにそろえて足しておく
+    if input_tokens is not None and cached_tokens:
+        input_tokens += cached_tokens
+    result.usage = _usage(input_tokens, output_tokens, cached_tokens)
+
+
+async def _stream_grok(client, req: TurnRequest, result: TurnResult) -> AsyncIterator[tuple[str, str]]:
+    # Live Search は検索/URL の種別が選ばれているときだけ "auto"（Tools OFF・ルーター無効では常に選ばれる。select_tool_kinds 参照）
+    search_mode = "auto" if req.tool_kinds & {WEB_SEARCH, URL_CONTEXT} else "off"
+
+    # 会話ごとのチャットハンドルに今回の発話を追記（モデル切替後などは履歴から作り直す）
+    handle = req.state.get("grok_chat")
+    if handle is None:
+        handle = req.state["grok_chat"] = GrokChatHandle()
+    user_text = f"{req.doc_context}\n\n{req.user_text}" if req.doc_context else req.user_text
+    images = await grok_image_urls(req.attachments)
+    mode = handle.prepare(client, req.model, req.system_prompt, req.history, user_text, search_mode, images=images)
+    request_bytes = handle.request_bytes()
+
+    last_response = None
+    answered = False
+    try:
+        async for response, chunk in _iterate_in_thread(handle.chat.stream()):
+            last_response = response
+            if chunk.content:
+                answered = True
+                yield "token", chunk.content
+    finally:
+        handle.commit(last_response if answered else None, len(req.history) + (1 if answered else 0))
+
+    usage = getattr(last_response, "usage", None)
+    if usage is not None:
+        result.usage = _usage(
+            getattr(usage, "prompt_tokens", None),
+            getattr(usage, "completion_tokens", None),
+            getattr(usage, "cached_prompt_text_tokens", None),
+        )
+    result.response_id = getattr(last_response, "id", None)
+    print(f"[Grok] mode={mode} request_bytes={request_bytes}")
+
+
+_STREAMERS = {
+    "openai": _stream_openai,
+    "gemini": _stream_gemini,
+    "claude": _stream_claude,
+    "grok": _stream_grok,
+}
+
+
+async def stream_turn(clients: ProviderClients, req: TurnRequest, result: TurnResult) -> AsyncIterator[tuple[str, str]]:
+    """1ターン分の応答をストリーミングする。テキスト・使用量・時間は result に記録する。"""
+    streamer = _STREAMERS.get(req.provider)
+    client = clients.for_provider(req.provider)
+    if streamer is None:
+        raise ValueError(f"unknown provider: {req.provider}")
+    if client is None:
+        raise RuntimeError(MISSING_KEY_MESSAGES[req.provider])
+    started = time.monotonic()
+    stream = streamer(client, req, result)
+    try:
+        async for kind, text in stream:
+            if kind == "token":
+                if result.ttft_ms is None:
+                    result.ttft_ms = round((time.monotonic() - started) * 1000, 1)
+                result.text += text
+            yield kind, text
+    except (asyncio.CancelledError, GeneratorExit):
+        result.cancelled = True
+        raise
+    finally:
+        # 呼び出し側が途中で抜けた場合もここで上流を閉じる（GC 任せにしない）
+        await stream.aclose()
+        result.total_ms = round((time.monotonic() - started) * 1000, 1)
+        print(
+            f"[Turn] provider={req.provider} model={req.model} ttft={result.ttft_ms}ms total={result.total_ms}ms "
+            f"usage={result.usage}" + (" cancelled" if result.cancelled else "")
+        )
@@ -71,15 +71,62 @@ const MonacoEditor = React.lazy(() => import('@monaco-editor/react'));
 const DEFAULT_HEIGHT = 420;
 const DEFAULT_FILENAME = 'index.html';
 const FALLBACK_LANGUAGE = 'html';
+// プレビュー（iframe.srcdoc の書き換え）の最短間隔
+const PREVIEW_THROTTLE_MS = 500;
+// 出力欄に保持する文字数の上限（古いものから捨てる）
+const OUTPUT_MAX_CHARS = 200000;
+
+// サーバーから受け取ったドキュメントの正本（再マウントされても差分を適用し続けられるようページ単位で保持）
+const DOC_STORE = (window.__codeWorkbenchDocs = window.__codeWorkbenchDocs || {});
+
+/* ---------- 差分の適用（app.py / workbench.py と同じ規則。オフセットは UTF-16 単位） ---------- */
+function applyPatchToText(text, patch) {
+  if (patch.op === 'reset') return patch.text || '';
+  if (patch.op === 'append') return text + (patch.text || '');
+  return text.slice(0, patch.start) + (patch.text || '') + text.slice(patch.end);
+}
+
+/* ---------- 実行出力の操作（本文は変えない） ---------- */
+function applyOutputPatch(output, patch) {
+  const chunks = patch.chunks || [];
+  let next = patch.op === 'output_reset' ? [] : output.slice();
+  for (const c of chunks) {
+    const last = next[next.length - 1];
+    if (last && last.stream === c.stream) {
+      next[next.length - 1] = { stream: c.stream, text: last.text + c.text };
+    } else {
+      next.push({ stream: c.stream, text: c.text });
+    }
+  }
+  let total = next.reduce((n, c) => n + c.text.length, 0);
+  while (total > OUTPUT_MAX_CHARS && next.length > 1) {
+    total -= next[0].text.length;
+    next = next.slice(1);
+  }
+  return next;
+}
+
+function initialDocText(docId, patch, legacyCode) {
+  const entry = docId && DOC_STORE[docId];
+  // ユーザーが編集した内容があればそちらを表示する（再マウントで失わない）
+  if (entry) return entry.dirty ? entry.local : entry.text;
+  if (patch && patch.op === 'reset') return patch.text || '';
+  return legacyCode || '';
+}
 
 export default function CodeWorkbench(props) {
   const {
-    code: initialCode = '',
+    code: legacyCode = '',
+    docId,
+    seq = 0,
+    patch,
     title = 'Canvas: Code Workbench',
     filename: propFilename,
     language: propLanguage,
     readOnly = false,
     autoPreview = true,
+    runnable = false,
+    output: initialOutput = [],
   } = props || {};
 
   const iframeRef = useRef(null);
@@ -87,20 +134,134 @@ export default function CodeWorkbench(props) {
   const containerRef = useRef(null);
   const fullscreenWrapperRef = useRef(null);
 
-  const [editorCode, setEditorCode] = useState(initialCode);
+  // コードは再レンダリングを起こさないよう ref で保持し、エディタは非制御（defaultValue）で使う
+  const codeRef = useRef(initialDocText(docId, patch, legacyCode));
+  const applyingRef = useRef(false);
+  // ユーザーがエディタを編集してサーバーの正本から分かれたか（分かれている間はサーバーの差分をエディタに適用しない）
+  const [dirty, setDirty] = useState(() => Boolean(docId && DOC_STORE[docId] && DOC_STORE[docId].dirty));
+  const dirtyRef = useRef(dirty);
+  const lastPreviewRef = useRef(0);
+  const previewTimerRef = useRef(null);
   const [activeView, setActiveView] = useState(autoPreview ? 'split' : 'editor'); // 'editor' | 'preview' | 'split'
   const [isFullscreen, setIsFullscreen] = useState(false);
   const [filename, setFilename] = useState(propFilename || DEFAULT_FILENAME);
   const [language, setLanguage] = useState(
-    propLanguage || detectLanguage(propFilename, initialCode) || FALLBACK_LANGUAGE,
+    propLanguage || detectLanguage(propFilename, codeRef.current) || FALLBACK_LANGUAGE,
   );
   const [cursorPos, setCursorPos] = useState({ lineNumber: 1, column: 1 });
   const [statusText, setStatusText] = useState('Ready');
+  // 実行出力と実行状態（runnable のときだけ表示）
+  // 保存済みのスナップショット（props.output）から開いた場合はその出力を初期値にする
+  const [output, setOutput] = useState(() => (docId && DOC_STORE[docId] && DOC_STORE[docId].output) || initialOutput);
+  const [runState, setRunState] = useState(() => (docId && DOC_STORE[docId] && DOC_STORE[docId].run) || null);
+  const outputRef = useRef(null);
+
+  /* ---------- プレビュー更新（スロットリング） ---------- */
+  const updatePreview = useCallback((code = codeRef.current) => {
+    if (!iframeRef.current) return;
+    lastPreviewRef.current = Date.now();
+    iframeRef.current.srcdoc = code;
+    setStatusText(`Preview updated at ${new Date().toLocaleTimeString()}`);
+  }, []);
+
+  const schedulePreview = useCallback(() => {
+    if (!autoPreview || previewTimerRef.current) return;
+    const wait = Math.max(0, PREVIEW_THROTTLE_MS - (Date.now() - lastPreviewRef.current));
+    previewTimerRef.current = setTimeout(() => {
+      previewTimerRef.current = null;
+      updatePreview();
+    }, wait);
+  }, [autoPreview, updatePreview]);
+
+  useEffect(() => () => clearTimeout(previewTimerRef.current), []);
+
+  /* ---------- サーバーからの差分をエディタに反映（カーソル・Undo・スクロールを保つ） ---------- */
+  const applyToEditor = useCallback((p, nextText) => {
+    const editor = editorRef.current;
+    const model = editor && editor.getModel();
+    if (!model) return;
+    applyingRef.current = true;
+    try {
+      if (p.op === 'reset') {
+        if (model.getValue() !== nextText) model.setValue(nextText);
+      } else if (p.op === 'append') {
+        const end = model.getFullModelRange().getEndPosition();
+        model.pushEditOperations(
+          [],
+          [{ range: { startLineNumber: end.lineNumber, startColumn: end.column, endLineNumber: end.lineNumber, endColumn: end.column }, text: p.text || '' }],
+          () => null,
+        );
+      } else {
+        const start = model.getPositionAt(p.start);
+        const end = model.getPositionAt(p.end);
+        model.pushEditOperations(
+          [],
+          [{ range: { startLineNumber: start.lineNumber, startColumn: start.column, endLineNumber: end.lineNumber, endColumn: end.column }, text: p.text || '' }],
+          () => null,
+        );
+      }
+    } finally {
+      applyingRef.current = false;
+    }
+  }, []);
 
-  /* ---------- 初期コード変化を監視 ---------- */
   useEffect(() => {
-    setEditorCode(initialCode);
-  }, [initialCode]);
+    if (!patch) {
+      // 旧形式（code を丸ごと渡す）にも対応
+      if (legacyCode && legacyCode !== codeRef.current && !dirtyRef.current) {
+        codeRef.current = legacyCode;
+        applyToEditor({ op: 'reset' }, legacyCode);
+        schedulePreview();
+      }
+      return;
+    }
+    const entry = DOC_STORE[docId];
+    if (entry && entry.seq >= seq) return; // 再マウント時など、適用済み
+    if (patch.op.startsWith('output')) {
+      if (!entry || entry.seq !== patch.base) {
+        if (typeof callAction === 'function') {
+          callAction({ name: 'workbench_resync', payload: { docId } });
+        }
+        return;
+      }
+      let run = entry.run || null;
+      let nextOutput = entry.output || [];
+      if (patch.op === 'output_exit') {
+        run = { running: false, ok: patch.ok, error: patch.error, durationMs: patch.duration_ms };
+      } else {
+        nextOutput = applyOutputPatch(nextOutput, patch);
+        if (patch.running) run = { running: true };
+      }
+      DOC_STORE[docId] = { ...entry, seq, output: nextOutput, run };
+      setOutput(nextOutput);
+      setRunState(run);
+      return;
+    }
+    let nextText;
+    if (patch.op === 'reset') {
+      nextText = patch.text || '';
+    } else if (entry && entry.seq === patch.base) {
+      nextText = applyPatchToText(entry.text, patch);
+    } else {
+      // 差分の取りこぼし: 全文を送り直してもらう
+      if (typeof callAction === 'function') {
+        callAction({ name: 'workbench_resync', payload: { docId } });
+      }
+      return;
+    }
+    DOC_STORE[docId] = { output: initialOutput, ...(entry || {}), text: nextText, seq };
+    if (dirtyRef.current) {
+      // ユーザーの編集（Undo 履歴・カーソルを含む）は上書きしない。最新版は「Load latest」で読み込む
+      setStatusText('Newer version available — your edits are kept');
+      return;
+    }
+    // エディタの内容は正本と同じなので、差分をそのまま適用できる（カーソル・Undo・スクロールを保つ）
+    applyToEditor(patch, nextText);
+    const model = editorRef.current && editorRef.current.getModel();
+    codeRef.current = model ? model.getValue() : nextText;
+    schedulePreview();
+    // eslint-disable-next-line react-hooks/exhaustive-deps
+  }, [docId, seq, legacyCode]);
 
   useEffect(() => {
     if (propFilename && propFilename !== filename) {
@@ -133,38 +294,58 @@ export default function CodeWorkbench(props) {
     }
   }, []);
 
-  /* ---------- プレビュー更新 ---------- */
-  const updatePreview = useCallback(
-    (code = editorCode) => {
-      if (!iframeRef.current) return;
-      iframeRef.current.srcdoc = code;
-      setStatusText(`Preview updated at ${new Date().toLocaleTimeString()}`);
-    },
-    [editorCode],
-  );
-
+  /* ---------- 表示切り替え時のプレビュー ---------- */
   useEffect(() => {
     if (autoPreview && (activeView === 'preview' || activeView === 'split')) {
-      const timeout = setTimeout(() => updatePreview(editorCode), 150);
-      return () => clearTimeout(timeout);
+      schedulePreview();
     }
-  }, [activeView, autoPreview, editorCode, updatePreview]);
+  }, [activeView, autoPreview, schedulePreview]);
+
+  /* ---------- 出力欄は末尾を表示し続ける ---------- */
+  useEffect(() => {
+    if (outputRef.current) outputRef.current.scrollTop = outputRef.current.scrollHeight;
+  }, [output]);
+
+  /* ---------- 編集を捨てて、サーバーの最新版を読み込む（確認してから） ---------- */
+  const handleLoadLatest = useCallback(() => {
+    const entry = DOC_STORE[docId];
+    if (!entry || !window.confirm('Discard your edits and load the latest version?')) return;
+    DOC_STORE[docId] = { ...entry, dirty: false, local: undefined };
+    dirtyRef.current = false;
+    setDirty(false);
+    applyToEditor({ op: 'reset' }, entry.text);
+    codeRef.current = entry.text;
+    schedulePreview();
+    setStatusText('Loaded the latest version');
+  }, [docId, applyToEditor, schedulePreview]);
+
+  /* ---------- 実行（サーバーの実行プールで、エディタ上のコードを実行） ---------- */
+  const handleRun = useCallback(() => {
+    if (!runnable || (runState && runState.running) || typeof callAction !== 'function') return;
+    setRunState({ running: true });
+    callAction({ name: 'workbench_run', payload: { docId, code: codeRef.current } });
+  }, [docId, runnable, runState]);
 
   /* ---------- ダウンロード ---------- */
   const handleDownload = useCallback(() => {
-    const blob = new Blob([editorCode], { type: 'text/plain;charset=utf-8' });
+    const blob = new Blob([codeRef.current], { type: 'text/plain;charset=utf-8' });
     const a = document.createElement('a');
     a.href = URL.createObjectURL(blob);
     a.download = filename || DEFAULT_FILENAME;
     a.click();
     setTimeout(() => URL.revokeObjectURL(a.href), 1200);
     setStatusText(`Downloaded ${filename}`);
-  }, [editorCode, filename]);
+  }, [filename]);
 
   /* ---------- Monaco Editor onMount ---------- */
   const handleEditorMount = useCallback((editor, monaco) => {
     editorRef.current = editor;
 
+    // 読み込み中に差分が届いていた場合は最新の内容にそろえる
+    if (editor.getValue() !== codeRef.current) {
+      editor.setValue(codeRef.current);
+    }
+
     // 行番号・カーソル位置をステータスバーへ反映
     const cursorListener = editor.onDidChangeCursorPosition((ev) => {
       setCursorPos({ lineNumber: ev.position.lineNumber, column: ev.position.column });
@@ -246,7 +427,7 @@ export default function CodeWorkbench(props) {
           style={activeView === 'preview' ? styles.tabActive : styles.tab}
           onClick={() => {
             setActiveView('preview');
-            updatePreview(editorCode);
+            updatePreview();
           }}
         >
           Preview
@@ -256,7 +437,7 @@ export default function CodeWorkbench(props) {
           style={activeView === 'split' ? styles.tabActive : styles.tab}
           onClick={() => {
             setActiveView('split');
-            updatePreview(editorCode);
+            updatePreview();
           }}
         >
           Split
@@ -268,9 +449,26 @@ export default function CodeWorkbench(props) {
             Fullscreen
           </button>
         )}
-        <button type="button" style={styles.controlBtn} onClick={() => updatePreview(editorCode)}>
-          Refresh
-        </button>
+        {dirty && (
+          <button type="button" style={styles.controlBtn} onClick={handleLoadLatest}>
+            Load latest
+          </button>
+        )}
+        {runnable && (
+          <button
+            type="button"
+            style={styles.controlBtn}
+            onClick={handleRun}
+            disabled={Boolean(runState && runState.running)}
+          >
+            {runState && runState.running ? 'Running…' : 'Run'}
+          </button>
+        )}
+        {!runnable && (
+          <button type="button" style={styles.controlBtn} onClick={() => updatePreview()}>
+            Refresh
+          </button>
+        )}
         <button type="button" style={styles.controlBtn} onClick={handleDownload}>
           Download
         </button>
@@ -300,11 +498,21 @@ export default function CodeWorkbench(props) {
       <div style={styles.body(activeView)}>
         {(activeView === 'editor' || activeView === 'split') && (
           <div style={styles.editorPane(activeView)}>
-            <Suspense fallback={<textarea style={styles.fallbackTextarea} defaultValue={editorCode} readOnly />}>
+            <Suspense fallback={<textarea style={styles.fallbackTextarea} defaultValue={codeRef.current} readOnly />}>
               <MonacoEditor
                 height={DEFAULT_HEIGHT}
-                value={editorCode}
-                onChange={(value) => setEditorCode(value ?? '')}
+                defaultValue={codeRef.current}
+                onChange={(value) => {
+                  codeRef.current = value ?? '';
+                  if (applyingRef.current) return;
+                  // ユーザーの編集: 以降はサーバーの差分でエディタを書き換えない
+                  if (docId) DOC_STORE[docId] = { ...(DOC_STORE[docId] || {}), dirty: true, local: codeRef.current };
+                  if (!dirtyRef.current) {
+                    dirtyRef.current = true;
+                    setDirty(true);
+                  }
+                  schedulePreview();
+                }}
                 onMount={handleEditorMount}
                 theme={theme}
                 defaultLanguage={language}
@@ -317,6 +525,25 @@ export default function CodeWorkbench(props) {
           <div style={styles.previewPane(activeView)}>{renderPreview()}</div>
         )}
       </div>
+      {runnable && (
+        <div style={styles.outputPanel}>
+          <div style={styles.outputHeader}>
+            <span>Output</span>
+            <span>
+              {runState && runState.running && 'running…'}
+              {runState && !runState.running &&
+                `${runState.ok ? 'ok' : runState.error || 'failed'}${runState.durationMs != null ? ` (${runState.durationMs} ms)` : ''}`}
+            </span>
+          </div>
+          <pre ref={outputRef} style={styles.outputBody}>
+            {output.map((c, i) => (
+              <span key={i} style={c.stream === 'stderr' ? styles.stderr : undefined}>
+                {c.text}
+              </span>
+            ))}
+          </pre>
+        </div>
+      )}
 
     </div>
   );
@@ -415,6 +642,26 @@ const styles = {
     cursor: 'pointer',
     zIndex: 2147483647,
   },
+  outputPanel: { borderTop: '1px solid #e5e7eb', background: '#0b1020' },
+  outputHeader: {
+    display: 'flex',
+    justifyContent: 'space-between',
+    padding: '4px 12px',
+    fontSize: 11,
+    color: '#9ca3af',
+    borderBottom: '1px solid #1f2937',
+  },
+  outputBody: {
+    margin: 0,
+    padding: '8px 12px',
+    maxHeight: 200,
+    overflow: 'auto',
+    color: '#e5e7eb',
+    fontFamily: 'ui-monospace, SFMono-Regular, Menlo, monospace',
+    fontSize: 12,
+    whiteSpace: 'pre-wrap',
+  },
+  stderr: { color: '#fca5a5' },
   fallbackTextarea: {
     width: '100%',
     height: DEFAULT_HEIGHT,
@@ -77,14 +77,18 @@ const styles = `
   }
 `;
 
-const convertJsonToMarkdownArray = (slides) => {
-  if (!Array.isArray(slides)) return [];
-  return slides.map(slide => {
-    let markdown = '';
-    if (slide.title) markdown += `# ${slide.title}\n\n`;
-    if (slide.content) markdown += `${slide.content.replace(/\n/g, '\n\n')}`;
-    return markdown;
-  });
+// Decks received from the server, kept per page so that a remounted element can keep applying updates
+const DECK_STORE = (window.__slidePreviewDecks = window.__slidePreviewDecks || {});
+// Number of neighbouring slides rendered (hidden) on each side of the visible one
+const RENDER_NEIGHBOURS = 1;
+
+const slideToMarkdown = (slide) => {
+  if (!slide) return '';
+  if (typeof slide === 'string') return slide;
+  let markdown = '';
+  if (slide.title) markdown += `# ${slide.title}\n\n`;
+  if (slide.content) markdown += `${String(slide.content).replace(/\n/g, '\n\n')}`;
+  return markdown;
 };
 
 // Fallback: try to extract a JSON array from arbitrary text (code fences, prefixes, etc.)
@@ -119,10 +123,26 @@ const extractJsonArrayClient = (text) => {
   return null;
 };
 
+// Legacy props: the whole deck as one JSON string
+const parseLegacySlides = (sj) => {
+  try {
+    if (Array.isArray(sj)) return sj;
+    if (sj && typeof sj === 'object' && Array.isArray(sj.slides)) return sj.slides;
+    if (typeof sj === 'string') {
+      const extracted = extractJsonArrayClient(sj);
+      if (Array.isArray(extracted)) return extracted;
+    }
+  } catch (e) {
+    console.error('Failed to parse slides_json:', e);
+  }
+  return [];
+};
+
 const SlidePreview = (props) => {
   // Chainlit CustomElement passes props object as-is. Read directly.
-  const { slides_json = '[]', title = 'Slide Preview' } = props || {};
+  const { deckId, seq = 0, patch, count = 0, slides_json, title = 'Slide Preview' } = props || {};
   const [currentPage, setCurrentPage] = useState(1);
+  const [deckVersion, setDeckVersion] = useState(0);
   const [librariesLoaded, setLibrariesLoaded] = useState(false);
   const containerRef = useRef(null);
 
@@ -133,35 +153,69 @@ const SlidePreview = (props) => {
       .catch(error => console.error('Failed to load marked:', error));
   }, []);
 
-  const slides = useMemo(() => {
-    try {
-      let data = [];
-      const sj = slides_json;
-      // Debug visibility (use console.log so it appears at default level)
-      try { console.log('[SlidePreview] slides_json type:', typeof sj); } catch (_) {}
-      if (Array.isArray(sj)) {
-        data = sj;
-      } else if (typeof sj === 'string') {
-        const parsed = JSON.parse(sj);
-        if (Array.isArray(parsed)) data = parsed;
-        else if (parsed && Array.isArray(parsed.slides)) data = parsed.slides;
-      } else if (sj && typeof sj === 'object') {
-        if (Array.isArray(sj.slides)) data = sj.slides;
+  // Apply addressed slide updates ({op: 'reset' | 'set', start, slides}) in sequence
+  useEffect(() => {
+    if (!deckId || !patch) return;
+    const entry = DECK_STORE[deckId];
+    if (entry && entry.seq >= seq) return; // already applied (e.g. remount)
+    let next;
+    if (patch.op === 'reset') {
+      next = { slides: new Array(count), html: {}, seq };
+    } else if (entry && entry.seq === patch.base) {
+      next = entry;
+      next.seq = seq;
+      if (next.slides.length < count) next.slides.length = count;
+    } else {
+      // Missed an update: ask the server for the whole deck again
+      if (typeof callAction === 'function') {
+        callAction({ name: 'slides_resync', payload: { deckId } });
       }
-      // If still empty, try robust client-side extraction from raw string
-      if ((!data || data.length === 0) && typeof sj === 'string') {
-        const extracted = extractJsonArrayClient(sj);
-        if (Array.isArray(extracted)) data = extracted;
+      return;
+    }
+    (patch.slides || []).forEach((slide, i) => {
+      next.slides[patch.start + i] = slide;
+      delete next.html[patch.start + i];
+    });
+    DECK_STORE[deckId] = next;
+    setDeckVersion(v => v + 1);
+    // eslint-disable-next-line react-hooks/exhaustive-deps
+  }, [deckId, seq]);
+
+  const legacySlides = useMemo(() => (deckId ? null : parseLegacySlides(slides_json)), [deckId, slides_json]);
+  const deck = deckId ? DECK_STORE[deckId] : null;
+  const totalPages = deck ? deck.slides.length : legacySlides.length;
+
+  useEffect(() => {
+    if (totalPages > 0 && currentPage > totalPages) setCurrentPage(totalPages);
+  }, [currentPage, totalPages]);
+
+  // Render only the visible slide and its neighbours; drop cached HTML for everything else
+  const renderedPages = useMemo(() => {
+    if (!librariesLoaded || !window.marked || totalPages === 0) return [];
+    const first = Math.max(0, currentPage - 1 - RENDER_NEIGHBOURS);
+    const last = Math.min(totalPages - 1, currentPage - 1 + RENDER_NEIGHBOURS);
+    const cache = deck ? deck.html : {};
+    const pages = [];
+    for (let i = first; i <= last; i += 1) {
+      const slide = deck ? deck.slides[i] : legacySlides[i];
+      if (slide === undefined) {
+        pages.push({ index: i, html: null });
+        continue;
       }
-      try { console.log('[SlidePreview] parsed slides length:', Array.isArray(data) ? data.length : 'N/A'); } catch (_) {}
-      return convertJsonToMarkdownArray(data);
-    } catch (e) {
-      console.error('Failed to parse slides_json:', e);
-      return ['Error: Invalid slide data format.'];
+      if (cache[i] === undefined) cache[i] = window.marked.parse(slideToMarkdown(slide));
+      pages.push({ index: i, html: cache[i] });
+    }
+    if (deck) {
+      Object.keys(cache).forEach((k) => {
+        if (k < first || k > last) delete cache[k];
+      });
     }
-  }, [slides_json]);
+    return pages;
+    // eslint-disable-next-line react-hooks/exhaustive-deps
+  }, [librariesLoaded, currentPage, totalPages, deckVersion, legacySlides]);
 
-  const totalPages = slides.length;
+  const goPrev = () => setCurrentPage(p => Math.max(1, p - 1));
+  const goNext = () => setCurrentPage(p => Math.min(totalPages, p + 1));
 
   const toggleFullScreen = () => {
     const elem = containerRef.current;
@@ -177,39 +231,34 @@ const SlidePreview = (props) => {
     return <div>Loading Markdown renderer...</div>;
   }
 
-  if (!slides_json || totalPages === 0) {
-    const preview = typeof slides_json === 'string' ? slides_json.slice(0, 500) : JSON.stringify(slides_json).slice(0, 500);
-    return (
-      <div>
-        <div>Loading slides or no slides to display...</div>
-        <details style={{ marginTop: 12 }}>
-          <summary>Debug: slides_json preview</summary>
-          <pre style={{ whiteSpace: 'pre-wrap' }}>{preview}</pre>
-        </details>
-      </div>
-    );
+  if (totalPages === 0) {
+    return <div>Loading slides or no slides to display...</div>;
   }
 
   return (
-    <div className="slide-preview-container" ref={containerRef}>
+    <div
+      className="slide-preview-container"
+      ref={containerRef}
+      tabIndex={0}
+      onKeyDown={(e) => {
+        if (e.key === 'ArrowLeft') goPrev();
+        if (e.key === 'ArrowRight') goNext();
+      }}
+    >
       <style>{styles}</style>
-      {/* On-screen debug banner */}
-      <div style={{ fontSize: 12, color: '#999', marginBottom: 6 }}>
-        <span>Debug: slides_json type = {typeof slides_json}; pages = {totalPages}</span>
-      </div>
       <div className="slide-render-area">
         <div className="slide-content">
-          {librariesLoaded && window.marked ? (
-            <div dangerouslySetInnerHTML={{ __html: window.marked.parse(slides[currentPage - 1] || '') }} />
-          ) : (
-            <div>Loading Markdown renderer...</div>
-          )}
+          {renderedPages.map(({ index, html }) => (
+            <div key={index} style={{ display: index === currentPage - 1 ? 'block' : 'none' }}>
+              {html === null ? <div>Loading slide {index + 1}...</div> : <div dangerouslySetInnerHTML={{ __html: html }} />}
+            </div>
+          ))}
         </div>
       </div>
       <div className="controls">
-        <button onClick={() => setCurrentPage(p => Math.max(1, p - 1))} disabled={currentPage === 1}>Prev</button>
+        <button onClick={goPrev} disabled={currentPage === 1}>Prev</button>
         <span>Page {currentPage} of {totalPages}</span>
-        <button onClick={() => setCurrentPage(p => Math.min(totalPages, p + 1))} disabled={currentPage === totalPages}>Next</button>
+        <button onClick={goNext} disabled={currentPage === totalPages}>Next</button>
       </div>
       <button onClick={toggleFullScreen} className="fullscreen-btn">Fullscreen</button>
     </div>
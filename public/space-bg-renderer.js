@@ -0,0 +1,277 @@
+// 黒宇宙の背景レンダラー（星層 + 低彩度ネビュラ + 微弱瞬き）。three.js を使わず WebGL で直接描く。
+// ワーカー（OffscreenCanvas）でもメインスレッドでも同じコードで動く（self.SpaceBg.create）。
+// フレーム時間を見て、描画解像度・FPS 上限・ネビュラの fbm オクターブ数を段階的に上げ下げする。
+// 非表示・応答ストリーミング中などは pause の理由が1つでもあれば描画を止める（最後のフレームが残る）。
+(function (root) {
+  // 上から順に重い。scale は CSS ピクセルに対する描画解像度（devicePixelRatio を上限にする）
+  const LEVELS = [
+    { scale: 1.5, fps: 60, octaves: 6 },
+    { scale: 1.0, fps: 60, octaves: 5 },
+    { scale: 0.75, fps: 30, octaves: 4 },
+    { scale: 0.5, fps: 30, octaves: 4 },
+    { scale: 0.5, fps: 20, octaves: 3 },
+    { scale: 0.35, fps: 10, octaves: 3 },
+  ];
+  const WINDOW_MS = 1000; // この間隔でフレーム時間を評価する
+  const UPGRADE_WINDOWS = 4; // 余裕のある評価がこれだけ続いたら1段上げる
+
+  const QUAD_VERT = `
+    attribute vec2 aPos;
+    void main(){ gl_Position = vec4(aPos, 0.0, 1.0); }`;
+
+  const NEBULA_FRAG = `
+    precision highp float;
+    uniform vec2 iRes;
+    uniform float iTime;
+    uniform int iOctaves;
+
+    float hash(vec2 p){ return fract(sin(dot(p, vec2(127.1,311.7))) * 43758.5453123); }
+    float noise(vec2 p){
+      vec2 i = floor(p), f = fract(p);
+      float a = hash(i), b = hash(i+vec2(1.,0.));
+      float c = hash(i+vec2(0.,1.)), d = hash(i+vec2(1.,1.));
+      vec2 u = f*f*(3.-2.*f);
+      return mix(mix(a,b,u.x), mix(c,d,u.x), u.y);
+    }
+    float fbm(vec2 p){
+      float v=0., a=0.5;
+      for(int i=0;i<6;i++){ if(i>=iOctaves) break; v += a*noise(p); p*=2.03; a*=0.5; }
+      return v;
+    }
+
+    void main(){
+      vec2 uv = gl_FragCoord.xy / iRes.xy;
+      vec2 p  = (uv - 0.5) * vec2(iRes.x/iRes.y, 1.0);
+      vec3 col = vec3(0.0);
+
+      // ネビュラ: 低彩度の青灰。極めて控えめ。
+      float n1 = fbm(p*2.2 + vec2(0.0, iTime*0.01));
+      float n2 = fbm(p*1.1 - vec2(iTime*0.006, 0.0));
+      float neb = smoothstep(0.55, 0.95, 0.5*n1 + 0.5*n2);
+      col += mix(vec3(0.0), vec3(0.08,0.09,0.12), neb) * 0.35;
+
+      // 薄い周辺減光で中央を僅かに持ち上げる
+      col *= 1.0 - 0.08 * smoothstep(0.4, 1.1, length(p));
+
+      // 微弱な瞬き
+      float twinkle = 0.5 + 0.5*sin(iTime*2.0 + fbm(p*8.0)*6.2831);
+      col += vec3(0.02)*twinkle*0.02;
+      gl_FragColor = vec4(col, 1.0);
+    }`;
+
+  const STAR_VERT = `
+    attribute vec2 aPos;
+    attribute float aSize;
+    attribute float aParallax;
+    attribute float aTwinkle;
+    uniform float iRatio;
+    uniform vec2 iDrift;
+    varying float vSize;
+    varying float vTwinkle;
+    void main(){
+      vSize = aSize;
+      vTwinkle = aTwinkle;
+      gl_Position = vec4(aPos + iDrift * aParallax, 0.0, 1.0);
+      gl_PointSize = aSize * 2.0 * iRatio;
+    }`;
+
+  const STAR_FRAG = `
+    precision mediump float;
+    uniform float iTime;
+    varying float vSize;
+    varying float vTwinkle;
+    void main(){
+      float d = length(gl_PointCoord - 0.5);
+      float disk = smoothstep(0.5, 0.0, d);
+      float core = smoothstep(0.12, 0.0, d);
+      float t = vTwinkle > 0.5 ? (0.75 + 0.25*sin(iTime*3.0 + vSize*13.0)) : 1.0;
+      gl_FragColor = vec4((vec3(0.85) * disk + vec3(1.0) * core) * t, disk);
+    }`;
+
+  function compile(gl, vert, frag) {
+    const prog = gl.createProgram();
+    for (const [type, src] of [[gl.VERTEX_SHADER, vert], [gl.FRAGMENT_SHADER, frag]]) {
+      const sh = gl.createShader(type);
+      gl.shaderSource(sh, src);
+      gl.compileShader(sh);
+      if (!gl.getShaderParameter(sh, gl.COMPILE_STATUS)) throw new Error(gl.getShaderInfoLog(sh));
+      gl.attachShader(prog, sh);
+    }
+    gl.linkProgram(prog);
+    if (!gl.getProgramParameter(prog, gl.LINK_STATUS)) throw new Error(gl.getProgramInfoLog(prog));
+    return prog;
+  }
+
+  function makeStars() {
+    // 遠 / 中 / 近（近はランダム瞬き）: x, y, size, parallax, twinkle
+    const data = [];
+    for (const [count, parallax, twinkle] of [[50, 0.2, 0], [20, 0.5, 0], [20, 1.0, 1]]) {
+      for (let i = 0; i < count; i++) {
+        data.push(Math.random() * 2 - 1, Math.random() * 2 - 1, (Math.random() * 1.25 + 0.4) * (1 + parallax), parallax, twinkle);
+      }
+    }
+    return new Float32Array(data);
+  }
+
+  function percentile(sorted, p) {
+    return sorted.length ? sorted[Math.min(sorted.length - 1, Math.floor(sorted.length * p))] : 0;
+  }
+
+  // opts: { width, height, dpr, level（固定する場合）, report（stats を送る）, reduced（動きを減らす）}
+  // emit: 統計などを呼び出し側へ返す関数（ワーカーでは postMessage）
+  function create(canvas, opts, emit) {
+    const gl = canvas.getContext("webgl", { antialias: false, alpha: false, powerPreference: "low-power", desynchronized: true });
+    if (!gl) throw new Error("WebGL unavailable");
+    const raf = root.requestAnimationFrame ? root.requestAnimationFrame.bind(root) : (cb) => setTimeout(() => cb(performance.now()), 16);
+
+    const quadBuf = gl.createBuffer();
+    gl.bindBuffer(gl.ARRAY_BUFFER, quadBuf);
+    gl.bufferData(gl.ARRAY_BUFFER, new Float32Array([-1, -1, 1, -1, -1, 1, 1, 1]), gl.STATIC_DRAW);
+    const nebula = compile(gl, QUAD_VERT, NEBULA_FRAG);
+    const nebulaLoc = {
+      aPos: gl.getAttribLocation(nebula, "aPos"),
+      iRes: gl.getUniformLocation(nebula, "iRes"),
+      iTime: gl.getUniformLocation(nebula, "iTime"),
+      iOctaves: gl.getUniformLocation(nebula, "iOctaves"),
+    };
+
+    const stars = makeStars();
+    const starBuf = gl.createBuffer();
+    gl.bindBuffer(gl.ARRAY_BUFFER, starBuf);
+    gl.bufferData(gl.ARRAY_BUFFER, stars, gl.STATIC_DRAW);
+    const starProg = compile(gl, STAR_VERT, STAR_FRAG);
+    const starLoc = {
+      attrs: ["aPos", "aSize", "aParallax", "aTwinkle"].map((n) => gl.getAttribLocation(starProg, n)),
+      iRatio: gl.getUniformLocation(starProg, "iRatio"),
+      iDrift: gl.getUniformLocation(starProg, "iDrift"),
+      iTime: gl.getUniformLocation(starProg, "iTime"),
+    };
+    const starCount = stars.length / 5;
+
+    const fixed = Number.isInteger(opts.level);
+    let level = fixed ? opts.level : Math.min(1, LEVELS.length - 1); // 既定は 1 段目から様子を見る
+    let width = opts.width, height = opts.height, dpr = opts.dpr || 1;
+    const pauses = new Set(opts.reduced ? ["reduced"] : []);
+    const t0 = performance.now();
+    let running = false, lastDraw = 0, windowStart = 0, calm = 0, pressure = 0;
+    let intervals = [], drawMs = 0, frames = 0;
+
+    function applySize() {
+      const scale = Math.min(LEVELS[level].scale, Math.max(1, dpr));
+      canvas.width = Math.max(1, Math.round(width * scale));
+      canvas.height = Math.max(1, Math.round(height * scale));
+      gl.viewport(0, 0, canvas.width, canvas.height);
+    }
+
+    function draw(now) {
+      const t = (now - t0) * 0.001;
+      gl.disable(gl.BLEND);
+      gl.useProgram(nebula);
+      gl.bindBuffer(gl.ARRAY_BUFFER, quadBuf);
+      gl.enableVertexAttribArray(nebulaLoc.aPos);
+      gl.vertexAttribPointer(nebulaLoc.aPos, 2, gl.FLOAT, false, 0, 0);
+      gl.uniform2f(nebulaLoc.iRes, canvas.width, canvas.height);
+      gl.uniform1f(nebulaLoc.iTime, t);
+      gl.uniform1i(nebulaLoc.iOctaves, LEVELS[level].octaves);
+      gl.drawArrays(gl.TRIANGLE_STRIP, 0, 4);
+      gl.disableVertexAttribArray(nebulaLoc.aPos);
+
+      gl.enable(gl.BLEND);
+      gl.blendFunc(gl.SRC_ALPHA, gl.ONE_MINUS_SRC_ALPHA);
+      gl.useProgram(starProg);
+      gl.bindBuffer(gl.ARRAY_BUFFER, starBuf);
+      starLoc.attrs.forEach((loc, i) => {
+        gl.enableVertexAttribArray(loc);
+        gl.vertexAttribPointer(loc, i === 0 ? 2 : 1, gl.FLOAT, false, 20, [0, 8, 12, 16][i]);
+      });
+      // 解像度を下げても星の見かけの大きさは変えない
+      const ratio = Math.max(1, Math.min(2, (width + height) / 1000)) * Math.min(1, canvas.width / width);
+      gl.uniform1f(starLoc.iRatio, ratio);
+      gl.uniform2f(starLoc.iDrift, Math.sin(t * 0.02) * 0.002, Math.cos(t * 0.015) * 0.002); // ごく僅かなパララックス・ドリフト
+      gl.uniform1f(starLoc.iTime, t);
+      gl.drawArrays(gl.POINTS, 0, starCount);
+      starLoc.attrs.forEach((loc) => gl.disableVertexAttribArray(loc));
+    }
+
+    function setLevel(next) {
+      next = Math.max(0, Math.min(LEVELS.length - 1, next));
+      if (next === level) return;
+      level = next;
+      applySize();
+    }
+
+    // 評価区間ごとに: 予定より遅れたフレームが多い・メインスレッドに長いタスクがある → 1段下げる
+    //                 余裕のある区間が UPGRADE_WINDOWS 回続いた → 1段上げる
+    function adapt(now) {
+      if (now - windowStart < WINDOW_MS) return;
+      const sorted = intervals.slice().sort((a, b) => a - b);
+      const budget = 1000 / LEVELS[level].fps;
+      const late = intervals.filter((dt) => dt > budget * 1.5).length / Math.max(1, intervals.length);
+      const stats = {
+        type: "stats", level, fps: Math.round(frames * 1000 / (now - windowStart)),
+        p50: +percentile(sorted, 0.5).toFixed(1), p95: +percentile(sorted, 0.95).toFixed(1),
+        drawMs: +(drawMs / Math.max(1, frames)).toFixed(2), late: +late.toFixed(2), pressure,
+        width: canvas.width, height: canvas.height, octaves: LEVELS[level].octaves,
+      };
+      if (!fixed) {
+        if (late > 0.2 || pressure > 0) {
+          setLevel(level + 1);
+          calm = -UPGRADE_WINDOWS; // 下げた直後はしばらく上げない
+        } else if (late < 0.02 && ++calm >= UPGRADE_WINDOWS) {
+          setLevel(level - 1);
+          calm = 0;
+        }
+      }
+      if (opts.report) emit(stats);
+      intervals = []; drawMs = 0; frames = 0; pressure = 0; windowStart = now;
+    }
+
+    function frame(now) {
+      if (pauses.size) { running = false; return; }
+      raf(frame);
+      const minInterval = 1000 / LEVELS[level].fps;
+      if (lastDraw && now - lastDraw < minInterval - 2) return; // FPS 上限
+      if (lastDraw) intervals.push(now - lastDraw);
+      lastDraw = now;
+      const started = performance.now();
+      draw(now);
+      drawMs += performance.now() - started;
+      frames++;
+      adapt(now);
+    }
+
+    function start() {
+      if (running || pauses.size) return;
+      running = true;
+      lastDraw = 0; intervals = []; windowStart = performance.now();
+      raf(frame);
+    }
+
+    function handle(msg) {
+      switch (msg.type) {
+        case "resize":
+          width = msg.width; height = msg.height; dpr = msg.dpr || dpr;
+          applySize();
+          if (!running) draw(performance.now()); // 止まっていても大きさは合わせる
+          break;
+        case "pause":
+          if (msg.on) pauses.add(msg.reason); else pauses.delete(msg.reason);
+          start();
+          break;
+        case "pressure":
+          pressure += msg.longTasks || 0;
+          break;
+        case "level":
+          setLevel(msg.level);
+          break;
+      }
+    }
+
+    applySize();
+    draw(performance.now()); // 止まった状態で始まっても1枚は描く
+    start();
+    return { handle, levels: LEVELS };
+  }
+
+  root.SpaceBg = { create, LEVELS };
+})(typeof self !== "undefined" ? self : window);
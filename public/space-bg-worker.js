@@ -0,0 +1,16 @@
+// 背景の描画をメインスレッドから外すワーカー。custom.js から OffscreenCanvas を受け取って space-bg-renderer.js で描く。
+importScripts("space-bg-renderer.js");
+
+let bg = null;
+self.onmessage = (e) => {
+  const msg = e.data;
+  if (msg.type === "init") {
+    try {
+      bg = self.SpaceBg.create(msg.canvas, msg, (m) => self.postMessage(m));
+    } catch (err) {
+      self.postMessage({ type: "error", message: String(err) });
+    }
+  } else if (bg) {
+    bg.handle(msg);
+  }
+};
@@ -0,0 +1,188 @@
+"""アップロード文書のローカル BM25 検索（NumPy / SciPy sparse によるベクトル化スコアリング）。"""
+import asyncio
+import os
+import re
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional
+
+import numpy as np
+from scipy import sparse
+
+# チャンク分割（文字数ベース）
+CHUNK_SIZE = int(os.getenv("RAG_CHUNK_SIZE", "800"))
+CHUNK_OVERLAP = int(os.getenv("RAG_CHUNK_OVERLAP", "100"))
+# プロンプトへ差し込むチャンク数
+TOP_K = int(os.getenv("RAG_TOP_K", "4"))
+# BM25 パラメータ
+BM25_K1 = 1.5
+BM25_B = 0.75
+
+INDEXABLE_MIME = ("text/plain", "text/markdown", "text/x-markdown", "application/pdf")
+INDEXABLE_EXT = (".txt", ".md", ".markdown", ".pdf")
+
+_WORD_RE = re.compile(r"[a-z0-9_]+")
+_CJK_RE = re.compile(r"[぀-ヿ㐀-䶿一-鿿豈-﫿ｦ-ﾟ]+")
+
+
+def is_indexable(name: str, mime: Optional[str]) -> bool:
+    return (mime or "") in INDEXABLE_MIME or (name or "").lower().endswith(INDEXABLE_EXT)
+
+
+def tokenize(text: str) -> list[str]:
+    """英数字は単語、日本語（CJK）は文字バイグラムでトークン化する。"""
+    t = (text or "").lower()
+    tokens = _WORD_RE.findall(t)
+    for run in _CJK_RE.findall(t):
+        if len(run) == 1:
+            tokens.append(run)
+        else:
+            tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+    return tokens
+
+
+def extract_text(path: str, name: str = "", mime: Optional[str] = None) -> str:
+    """テキスト / Markdown / PDF から本文を取り出す。"""
+    if (mime == "application/pdf") or (name or path).lower().endswith(".pdf"):
+        try:
+            from pypdf import PdfReader
+        except ImportError:
+            print("[RAG] pypdf が未インストールのため PDF を索引化できません")
+            return ""
+        reader = PdfReader(path)
+        return "\n".join((page.extract_text() or "") for page in reader.pages)
+    with open(path, "r", encoding="utf-8", errors="replace") as f:
+        return f.read()
+
+
+def chunk_text(text: str, size: int = CHUNK_SIZE, overlap: int = CHUNK_OVERLAP) -> list[str]:
+    """段落境界を優先しつつ、固定長＋オーバーラップで分割する。"""
+    text = (text or "").strip()
+    if not text:
+        return []
+    chunks = []
+    start = 0
+    step = max(1, size - overlap)
+    while start < len(text):
+        end = min(len(text), start + size)
+        if end < len(text):
+            cut = text.rfind("\n\n", start + step // 2, end)
+            if cut != -1:
+                end = cut
+        chunk = text[start:end].strip()
+        if chunk:
+            chunks.append(chunk)
+        if end >= len(text):
+            break
+        start = max(end - overlap, start + 1)
+    return chunks
+
+
+def prepare_document(path: str, name: str, mime: Optional[str]) -> list[tuple[str, list[str]]]:
+    """（プロセスプール上で実行）文書を読み込み、チャンクとトークン列を返す。"""
+    text = extract_text(path, name, mime)
+    return [(chunk, tokenize(chunk)) for chunk in chunk_text(text)]
+
+
+class BM25Index:
+    """追記型の BM25 インデックス。
+
+    チャンクの追加は語彙 ID と頻度の配列を積むだけで、重み行列は次の検索時に
+    まとめて（ベクトル化して）再計算する。
+    """
+
+    def __init__(self, k1: float = BM25_K1, b: float = BM25_B):
+        self.k1 = k1
+        self.b = b
+        self.vocab: dict[str, int] = {}
+        self.chunks: list[dict] = []
+        self.doc_ids: set[str] = set()
+        self._term_ids: list[np.ndarray] = []
+        self._term_tfs: list[np.ndarray] = []
+        self._weights: Optional[sparse.csc_matrix] = None
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.chunks)
+
+    def add_chunks(self, doc_id: str, source: str, prepared: list[tuple[str, list[str]]]) -> int:
+        """前処理済みチャンクを追加する。同じ doc_id は一度だけ追加する。"""
+        with self._lock:
+            if doc_id in self.doc_ids:
+                return 0
+            self.doc_ids.add(doc_id)
+            for text, tokens in prepared:
+                ids = [self.vocab.setdefault(tok, len(self.vocab)) for tok in tokens]
+                uniq, counts = np.unique(np.asarray(ids, dtype=np.int64), return_counts=True)
+                self._term_ids.append(uniq)
+                self._term_tfs.append(counts.astype(np.float32))
+                self.chunks.append({"doc_id": doc_id, "source": source, "text": text})
+            self._weights = None
+            return len(prepared)
+
+    def _build(self) -> sparse.csc_matrix:
+        n_docs = len(self._term_ids)
+        n_terms = max(1, len(self.vocab))
+        lengths = np.fromiter((len(ids) for ids in self._term_ids), dtype=np.int64, count=n_docs)
+        rows = np.repeat(np.arange(n_docs, dtype=np.int64), lengths)
+        cols = np.concatenate(self._term_ids) if n_docs else np.zeros(0, dtype=np.int64)
+        tfs = np.concatenate(self._term_tfs) if n_docs else np.zeros(0, dtype=np.float32)
+
+        dl = np.bincount(rows, weights=tfs, minlength=n_docs)
+        avgdl = dl.mean() if n_docs else 1.0
+        df = np.bincount(cols, minlength=n_terms)
+        idf = np.log1p((n_docs - df + 0.5) / (df + 0.5)).astype(np.float32)
+
+        norm = self.k1 * (1 - self.b + self.b * dl[rows] / (avgdl or 1.0))
+        data = idf[cols] * tfs * (self.k1 + 1) / (tfs + norm)
+        return sparse.csc_matrix((data.astype(np.float32), (rows, cols)), shape=(n_docs, n_terms))
+
+    def search(self, query: str, k: int = TOP_K) -> list[tuple[float, dict]]:
+        with self._lock:
+            if not self.chunks:
+                return []
+            if self._weights is None:
+                self._weights = self._build()
+            weights = self._weights
+            term_ids = sorted({self.vocab[t] for t in tokenize(query) if t in self.vocab})
+        if not term_ids:
+            return []
+        scores = np.asarray(weights[:, term_ids].sum(axis=1)).ravel()
+        k = min(k, scores.shape[0])
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(float(scores[i]), self.chunks[i]) for i in top if scores[i] > 0]
+
+
+# 全セッション共有のインデックス（RAG_SHARED_INDEX=1 のときに利用）
+SHARED_INDEX_ENABLED = os.getenv("RAG_SHARED_INDEX", "0") == "1"
+shared_index = BM25Index()
+
+_pool: Optional[ProcessPoolExecutor] = None
+
+
+def _get_pool() -> ProcessPoolExecutor:
+    global _pool
+    if _pool is None:
+        _pool = ProcessPoolExecutor(max_workers=int(os.getenv("RAG_WORKERS", "2")))
+    return _pool
+
+
+async def index_file(index: BM25Index, doc_id: str, path: str, name: str, mime: Optional[str]) -> int:
+    """文書の読み込み・分割・トークン化をプロセスプールで行い、インデックスに追加する。"""
+    if doc_id in index.doc_ids:
+        return 0
+    loop = asyncio.get_running_loop()
+    prepared = await loop.run_in_executor(_get_pool(), prepare_document, path, name, mime)
+    return index.add_chunks(doc_id, name, prepared)
+
+
+def format_context(hits: list[tuple[float, dict]]) -> str:
+    """検索結果をシステムプロンプトへ差し込む形式に整形する。"""
+    if not hits:
+        return ""
+    blocks = [f"[{i}] ({h['source']})\n{h['text']}" for i, (_, h) in enumerate(hits, 1)]
+    return (
+        "以下はユーザーがアップロードした文書から検索した関連箇所です。回答に必要な場合のみ参照してください。\n\n"
+        + "\n\n".join(blocks)
+    )
@@ -0,0 +1,156 @@
+# ローカル検証用の Batch API スタブ（batch_jobs.py のジョブの一連の流れを API キーなしで確認する）
+# 起動:  python samplecode/batch_stub_server.py            (http://127.0.0.1:8766)
+# 接続:  BATCH_OPENAI_BASE_URL=http://127.0.0.1:8766/openai/v1
+#        BATCH_ANTHROPIC_BASE_URL=http://127.0.0.1:8766/anthropic
+# バッチは STUB_BATCH_SECONDS 秒後に完了する。プロンプトに "FAIL" を含むリクエストはエラーとして返す。
+import json
+import os
+import time
+import uuid
+
+import uvicorn
+from fastapi import FastAPI, File, Form, HTTPException, Request, UploadFile
+from fastapi.responses import PlainTextResponse
+
+STUB_BATCH_SECONDS = float(os.getenv("STUB_BATCH_SECONDS", "3"))
+
+app = FastAPI()
+files: dict[str, dict] = {}
+openai_batches: dict[str, dict] = {}
+anthropic_batches: dict[str, dict] = {}
+
+
+def _answer(model: str, prompt: str) -> str:
+    return f"[stub:{model}] {prompt[:200]}"
+
+
+# --- OpenAI: /v1/files, /v1/batches ---
+@app.post("/openai/v1/files")
+async def create_file(file: UploadFile = File(...), purpose: str = Form(...)):
+    data = await file.read()
+    file_id = f"file-{uuid.uuid4().hex[:12]}"
+    files[file_id] = {"data": data, "filename": file.filename, "purpose": purpose}
+    return {"id": file_id, "object": "file", "bytes": len(data), "created_at": int(time.time()),
+            "filename": file.filename, "purpose": purpose, "status": "processed"}
+
+
+@app.get("/openai/v1/files/{file_id}/content")
+async def file_content(file_id: str):
+    if file_id not in files:
+        raise HTTPException(404, "file not found")
+    return PlainTextResponse(files[file_id]["data"].decode("utf-8"))
+
+
+def _openai_batch_view(batch: dict) -> dict:
+    elapsed = time.time() - batch["created_at"]
+    if batch["status"] == "in_progress" and elapsed >= STUB_BATCH_SECONDS:
+        ok_lines, err_lines = [], []
+        for line in files[batch["input_file_id"]]["data"].decode("utf-8").splitlines():
+            if not line.strip():
+                continue
+            req = json.loads(line)
+            prompt = req["body"]["input"][-1]["content"]
+            if "FAIL" in prompt:
+                err_lines.append({"id": f"resp-{uuid.uuid4().hex[:8]}", "custom_id": req["custom_id"], "response": None,
+                                  "error": {"code": "stub_error", "message": "requested failure"}})
+                continue
+            body = {
+                "id": f"resp_{uuid.uuid4().hex[:12]}", "object": "response", "model": req["body"]["model"],
+                "output": [{"type": "message", "role": "assistant",
+                            "content": [{"type": "output_text", "text": _answer(req["body"]["model"], prompt)}]}],
+                "usage": {"input_tokens": len(prompt.split()), "output_tokens": len(prompt.split()) + 1},
+            }
+            ok_lines.append({"id": f"resp-{uuid.uuid4().hex[:8]}", "custom_id": req["custom_id"],
+                             "response": {"status_code": 200, "request_id": uuid.uuid4().hex, "body": body}, "error": None})
+        for key, lines in (("output_file_id", ok_lines), ("error_file_id", err_lines)):
+            if lines:
+                file_id = f"file-{uuid.uuid4().hex[:12]}"
+                files[file_id] = {"data": "".join(json.dumps(l) + "\n" for l in lines).encode("utf-8"),
+                                  "filename": f"{key}.jsonl", "purpose": "batch_output"}
+                batch[key] = file_id
+        batch["status"] = "completed"
+        batch["completed_at"] = int(time.time())
+        batch["request_counts"] = {"total": len(ok_lines) + len(err_lines), "completed": len(ok_lines), "failed": len(err_lines)}
+    return batch
+
+
+@app.post("/openai/v1/batches")
+async def create_openai_batch(request: Request):
+    body = await request.json()
+    if body.get("input_file_id") not in files:
+        raise HTTPException(400, "unknown input_file_id")
+    batch_id = f"batch_{uuid.uuid4().hex[:12]}"
+    openai_batches[batch_id] = {
+        "id": batch_id, "object": "batch", "endpoint": body["endpoint"], "input_file_id": body["input_file_id"],
+        "completion_window": body["completion_window"], "status": "in_progress", "created_at": int(time.time()),
+        "output_file_id": None, "error_file_id": None,
+        "request_counts": {"total": 0, "completed": 0, "failed": 0},
+    }
+    return openai_batches[batch_id]
+
+
+@app.get("/openai/v1/batches/{batch_id}")
+async def get_openai_batch(batch_id: str):
+    if batch_id not in openai_batches:
+        raise HTTPException(404, "batch not found")
+    return _openai_batch_view(openai_batches[batch_id])
+
+
+# --- Anthropic: /v1/messages/batches ---
+def _anthropic_batch_view(batch: dict, request: Request) -> dict:
+    view = {k: v for k, v in batch.items() if k != "requests"}
+    if time.time() - batch["_created"] >= STUB_BATCH_SECONDS:
+        failed = sum("FAIL" in r["params"]["messages"][-1]["content"] for r in batch["requests"])
+        view.update(processing_status="ended", ended_at=view["created_at"],
+                    results_url=str(request.base_url) + f"anthropic/v1/messages/batches/{batch['id']}/results",
+                    request_counts={"processing": 0, "succeeded": len(batch["requests"]) - failed, "errored": failed,
+                                    "canceled": 0, "expired": 0})
+    view.pop("_created", None)
+    return view
+
+
+@app.post("/anthropic/v1/messages/batches")
+async def create_anthropic_batch(request: Request):
+    body = await request.json()
+    batch_id = f"msgbatch_{uuid.uuid4().hex[:12]}"
+    now = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
+    anthropic_batches[batch_id] = {
+        "id": batch_id, "type": "message_batch", "processing_status": "in_progress",
+        "request_counts": {"processing": len(body["requests"]), "succeeded": 0, "errored": 0, "canceled": 0, "expired": 0},
+        "created_at": now, "expires_at": now, "ended_at": None, "archived_at": None, "cancel_initiated_at": None,
+        "results_url": None, "requests": body["requests"], "_created": time.time(),
+    }
+    return _anthropic_batch_view(anthropic_batches[batch_id], request)
+
+
+@app.get("/anthropic/v1/messages/batches/{batch_id}")
+async def get_anthropic_batch(batch_id: str, request: Request):
+    if batch_id not in anthropic_batches:
+        raise HTTPException(404, "batch not found")
+    return _anthropic_batch_view(anthropic_batches[batch_id], request)
+
+
+@app.get("/anthropic/v1/messages/batches/{batch_id}/results")
+async def anthropic_results(batch_id: str):
+    batch = anthropic_batches.get(batch_id)
+    if batch is None:
+        raise HTTPException(404, "batch not found")
+    lines = []
+    for req in reversed(batch["requests"]):  # 本物と同じく順不同で返す
+        params = req["params"]
+        prompt = params["messages"][-1]["content"]
+        if "FAIL" in prompt:
+            result = {"type": "errored", "error": {"type": "error", "error": {"type": "invalid_request_error", "message": "requested failure"}}}
+        else:
+            result = {"type": "succeeded", "message": {
+                "id": f"msg_{uuid.uuid4().hex[:12]}", "type": "message", "role": "assistant", "model": params["model"],
+                "content": [{"type": "text", "text": _answer(params["model"], prompt)}],
+                "stop_reason": "end_turn", "stop_sequence": None,
+                "usage": {"input_tokens": len(prompt.split()), "output_tokens": len(prompt.split()) + 1},
+            }}
+        lines.append(json.dumps({"custom_id": req["custom_id"], "result": result}))
+    return PlainTextResponse("\n".join(lines) + "\n", media_type="application/binary")
+
+
+if __name__ == "__main__":
+    uvicorn.run(app, host="127.0.0.1", port=int(os.getenv("STUB_PORT", "8766")))
@@ -0,0 +1,32 @@
+# ローカル検証用の MCP スタブサーバー（mcp_pool.py の動作確認に使う）
+# stdio:            python samplecode/mcp_stub_server.py
+# streamable-http:  python samplecode/mcp_stub_server.py http   (http://127.0.0.1:8765/mcp)
+import asyncio
+import sys
+
+from mcp.server.fastmcp import FastMCP
+
+server = FastMCP("stub", host="127.0.0.1", port=8765)
+
+
+@server.tool()
+def echo(text: str) -> str:
+    """入力をそのまま返す。"""
+    return text
+
+
+@server.tool()
+def add(a: int, b: int) -> int:
+    """2つの整数を足す。"""
+    return a + b
+
+
+@server.tool()
+async def sleep(seconds: float) -> str:
+    """指定秒数待ってから返す（並列実行の確認用）。"""
+    await asyncio.sleep(seconds)
+    return f"slept {seconds}s"
+
+
+if __name__ == "__main__":
+    server.run("streamable-http" if len(sys.argv) > 1 and sys.argv[1] == "http" else "stdio")
@@ -0,0 +1,262 @@
+"""過去の会話の全文検索（SQLite FTS5）。
+
+ターンの終わりにユーザー発話・応答・応答中のコードブロック・スライドのタイトルをキューに積み、
+バックグラウンドでまとめて SEARCH_DB_PATH に追記する（ターンは書き込みを待たない）。
+- 日本語は単語で区切れないので trigram トークナイザーを使う（3文字以上の語は索引で引ける）
+- 2文字以下の語は部分一致（LIKE）で絞り込む。この語だけの検索は新しい順に走査するので遅くなることがある
+- FTS5 の bm25() は語の全体での出現数を数えるので、よくある語ほど遅くなる。そこで索引からは新しい順に
+  SEARCH_CANDIDATES 件だけ取り出し、その中で BM25 の順位を付ける（該当が少ない語は全件が順位付けの対象）
+- 利用者ごとの絞り込みも索引で行う（owner 列に利用者IDのハッシュを入れる。未ログインの利用者はセッション単位）
+- スレッドの削除・セッションの終了（未ログイン）・保存期間切れで行を消す。削除も書き込みと同じキューで順に行う
+- 書き込みは専用スレッドの1接続で行い、検索はスレッドごとの読み取り接続で行う（WAL なので互いを待たない）
+"""
+import asyncio
+import hashlib
+import math
+import os
+import re
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Optional
+
+SEARCH_INDEX_ENABLED = os.getenv("SEARCH_INDEX_ENABLED", "1") != "0"
+SEARCH_DB_PATH = os.getenv("SEARCH_DB_PATH", os.path.join(".files", "search.db"))
+SEARCH_TOP_K = int(os.getenv("SEARCH_TOP_K", "10"))
+SEARCH_BATCH = int(os.getenv("SEARCH_BATCH", "200"))
+SEARCH_INTERVAL_SEC = float(os.getenv("SEARCH_INTERVAL_SEC", "0.5"))
+# 順位付けの対象にする、新しい順の候補の件数
+SEARCH_CANDIDATES = int(os.getenv("SEARCH_CANDIDATES", "500"))
+# これより古い行は消す（0 なら消さない）。確認は書き込みのついでに1時間ごと
+SEARCH_RETENTION_DAYS = float(os.getenv("SEARCH_RETENTION_DAYS", "90"))
+PRUNE_INTERVAL_SEC = 3600
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS docs (
+    id INTEGER PRIMARY KEY,
+    owner TEXT NOT NULL,
+    thread_id TEXT,
+    session_id TEXT,
+    kind TEXT NOT NULL,
+    created REAL NOT NULL,
+    text TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS docs_owner ON docs(owner, id);
+CREATE INDEX IF NOT EXISTS docs_thread ON docs(thread_id);
+CREATE INDEX IF NOT EXISTS docs_created ON docs(created);
+CREATE VIRTUAL TABLE IF NOT EXISTS docs_fts USING fts5(owner, text, content='docs', content_rowid='id', tokenize='trigram');
+CREATE TRIGGER IF NOT EXISTS docs_ai AFTER INSERT ON docs BEGIN
+    INSERT INTO docs_fts(rowid, owner, text) VALUES (new.id, new.owner, new.text);
+END;
+CREATE TRIGGER IF NOT EXISTS docs_ad AFTER DELETE ON docs BEGIN
+    INSERT INTO docs_fts(docs_fts, rowid, owner, text) VALUES ('delete', old.id, old.owner, old.text);
+END;
+"""
+# 削除できる条件（列名 -> WHERE 句）
+_DELETE_WHERE = {"thread_id": "thread_id = ?", "owner": "owner = ?", "created": "created < ?"}
+
+KIND_LABELS = {"user": "質問", "assistant": "回答", "code": "コード", "slide": "スライド"}
+
+
+@dataclass
+class SearchHit:
+    kind: str
+    thread_id: Optional[str]
+    created: float
+    snippet: str
+    score: float
+
+
+def _connect(path: str) -> sqlite3.Connection:
+    conn = sqlite3.connect(path, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
+
+
+def owner_key(user_id: str) -> str:
+    # 長さをそろえる（trigram の部分一致で別の利用者のIDに当たらないように）
+    return hashlib.sha256((user_id or "").encode()).hexdigest()[:16]
+
+
+def _phrase(term: str) -> str:
+    return '"' + term.replace('"', '""') + '"'
+
+
+def _rank(rows: list, terms: list[str], k1: float = 1.2, b: float = 0.75) -> list[tuple[float, tuple]]:
+    """候補の中での BM25（語の出現数は部分一致で数える）。同点は新しい順のまま。"""
+    lowered = [row[-1].lower() for row in rows]
+    avg_len = sum(len(t) for t in lowered) / len(lowered)
+    scored = [0.0] * len(rows)
+    for term in (t.lower() for t in terms):
+        counts = [text.count(term) for text in lowered]
+        df = sum(1 for c in counts if c)
+        idf = math.log(1 + (len(rows) - df + 0.5) / (df + 0.5))
+        for i, tf in enumerate(counts):
+            if tf:
+                scored[i] += idf * tf * (k1 + 1) / (tf + k1 * (1 - b + b * len(lowered[i]) / avg_len))
+    order = sorted(range(len(rows)), key=lambda i: -scored[i])
+    return [(scored[i], rows[i]) for i in order]
+
+
+def _like_snippet(text: str, terms: list[str], width: int = 40) -> str:
+    lowered = text.lower()
+    pos = min((p for p in (lowered.find(t.lower()) for t in terms) if p >= 0), default=0)
+    start = max(0, pos - width)
+    snippet = text[start:pos + width * 2]
+    for t in terms:
+        snippet = re.sub(re.escape(t), lambda m: f"**{m.group(0)}**", snippet, flags=re.IGNORECASE)
+    return ("…" if start else "") + snippet + ("…" if pos + width * 2 < len(text) else "")
+
+
+class SearchIndex:
+    """add() でキューに積み、バックグラウンドで FTS5 に追記する。search() は別スレッドで検索する。"""
+
+    def __init__(self, path: str = SEARCH_DB_PATH, batch_size: int = SEARCH_BATCH, interval: float = SEARCH_INTERVAL_SEC):
+        self.path = path
+        self.batch_size = batch_size
+        self.interval = interval
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="search-writer")
+        self._write_conn: Optional[sqlite3.Connection] = None
+        self._local = threading.local()
+        self.stats = {"written": 0, "batches": 0, "dropped": 0, "deleted": 0}
+        self._pruned_at = 0.0
+
+    def _ensure_writer(self) -> None:
+        if self._queue is None:
+            self._queue = asyncio.Queue(maxsize=10_000)
+            self._task = asyncio.create_task(self._run(), name="search-indexer")
+
+    def add(self, user_id: str, thread_id: Optional[str], session_id: str, entries: list[tuple[str, str]]) -> None:
+        """entries: (kind, text) のリスト。待たずに戻る。"""
+        self._ensure_writer()
+        now = time.time()
+        for kind, text in entries:
+            if not text or not text.strip():
+                continue
+            try:
+                self._queue.put_nowait((owner_key(user_id), thread_id, session_id, kind, now, text))
+            except asyncio.QueueFull:
+                self.stats["dropped"] += 1  # 取りこぼしてもターンは止めない
+
+    async def delete_thread(self, thread_id: str) -> None:
+        """スレッドの行を消す（キューに積んだ書き込みの後で消える）。"""
+        if thread_id:
+            self._ensure_writer()
+            await self._queue.put(("thread_id", thread_id))
+
+    async def delete_owner(self, user_id: str) -> None:
+        """利用者（未ログインならセッション）の行をすべて消す。"""
+        self._ensure_writer()
+        await self._queue.put(("owner", owner_key(user_id)))
+
+    def write(self, rows: list[tuple]) -> None:
+        """（書き込みスレッドで実行）rows を1トランザクションで追記する。(列名, 値) の2要素の行はその条件で削除する。"""
+        if self._write_conn is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            self._write_conn = _connect(self.path)
+            self._write_conn.executescript(SCHEMA)
+        with self._write_conn:
+            pending = []
+            for row in rows:
+                if len(row) != 2:
+                    pending.append(row)
+                    continue
+                self._insert(pending)  # 削除より前に積まれた行を先に書く
+                pending = []
+                cur = self._write_conn.execute(f"DELETE FROM docs WHERE {_DELETE_WHERE[row[0]]}", (row[1],))
+                self.stats["deleted"] += cur.rowcount
+            self._insert(pending)
+        self.stats["written"] += sum(1 for row in rows if len(row) != 2)
+        self.stats["batches"] += 1
+
+    def _insert(self, rows: list[tuple]) -> None:
+        if rows:
+            self._write_conn.executemany(
+                "INSERT INTO docs(owner, thread_id, session_id, kind, created, text) VALUES (?, ?, ?, ?, ?, ?)", rows
+            )
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = time.monotonic() + self.interval
+            while len(batch) < self.batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            if SEARCH_RETENTION_DAYS > 0 and time.monotonic() - self._pruned_at > PRUNE_INTERVAL_SEC:
+                self._pruned_at = time.monotonic()
+                batch.append(("created", time.time() - SEARCH_RETENTION_DAYS * 86400))
+            try:
+                await loop.run_in_executor(self._writer, self.write, batch)
+            except Exception as e:
+                print(f"[Search] index write failed: {e}")
+
+    def _reader(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = _connect(self.path)
+        return conn
+
+    def query(self, user_id: str, text: str, limit: int = SEARCH_TOP_K) -> list[SearchHit]:
+        """（同期）関連度順の抜粋を返す。3文字以上の語は FTS5、それ未満の語は部分一致で絞り込む。"""
+        terms = [t for t in text.split() if t]
+        if not terms or not os.path.exists(self.path):
+            return []
+        owner = owner_key(user_id)
+        long_terms = [t for t in terms if len(t) >= 3]
+        short_terms = [t for t in terms if len(t) < 3]
+        like = "".join(" AND d.text LIKE ?" for _ in short_terms)
+        like_args = [f"%{t}%" for t in short_terms]
+        conn = self._reader()
+        try:
+            if long_terms:
+                match = f'owner:"{owner}" AND ' + " AND ".join(f"text:{_phrase(t)}" for t in long_terms)
+                rows = conn.execute(
+                    "SELECT d.kind, d.thread_id, d.created, d.text FROM docs_fts JOIN docs d ON d.id = docs_fts.rowid "
+                    f"WHERE docs_fts MATCH ?{like} ORDER BY docs_fts.rowid DESC LIMIT ?",
+                    [match, *like_args, SEARCH_CANDIDATES],
+                ).fetchall()
+            else:
+                rows = conn.execute(
+                    f"SELECT d.kind, d.thread_id, d.created, d.text FROM docs d WHERE d.owner = ?{like} ORDER BY d.id DESC LIMIT ?",
+                    [owner, *like_args, SEARCH_CANDIDATES],
+                ).fetchall()
+        except sqlite3.OperationalError as e:  # まだテーブルが無い（最初の書き込み前）など
+            print(f"[Search] query failed: {e}")
+            return []
+        if not rows:
+            return []
+        return [
+            SearchHit(kind, thread, created, _like_snippet(full, terms), round(score, 3))
+            for score, (kind, thread, created, full) in _rank(rows, terms)[:limit]
+        ]
+
+    async def search(self, user_id: str, text: str, limit: int = SEARCH_TOP_K) -> tuple[list[SearchHit], float]:
+        started = time.perf_counter()
+        hits = await asyncio.to_thread(self.query, user_id, text, limit)
+        return hits, (time.perf_counter() - started) * 1000
+
+
+def format_hits(hits: list[SearchHit], elapsed_ms: float) -> str:
+    if not hits:
+        return f"見つかりませんでした。（{elapsed_ms:.1f} ms）"
+    lines = [f"{len(hits)} 件（{elapsed_ms:.1f} ms）\n"]
+    for i, hit in enumerate(hits, 1):
+        when = time.strftime("%Y-%m-%d %H:%M", time.localtime(hit.created))
+        link = f" [スレッドを開く](/thread/{hit.thread_id})" if hit.thread_id else ""
+        snippet = " ".join(hit.snippet.split())
+        lines.append(f"{i}. `{KIND_LABELS.get(hit.kind, hit.kind)}` {when}{link}\n   {snippet}")
+    return "\n".join(lines)
+
+
+search_index = SearchIndex()
@@ -0,0 +1,137 @@
+"""同一リクエストのまとめ実行（single-flight）。
+
+同じキー（利用者の範囲・モデル・システムプロンプト・履歴・ツール設定が同じ）のリクエストが同時に来たら、上流へのストリームは1本だけ開き、
+そのイベントを待っている全員に配る。後から参加したものは、それまでにバッファしたイベントを先に再生してから合流する。
+上流のストリームは参加者とは別のタスクで動かし、参加者が全員いなくなったら止める。
+使用量は参加者ではなく上流1本ごとに、終わったときに1回だけ記録する（on_finish）。
+"""
+import asyncio
+import hashlib
+import json
+import os
+from typing import AsyncIterator, Callable, Optional
+
+from providers import TurnRequest, TurnResult
+
+SINGLEFLIGHT_ENABLED = os.getenv("SINGLEFLIGHT_ENABLED", "1") != "0"
+# 完了後もしばらく結果を残して、直後に来た同じリクエストにも再生する秒数（0 なら完了時に破棄）
+SINGLEFLIGHT_LINGER_SEC = float(os.getenv("SINGLEFLIGHT_LINGER_SEC", "0"))
+# まとめる範囲: "user" = 同じユーザー（未ログインなら同じセッション）の中だけ、"global" = 別のユーザーとも共有する
+SINGLEFLIGHT_SCOPE = os.getenv("SINGLEFLIGHT_SCOPE", "user")
+
+Starter = Callable[[TurnResult], AsyncIterator[tuple[str, str]]]
+FinishHook = Callable[["Flight"], None]
+
+
+def coalesce_key(req: TurnRequest, scope: str = "") -> Optional[str]:
+    """まとめてよいリクエストのキー。添付ファイル付きのものはまとめない（None）。
+
+    scope が違うリクエストはまとめない（呼び出し側でユーザー / セッションを渡す）。
+    """
+    if req.attachments:
+        return None
+    payload = {
+        "scope": scope,
+        "provider": req.provider,
+        "model": req.model,
+        "system": req.system_prompt,
+        "doc": req.doc_context,
+        "history": [(type(m).__name__, m.content) for m in req.history],
+        "tools": sorted(req.tool_kinds),
+        # OpenAI は previous_response_id で会話をつなぐので、それも同じでなければならない
+        "previous": req.state.get("previous_response_id") if req.provider == "openai" else None,
+    }
+    return hashlib.sha256(json.dumps(payload, ensure_ascii=False, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+class Flight:
+    """1本の上流ストリームと、そのイベントのバッファ。"""
+
+    def __init__(self, key: str):
+        self.key = key
+        self.result = TurnResult()
+        self.events: list[tuple[str, str]] = []
+        self.done = False
+        self.error: Optional[BaseException] = None
+        self.subscribers = 0
+        self.joined = 0  # 参加した延べ数（計測用）
+        self.task: Optional[asyncio.Task] = None
+        self.on_finish: Optional[FinishHook] = None
+        self._changed = asyncio.Event()
+
+    def _notify(self) -> None:
+        changed, self._changed = self._changed, asyncio.Event()
+        changed.set()
+
+    async def _run(self, start: Starter) -> None:
+        try:
+            async for event in start(self.result):
+                self.events.append(event)
+                self._notify()
+        except asyncio.CancelledError:
+            self.error = asyncio.CancelledError()
+        except Exception as e:
+            self.error = e
+        finally:
+            self.done = True
+            self._notify()
+
+    async def subscribe(self) -> AsyncIterator[tuple[str, str]]:
+        """バッファ済みのイベントを再生し、その後は届いた順に返す。上流のエラーはそのまま送出する。"""
+        self.subscribers += 1
+        self.joined += 1
+        index = 0
+        try:
+            while True:
+                while index < len(self.events):
+                    yield self.events[index]
+                    index += 1
+                if self.done:
+                    if self.error is not None:
+                        raise self.error
+                    return
+                await self._changed.wait()
+        finally:
+            self.subscribers -= 1
+            if self.subscribers == 0 and not self.done and self.task is not None:
+                self.task.cancel()  # 誰も待っていない上流は止める
+
+
+class SingleFlight:
+    def __init__(self, linger: float = SINGLEFLIGHT_LINGER_SEC):
+        self.linger = linger
+        self._flights: dict[str, Flight] = {}
+        self.upstream_calls = 0
+        self.coalesced = 0
+
+    def join(self, key: str, start: Starter, on_finish: Optional[FinishHook] = None) -> tuple[Flight, bool]:
+        """key の Flight に参加する。無ければ start で上流を開く。戻り値の bool は自分が上流を開いたか。
+
+        on_finish は上流を開いたときだけ使い、上流が終わったとき（完了・エラー・全員が抜けて止めたとき）に1回だけ呼ぶ。
+        """
+        flight = self._flights.get(key)
+        if flight is not None and not (flight.done and flight.error is not None):
+            self.coalesced += 1
+            return flight, False
+        flight = Flight(key)
+        flight.on_finish = on_finish
+        self._flights[key] = flight
+        self.upstream_calls += 1
+        flight.task = asyncio.create_task(flight._run(start), name=f"singleflight-{key[:8]}")
+        flight.task.add_done_callback(lambda _: self._finish(flight))
+        return flight, True
+
+    def _finish(self, flight: Flight) -> None:
+        if flight.on_finish is not None:
+            try:
+                flight.on_finish(flight)
+            except Exception as e:
+                print(f"[SingleFlight] on_finish failed: {e}")
+        if flight.error is not None or self.linger <= 0:
+            self._forget(flight)
+        else:
+            asyncio.get_running_loop().call_later(self.linger, self._forget, flight)
+
+    def _forget(self, flight: Flight) -> None:
+        if self._flights.get(flight.key) is flight:
+            del self._flights[flight.key]
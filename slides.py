@@ -0,0 +1,120 @@
+"""SlidePreview へのスライド送信（1回だけ検証したスライド配列を、番号付きの小さな更新で届ける）。
+
+データレイヤーには送り終えた時点の全スライドを1回だけ保存する。
+"""
+import json
+import os
+import uuid
+from dataclasses import dataclass, field
+from typing import Optional
+
+import chainlit as cl
+from chainlit.data import get_data_layer
+
+# 1回の更新で送るスライド数（最初の更新で先頭を送り、表示を待たせない）
+SLIDE_BATCH_SIZE = int(os.getenv("SLIDE_BATCH_SIZE", "20"))
+SLIDE_KEYS = ("title", "content", "directives", "notes")
+
+
+def normalize_slides(data) -> Optional[list[dict]]:
+    """パース済みの JSON をスライド配列として検証・正規化する。スライドが無ければ None。"""
+    if isinstance(data, dict) and isinstance(data.get("slides"), list):
+        data = data["slides"]
+    if not isinstance(data, list):
+        return None
+    slides = []
+    for item in data:
+        if isinstance(item, str):
+            slides.append({"content": item})
+        elif isinstance(item, dict):
+            slide = {k: item[k] for k in SLIDE_KEYS if item.get(k) is not None}
+            for k in ("title", "content", "notes"):
+                if k in slide and not isinstance(slide[k], str):
+                    slide[k] = str(slide[k])
+            if slide:
+                slides.append(slide)
+    return slides
+
+
+@dataclass
+class SlideDeck:
+    """サイドバーに表示中のスライド（サーバー側の正本）。"""
+    deck_id: str
+    title: str
+    slides: list = field(default_factory=list)
+    seq: int = 0
+    element: Optional[cl.CustomElement] = None
+
+
+def _props(deck: SlideDeck, patch: dict) -> dict:
+    return {
+        "deckId": deck.deck_id,
+        "title": deck.title,
+        "count": len(deck.slides),
+        "seq": deck.seq,
+        "patch": {**patch, "base": deck.seq - 1},
+        "key": f"slide-preview-{deck.deck_id}",
+    }
+
+
+async def _send(deck: SlideDeck, patch: dict) -> None:
+    deck.seq += 1
+    props = _props(deck, patch)
+    if deck.element is None:
+        deck.element = cl.CustomElement(name="SlidePreview", props=props, display="inline")
+    deck.element.props = props
+    deck.element.content = json.dumps(props, ensure_ascii=False)
+    await cl.ElementSidebar.set_title(deck.title)
+    # サイドバーは key が前回と同じだと要素を差し替えない（21枚目以降の更新が届かない）ので、更新ごとに key を変える
+    await cl.ElementSidebar.set_elements([deck.element], key=f"{deck.deck_id}:{deck.seq}")
+
+
+async def _persist(deck: SlideDeck) -> None:
+    """全スライドを1回の reset として、画面上の要素と同じ id で保存する（読み込み直したときはこれだけで復元できる）。"""
+    data_layer = get_data_layer()
+    if data_layer is None or deck.element is None:
+        return
+    snapshot = cl.CustomElement(
+        id=deck.element.id,
+        name=deck.element.name,
+        props=_props(deck, {"op": "reset", "start": 0, "slides": deck.slides}),
+        display=deck.element.display,
+        for_id=deck.element.for_id,
+    )
+    try:
+        await data_layer.create_element(snapshot)
+    except Exception as e:
+        print(f"[Slides] failed to persist {deck.deck_id}: {e}")
+
+
+async def open_slide_deck(slides: list[dict], title: str = "Slide Preview") -> SlideDeck:
+    """新しいスライドを開く。先頭のまとまりを先に送り、残りは番号付きの更新で続けて送る。"""
+    deck = SlideDeck(deck_id=uuid.uuid4().hex[:12], title=title, slides=list(slides))
+    cl.user_session.set("slide_deck", deck)
+    await _send(deck, {"op": "reset", "start": 0, "slides": deck.slides[:SLIDE_BATCH_SIZE]})
+    for start in range(SLIDE_BATCH_SIZE, len(deck.slides), SLIDE_BATCH_SIZE):
+        await _send(deck, {"op": "set", "start": start, "slides": deck.slides[start:start + SLIDE_BATCH_SIZE]})
+    await _persist(deck)
+    return deck
+
+
+async def update_slide(deck: SlideDeck, index: int, slide: dict) -> bool:
+    """表示中のスライドの1枚だけを差し替える（末尾の次の番号なら追加）。送った後は全スライドを保存し直す。"""
+    normalized = normalize_slides([slide])
+    if not normalized or not (0 <= index <= len(deck.slides)):
+        return False
+    if index == len(deck.slides):
+        deck.slides.append(normalized[0])
+    else:
+        deck.slides[index] = normalized[0]
+    await _send(deck, {"op": "set", "start": index, "slides": normalized})
+    await _persist(deck)
+    return True
+
+
+async def resync_slide_deck(deck_id: str) -> None:
+    """クライアントが更新を取りこぼしたときに全スライドを送り直す。"""
+    deck: Optional[SlideDeck] = cl.user_session.get("slide_deck")
+    if deck is None or deck.deck_id != deck_id:
+        return
+    await _send(deck, {"op": "reset", "start": 0, "slides": deck.slides})
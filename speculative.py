@@ -0,0 +1,106 @@
+"""下書きモード: 遅いモデルの応答を待つ間、速いモデルの下書きを先に表示する。
+
+選択中のモデル（GPT-5 Pro、Claude Opus、Grok4 など DRAFT_TARGETS に該当するもの）へのリクエストと同時に、
+速いモデルへ同じ会話を送り、届いた下書きをすぐに流す。本来の応答の最初のトークンが届いた時点で下書きの
+ストリームを止め、表示を本来の応答で置き換える。下書きの分の料金は "chat (draft)" として別に記録する。
+"""
+import asyncio
+import os
+from contextlib import aclosing
+from dataclasses import replace
+from typing import AsyncIterator, Optional
+
+from providers import ProviderClients, TurnRequest
+
+# 設定パネルの「下書きモード」の初期値
+DRAFT_MODE_DEFAULT = os.getenv("DRAFT_MODE_DEFAULT", "0") == "1"
+# 下書きを出す対象のモデル（前方一致）
+DRAFT_TARGETS = tuple(
+    p.strip() for p in os.getenv("DRAFT_TARGETS", "gpt-5-pro,gpt-5-2025,claude-opus,grok-4-0709,gemini-2.5-pro").split(",") if p.strip()
+)
+# 下書きに使うモデルの候補（上から順に、API キーのあるもの）。DRAFT_MODEL="provider:model" で固定できる
+DRAFT_CANDIDATES = [
+    ("gemini", "gemini-2.5-flash-lite"),
+    ("grok", "grok-4-fast-non-reasoning-latest"),
+    ("openai", "gpt-5-nano-2025-08-07"),
+]
+if os.getenv("DRAFT_MODEL") and ":" in os.getenv("DRAFT_MODEL"):
+    DRAFT_CANDIDATES = [tuple(os.getenv("DRAFT_MODEL").split(":", 1))]
+DRAFT_INSTRUCTION = "\n\n（この回答はより詳しい回答が届くまでの下書きとして表示されます。要点だけを簡潔に答えてください。）"
+
+
+def wants_draft(model: str) -> bool:
+    return any(model.startswith(prefix) for prefix in DRAFT_TARGETS)
+
+
+def pick_draft_model(clients: ProviderClients, model: str) -> Optional[tuple[str, str]]:
+    for provider, candidate in DRAFT_CANDIDATES:
+        if candidate != model and clients.for_provider(provider) is not None:
+            return provider, candidate
+    return None
+
+
+def draft_request(req: TurnRequest, provider: str, model: str, state: dict) -> TurnRequest:
+    """本来のリクエストから下書き用のリクエストを作る。
+
+    添付ファイルの参照はプロバイダごとなので渡さず、ツールも使わない。
+    OpenAI は会話を previous_response_id でつなぐため、下書き同士の連鎖を作らないよう毎回最後の発話だけを送る。
+    """
+    return replace(
+        req,
+        provider=provider,
+        model=model,
+        system_prompt=req.system_prompt + DRAFT_INSTRUCTION,
+        attachments=[],
+        tool_kinds=set(),
+        openai_tools=[],
+        mcp=None,
+        state={} if provider == "openai" else state,
+    )
+
+
+async def draft_then_refine(
+    draft: AsyncIterator[tuple[str, str]], final: AsyncIterator[tuple[str, str]]
+) -> AsyncIterator[tuple[str, str]]:
+    """下書きと本来の応答を同時に読み、("draft", text) → ("token", text) の順に返す。
+
+    本来の応答の最初のトークンが届いたら下書きを止め、以降は本来の応答だけを返す（最初の ("token", ...) で
+    表示を置き換える）。ステータスは本来の応答のものだけを返す。下書きの失敗は無視する。
+    どちらも StreamPipe.stream() を渡す想定で、キューを1件にして送信が遅れた分はパイプ側でまとめさせる。
+    """
+    queue: asyncio.Queue = asyncio.Queue(maxsize=1)
+
+    async def pump(name: str, events: AsyncIterator[tuple[str, str]]) -> None:
+        try:
+            async with aclosing(events):
+                async for kind, text in events:
+                    await queue.put((name, kind, text))
+        except Exception as e:
+            await queue.put((name, "error", e))
+            return
+        await queue.put((name, "end", None))
+
+    draft_task = asyncio.create_task(pump("draft", draft), name="draft-stream")
+    final_task = asyncio.create_task(pump("final", final), name="final-stream")
+    refined = False
+    try:
+        while True:
+            name, kind, payload = await queue.get()
+            if name == "draft":
+                if kind == "token" and not refined:
+                    yield "draft", payload
+                elif kind == "error":
+                    print(f"[Draft] draft failed: {payload}")
+                continue
+            if kind == "end":
+                return
+            if kind == "error":
+                raise payload
+            if kind == "token" and not refined:
+                refined = True
+                draft_task.cancel()  # 本来の応答が届いたので下書きの生成（と課金）を止める
+            yield kind, payload
+    finally:
+        for task in (draft_task, final_task):
+            task.cancel()
+        await asyncio.gather(draft_task, final_task, return_exceptions=True)
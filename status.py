@@ -0,0 +1,80 @@
+"""セッションごとのステータス表示マネージャー（デバウンス＋最小表示時間をバックグラウンドで保証）。"""
+import asyncio
+import os
+import time
+from typing import Optional
+
+# 連続したステータス変更をまとめる時間
+STATUS_DEBOUNCE_SEC = float(os.getenv("STATUS_DEBOUNCE_SEC", "0.15"))
+# 表示したステータスを消すまでの最小表示時間（一瞬で消えてちらつくのを防ぐ）
+STATUS_MIN_DISPLAY_SEC = float(os.getenv("STATUS_MIN_DISPLAY_SEC", "0.3"))
+# 変化が続いていても、最初の変化からこの時間が経ったら最新の値を送る（デバウンスで表示が止まらないように）
+STATUS_MAX_WAIT_SEC = float(os.getenv("STATUS_MAX_WAIT_SEC", "1.0"))
+
+
+class StatusManager:
+    """set / clear は待たずに戻り、実際の送信はバックグラウンドタスクが行う。
+
+    - 短時間に何度も変わった場合は最後の値だけを送る（デバウンス。ただし max_wait を超えては待たない）
+    - 表示中のステータスを消すときは最小表示時間が経つまでタスク側で待つ
+    """
+
+    def __init__(
+        self,
+        emitter,
+        debounce: float = STATUS_DEBOUNCE_SEC,
+        min_display: float = STATUS_MIN_DISPLAY_SEC,
+        max_wait: float = STATUS_MAX_WAIT_SEC,
+    ):
+        self._emitter = emitter
+        self._debounce = debounce
+        self._min_display = min_display
+        self._max_wait = max_wait
+        self._desired = ""
+        self._shown = ""
+        self._shown_at = 0.0
+        self._changed = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    def set(self, text: str) -> None:
+        text = text or ""
+        if text == self._desired:
+            return  # 同じ文言の繰り返し（tool_call.delta ごとなど）はデバウンスを延ばさない
+        self._desired = text
+        self._changed.set()
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run(), name="status-manager")
+
+    def clear(self) -> None:
+        self.set("")
+
+    async def _emit(self, text: str) -> None:
+        try:
+            await self._emitter.set_status(text)
+        except Exception:
+            pass
+        self._shown = text
+        self._shown_at = time.monotonic()
+
+    async def _run(self) -> None:
+        deadline = time.monotonic() + self._max_wait
+        while self._changed.is_set():
+            self._changed.clear()
+            await asyncio.sleep(self._debounce)
+            if self._changed.is_set() and time.monotonic() < deadline:
+                continue  # まだ変化が続いているので最後の値を待つ
+            desired = self._desired
+            if not desired and self._shown:
+                remaining = self._min_display - (time.monotonic() - self._shown_at)
+                if remaining > 0:
+                    await asyncio.sleep(remaining)
+                    if self._changed.is_set():
+                        continue
+            if desired != self._shown:
+                await self._emit(desired)
+            deadline = time.monotonic() + self._max_wait
+
+    async def flush(self) -> None:
+        """（テスト・終了処理用）保留中の変更が送られるまで待つ。"""
+        if self._task is not None:
+            await self._task
@@ -0,0 +1,116 @@
+"""プロバイダの受信と画面への送信を分ける、ターンごとの生産者 / 消費者パイプ。
+
+生産者タスクはプロバイダのストリームを読み続けてバッファに積むだけで、画面への送信（WebSocket）を待たない。
+消費者（on_message のループ）は送信が終わるたびに溜まっている差分をまとめて1回で送るので、
+クライアントが遅いと送信回数が減り、速ければ1トークンずつ流れる。
+- トークンは捨てずに連結する（最終的なテキストは必ず全部届く）。バッファが上限に達したら末尾に連結する
+- ステータスは途中のものを捨てて最新だけを送る
+- 深さ・まとめた数・遅延を stats に記録し、ターンの終わりに [Pipe] として出力する
+"""
+import asyncio
+import os
+import time
+from collections import deque
+from typing import AsyncIterator, Optional
+
+# バッファに積む差分の件数の上限（超えた分は末尾の差分に連結する）
+STREAM_QUEUE_MAX = int(os.getenv("STREAM_QUEUE_MAX", "64"))
+
+
+class StreamPipe:
+    """StreamPipe(events).stream() が stream_turn() と同じ形の (kind, text) を返す。
+
+    途中で抜けたときに上流をすぐ閉じるため、contextlib.aclosing() で囲んで使う。
+    """
+
+    def __init__(self, events: AsyncIterator[tuple[str, str]], max_pending: int = STREAM_QUEUE_MAX):
+        self._events = events
+        self.max_pending = max(1, max_pending)
+        self._tokens: deque[list] = deque()  # [text, 最初に積んだ時刻]
+        self._status: Optional[str] = None  # 未送信の最新ステータス（None = なし）
+        self._ready = asyncio.Event()
+        self._done = False
+        self._error: Optional[BaseException] = None
+        self._produced_at: Optional[float] = None
+        self.stats = {
+            "deltas": 0,  # 受信したトークン差分
+            "emits": 0,  # 画面へ送った回数
+            "merged": 0,  # 他の差分とまとめて送った差分
+            "dropped_status": 0,  # 送らずに捨てた途中のステータス
+            "max_depth": 0,  # 送信待ちの差分の最大件数
+            "max_lag_ms": 0.0,  # 受信してから送信を始めるまでの最大遅延
+            "avg_lag_ms": 0.0,
+            "emit_ms": 0.0,  # 送信にかかった時間の合計
+            "drain_ms": 0.0,  # 受信完了から送信完了まで
+        }
+        self._lag_total = 0.0
+
+    async def _produce(self) -> None:
+        try:
+            async for kind, text in self._events:
+                if kind == "token":
+                    self._push_token(text)
+                else:
+                    if self._status is not None:
+                        self.stats["dropped_status"] += 1
+                    self._status = text
+                self._ready.set()
+        except Exception as e:
+            self._error = e
+        finally:
+            self._done = True
+            self._produced_at = time.perf_counter()
+            self._ready.set()
+
+    def _push_token(self, text: str) -> None:
+        self.stats["deltas"] += 1
+        if len(self._tokens) >= self.max_pending:
+            self._tokens[-1][0] += text
+        else:
+            self._tokens.append([text, time.perf_counter()])
+        self.stats["max_depth"] = max(self.stats["max_depth"], len(self._tokens))
+
+    async def stream(self) -> AsyncIterator[tuple[str, str]]:
+        producer = asyncio.create_task(self._produce(), name="stream-pipe")
+        try:
+            while True:
+                await self._ready.wait()
+                self._ready.clear()
+                if self._tokens:
+                    text, oldest = "".join(t for t, _ in self._tokens), self._tokens[0][1]
+                    count = len(self._tokens)
+                    self._tokens.clear()
+                    started = time.perf_counter()
+                    lag = (started - oldest) * 1000
+                    self.stats["emits"] += 1
+                    self.stats["merged"] += count - 1
+                    self.stats["max_lag_ms"] = max(self.stats["max_lag_ms"], lag)
+                    self._lag_total += lag
+                    yield "token", text
+                    self.stats["emit_ms"] += (time.perf_counter() - started) * 1000
+                if self._status is not None:
+                    status, self._status = self._status, None
+                    yield "status", status
+                if self._done and not self._tokens and self._status is None:
+                    if self._error is not None:
+                        raise self._error
+                    return
+        finally:
+            if not producer.done():
+                producer.cancel()  # 途中で抜けた（停止・切断）ときは上流もここで閉じる
+            await asyncio.gather(producer, return_exceptions=True)
+            self._log()
+
+    def _log(self) -> None:
+        s = self.stats
+        if s["emits"]:
+            s["avg_lag_ms"] = round(self._lag_total / s["emits"], 2)
+        s["max_lag_ms"] = round(s["max_lag_ms"], 2)
+        s["emit_ms"] = round(s["emit_ms"], 1)
+        if self._produced_at is not None:
+            s["drain_ms"] = round((time.perf_counter() - self._produced_at) * 1000, 1)
+        print(
+            f"[Pipe] deltas={s['deltas']} emits={s['emits']} merged={s['merged']} max_depth={s['max_depth']} "
+            f"lag_avg={s['avg_lag_ms']}ms lag_max={s['max_lag_ms']}ms emit={s['emit_ms']}ms drain={s['drain_ms']}ms "
+            f"dropped_status={s['dropped_status']}"
+        )
@@ -0,0 +1,175 @@
+# 停止ボタン / 切断でターンのタスクがキャンセルされたとき、上流のストリームが一定時間内に閉じられることを確かめる
+# （計測は bench/bench_cancel.py。こちらは疑似ストリームで上限だけを確認する）
+# 使い方: python -m pytest -q tests
+import asyncio
+import os
+import sys
+import threading
+import time
+from contextlib import aclosing
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from langchain_core.messages import HumanMessage
+
+from providers import ProviderClients, TurnRequest, TurnResult, _iterate_in_thread, stream_turn
+from singleflight import SingleFlight, coalesce_key
+from stream_pipe import StreamPipe
+
+# キャンセルしてから上流が閉じるまでの上限
+RELEASE_BOUND_SEC = 0.5
+TOKEN_INTERVAL_SEC = 0.02
+
+
+class FakeStream:
+    """OpenAI SDK の AsyncStream の代わり。トークンを流し続け、close() された時刻を記録する。"""
+
+    def __init__(self):
+        self.closed_at = None
+
+    def __aiter__(self):
+        return self._events()
+
+    async def _events(self):
+        i = 0
+        while self.closed_at is None:
+            await asyncio.sleep(TOKEN_INTERVAL_SEC)
+            yield SimpleNamespace(type="response.output_text.delta", delta=f"t{i} ")
+            i += 1
+
+    async def close(self):
+        self.closed_at = time.perf_counter()
+
+
+class FakeResponses:
+    def __init__(self):
+        self.streams = []
+
+    async def create(self, **kwargs):
+        self.streams.append(FakeStream())
+        return self.streams[-1]
+
+
+def fake_clients():
+    responses = FakeResponses()
+    return ProviderClients(openai=SimpleNamespace(responses=responses)), responses
+
+
+def request():
+    return TurnRequest(provider="openai", model="fake", history=[HumanMessage("hi")])
+
+
+async def consume(events, received: asyncio.Event, tokens: int = 5):
+    """on_message と同じく aclosing で囲んで読む。tokens 件受け取ったら received を立ててそのまま読み続ける。"""
+    count = 0
+    async with aclosing(events) as stream:
+        async for kind, _ in stream:
+            if kind == "token":
+                count += 1
+                if count >= tokens:
+                    received.set()
+
+
+async def cancel_and_time(task: asyncio.Task) -> float:
+    cancelled_at = time.perf_counter()
+    task.cancel()
+    try:
+        await task
+    except asyncio.CancelledError:
+        pass
+    return cancelled_at
+
+
+def test_stream_turn_closes_upstream_on_cancel():
+    async def main():
+        clients, responses = fake_clients()
+        result = TurnResult()
+        received = asyncio.Event()
+        task = asyncio.create_task(consume(StreamPipe(stream_turn(clients, request(), result)).stream(), received))
+        await asyncio.wait_for(received.wait(), 5)
+        cancelled_at = await cancel_and_time(task)
+        upstream = responses.streams[0]
+        assert upstream.closed_at is not None, "upstream stream was not closed"
+        assert upstream.closed_at - cancelled_at < RELEASE_BOUND_SEC
+        assert result.cancelled
+
+    asyncio.run(main())
+
+
+def test_single_flight_closes_upstream_when_last_subscriber_leaves():
+    async def main():
+        clients, responses = fake_clients()
+        flights = SingleFlight()
+        req = request()
+        flight, leader = flights.join(coalesce_key(req, "user"), lambda r: stream_turn(clients, req, r))
+        assert leader
+        received = asyncio.Event()
+        task = asyncio.create_task(consume(StreamPipe(flight.subscribe()).stream(), received))
+        await asyncio.wait_for(received.wait(), 5)
+        cancelled_at = await cancel_and_time(task)
+        await asyncio.wait_for(asyncio.gather(flight.task, return_exceptions=True), RELEASE_BOUND_SEC)
+        upstream = responses.streams[0]
+        assert upstream.closed_at is not None and upstream.closed_at - cancelled_at < RELEASE_BOUND_SEC
+        assert flight.result.cancelled
+
+    asyncio.run(main())
+
+
+def test_threaded_stream_closed_after_inflight_chunk():
+    """Grok（同期ストリームをスレッドで回す経路）: 呼び出し側はすぐ戻り、実行中の next() が返ったら閉じる。"""
+    chunk_sec = 0.2
+    closed = threading.Event()
+
+    def slow_chunks():
+        try:
+            while True:
+                time.sleep(chunk_sec)
+                yield "chunk"
+        finally:
+            closed.set()
+
+    async def main():
+        received = asyncio.Event()
+
+        async def read():
+            async with aclosing(_iterate_in_thread(slow_chunks())) as chunks:
+                async for _ in chunks:
+                    received.set()
+
+        task = asyncio.create_task(read())
+        await asyncio.wait_for(received.wait(), 5)
+        cancelled_at = await cancel_and_time(task)
+        assert time.perf_counter() - cancelled_at < 0.1, "caller waited for the in-flight chunk"
+        assert await asyncio.to_thread(closed.wait, chunk_sec + RELEASE_BOUND_SEC)
+
+    asyncio.run(main())
+
+
+def test_single_flight_records_usage_once_when_leader_stops():
+    """開いた側が停止しても相乗りした側のために上流は続き、使用量は上流が終わったときに1回だけ記録される。"""
+    async def main():
+        clients, _ = fake_clients()
+        flights = SingleFlight()
+        req = request()
+        finished = []
+        key = coalesce_key(req, "user")
+        flight, leader = flights.join(key, lambda r: stream_turn(clients, req, r), on_finish=finished.append)
+        follower_flight, follower_leader = flights.join(key, lambda r: stream_turn(clients, req, r), on_finish=finished.append)
+        assert leader and not follower_leader and follower_flight is flight
+        leader_received, follower_received = asyncio.Event(), asyncio.Event()
+        leader_task = asyncio.create_task(consume(StreamPipe(flight.subscribe()).stream(), leader_received))
+        follower_task = asyncio.create_task(consume(StreamPipe(flight.subscribe()).stream(), follower_received, tokens=15))
+        await asyncio.wait_for(leader_received.wait(), 5)
+        await cancel_and_time(leader_task)
+        # app.py はこの状態（上流が続き、まだ参加者がいる）を見て、停止した側はレイテンシだけを記録する
+        assert not flight.done and flight.subscribers == 1
+        text_when_leader_stopped = flight.result.text
+        await asyncio.wait_for(follower_received.wait(), 5)
+        assert finished == [], "usage recorded before the upstream finished"
+        await cancel_and_time(follower_task)
+        await asyncio.wait_for(asyncio.gather(flight.task, return_exceptions=True), RELEASE_BOUND_SEC)
+        await asyncio.sleep(0)  # done callback
+        assert finished == [flight]
+        assert len(flight.result.text) > len(text_when_leader_stopped)
+
+    asyncio.run(main())
@@ -0,0 +1,186 @@
+"""メッセージごとに必要最小限のツールを選ぶローカルルーター（ヒューリスティクス + 任意の小型分類器）。"""
+import json
+import math
+import os
+import re
+import time
+from dataclasses import dataclass, field
+from typing import Optional
+
+# プロバイダ非依存のツール種別
+WEB_SEARCH = "web_search"
+URL_CONTEXT = "url_context"
+CODE = "code"
+IMAGE = "image"
+MCP = "mcp"
+ALL_TOOL_KINDS = (WEB_SEARCH, URL_CONTEXT, CODE, IMAGE, MCP)
+
+# ツールを付与したときのおおよそのオーバーヘッド（スキーマ送信・MCPのtools/list等）。ログの概算用
+ESTIMATED_TOOL_OVERHEAD_MS = {
+    WEB_SEARCH: 150,
+    URL_CONTEXT: 100,
+    CODE: 200,
+    IMAGE: 100,
+    MCP: 800,
+}
+
+URL_RE = re.compile(r"https?://\S+", re.IGNORECASE)
+
+# (ツール種別, パターン) の一覧。日本語・英語の代表的な言い回しを拾う
+HEURISTIC_RULES = [
+    (WEB_SEARCH, re.compile(
+        r"最新|ニュース|今日|本日|昨日|今週|現在の|天気|株価|為替|速報|調べて|検索|発表された"
+        r"|latest|news|today|yesterday|current|weather|stock price|search|look up",
+        re.IGNORECASE,
+    )),
+    (CODE, re.compile(
+        r"計算して|計算する|グラフ|プロット|集計|実行して|データ分析|csv|excel|統計"
+        r"|calculate|compute|plot|chart|run (this|the) code|analy[sz]e (the )?data",
+        re.IGNORECASE,
+    )),
+    (IMAGE, re.compile(
+        r"画像を(生成|作|描)|絵を描|イラストを|ロゴを(作|生成)|draw |generate an image|create an image|illustration",
+        re.IGNORECASE,
+    )),
+    (MCP, re.compile(
+        r"github|リポジトリ|repository|repo\b|deepwiki|ソースコードを読|ライブラリの(実装|ドキュメント)",
+        re.IGNORECASE,
+    )),
+]
+
+
+@dataclass
+class RouteDecision:
+    """ルーティング結果。"""
+    tools: set = field(default_factory=set)
+    reasons: dict = field(default_factory=dict)
+    elapsed_ms: float = 0.0
+
+    def has(self, kind: str) -> bool:
+        return kind in self.tools
+
+
+class TinyToolClassifier:
+    """トークン重みによるロジスティック分類器（ツール種別ごとに独立）。
+
+    JSON 形式: {"threshold": 0.5, "bias": {"web_search": -2.0}, "weights": {"web_search": {"ニュース": 3.1}}}
+    """
+
+    def __init__(self, bias: dict, weights: dict, threshold: float = 0.5):
+        self.bias = bias
+        self.weights = weights
+        self.threshold = threshold
+
+    @classmethod
+    def load(cls, path: str) -> "TinyToolClassifier":
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        return cls(data.get("bias", {}), data.get("weights", {}), float(data.get("threshold", 0.5)))
+
+    def predict(self, text: str) -> dict[str, float]:
+        t = (text or "").lower()
+        probs = {}
+        for kind, weights in self.weights.items():
+            z = self.bias.get(kind, 0.0) + sum(w for tok, w in weights.items() if tok in t)
+            probs[kind] = 1.0 / (1.0 + math.exp(-z))
+        return probs
+
+
+_classifier: Optional[TinyToolClassifier] = None
+_CLASSIFIER_PATH = os.getenv("TOOL_ROUTER_CLASSIFIER")
+if _CLASSIFIER_PATH:
+    try:
+        _classifier = TinyToolClassifier.load(_CLASSIFIER_PATH)
+        print(f"[ToolRouter] classifier loaded: {_CLASSIFIER_PATH}")
+    except Exception as e:
+        print(f"[ToolRouter] classifier の読み込みに失敗しました: {e}")
+
+
+def route_tools(text: str) -> RouteDecision:
+    """メッセージ本文から必要なツール種別を決める。"""
+    started = time.perf_counter()
+    decision = RouteDecision()
+    text = text or ""
+
+    if URL_RE.search(text):
+        decision.tools.add(URL_CONTEXT)
+        decision.reasons[URL_CONTEXT] = "url"
+    for kind, pattern in HEURISTIC_RULES:
+        m = pattern.search(text)
+        if m:
+            decision.tools.add(kind)
+            decision.reasons[kind] = f"rule:{m.group(0)}"
+
+    if _classifier is not None:
+        for kind, prob in _classifier.predict(text).items():
+            if kind in ALL_TOOL_KINDS and prob >= _classifier.threshold and kind not in decision.tools:
+                decision.tools.add(kind)
+                decision.reasons[kind] = f"clf:{prob:.2f}"
+
+    decision.elapsed_ms = (time.perf_counter() - started) * 1000
+    return decision
+
+
+def log_decision(provider: str, decision: RouteDecision, available: list[str]) -> None:
+    """選ばれたツールと、付与しなかったツール分の概算節約時間をログに出す。"""
+    selected = [k for k in available if k in decision.tools]
+    skipped = [k for k in available if k not in decision.tools]
+    saved_ms = sum(ESTIMATED_TOOL_OVERHEAD_MS.get(k, 0) for k in skipped)
+    print(
+        f"[ToolRouter] provider={provider} selected={selected or '-'} skipped={skipped or '-'} "
+        f"reasons={decision.reasons or '-'} route={decision.elapsed_ms:.2f}ms saved≈{saved_ms}ms"
+    )
+
+
+# --- プロバイダへの付与（チャット画面と batch_run.py で共通） ---
+# ツールルーター: Tools ON のときでもメッセージごとに必要なツールだけを付与する（0 で従来通り全付与）
+TOOL_ROUTER_ENABLED = os.getenv("TOOL_ROUTER_ENABLED", "1") != "0"
+
+# OpenAI用のツール定義（有効時のみ付与）
+OPENAI_ALL_TOOLS = [
+    {"type": "web_search"},
+    {"type": "code_interpreter", "container": {"type": "auto"}},
+    {"type": "image_generation"},
+    {
+        "type": "mcp",
+        "server_label": "deepwiki",
+        "server_url": "https://mcp.deepwiki.com/mcp",
+        "require_approval": "never",
+    },
+]
+# OpenAI のツール type -> 対応するツール種別
+OPENAI_TOOL_KINDS = {
+    "web_search": (WEB_SEARCH, URL_CONTEXT),
+    "code_interpreter": (CODE,),
+    "image_generation": (IMAGE,),
+    "mcp": (MCP,),
+}
+# プロバイダごとに付与できるツール種別
+PROVIDER_TOOL_KINDS = {
+    "openai": [WEB_SEARCH, URL_CONTEXT, CODE, IMAGE, MCP],
+    "gemini": [WEB_SEARCH, URL_CONTEXT, CODE],
+    "grok": [WEB_SEARCH, URL_CONTEXT],
+}
+
+
+def select_tool_kinds(provider: str, text: str, tools_enabled: bool) -> set:
+    """Tools スイッチとルーターの判定から、今回付与するツール種別を返す。"""
+    if provider not in PROVIDER_TOOL_KINDS:
+        return set()
+    if not tools_enabled:
+        # Grok の Live Search は以前から Tools スイッチに関係なく mode="auto"（検索するかはモデルが決める）なので、そのまま残す
+        return {WEB_SEARCH, URL_CONTEXT} if provider == "grok" else set()
+    available = PROVIDER_TOOL_KINDS[provider]
+    if not TOOL_ROUTER_ENABLED:
+        return set(available)
+    decision = route_tools(text)
+    log_decision(provider, decision, available)
+    return {k for k in decision.tools if k in available}
+
+
+def openai_tools_for(tool_kinds: set, skip_mcp: bool = False) -> list[dict]:
+    """選ばれた種別に対応する OpenAI のツール定義（skip_mcp: MCP をプール経由で呼ぶときは hosted mcp を付けない）。"""
+    return [
+        t for t in OPENAI_ALL_TOOLS
+        if tool_kinds & set(OPENAI_TOOL_KINDS[t["type"]]) and not (skip_mcp and t["type"] == "mcp")
+    ]
@@ -0,0 +1,135 @@
+"""トレースのポリシー（サンプリング・ペイロード切り詰め・非同期バッチエクスポート）。"""
+import asyncio
+import json
+import os
+import random
+import time
+from contextlib import asynccontextmanager
+from typing import Optional
+
+import chainlit as cl
+
+# cl.Step として記録するターンの割合（0.0〜1.0）
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "1.0"))
+# Step の input / output に保存する最大文字数
+TRACE_MAX_PAYLOAD_CHARS = int(os.getenv("TRACE_MAX_PAYLOAD_CHARS", "2000"))
+# 指定するとサンプリングされた Step の全文を JSONL にバッチで書き出す
+TRACE_EXPORT_PATH = os.getenv("TRACE_EXPORT_PATH")
+TRACE_EXPORT_BATCH = int(os.getenv("TRACE_EXPORT_BATCH", "50"))
+TRACE_EXPORT_INTERVAL_SEC = float(os.getenv("TRACE_EXPORT_INTERVAL_SEC", "5"))
+# cl.instrument_openai() は全呼び出しを記録するため、既定では全量サンプリング時のみ有効にする
+TRACE_INSTRUMENT_OPENAI = os.getenv("TRACE_INSTRUMENT_OPENAI", "1" if TRACE_SAMPLE_RATE >= 1.0 else "0") == "1"
+
+
+def truncate(text: Optional[str], limit: int = TRACE_MAX_PAYLOAD_CHARS) -> str:
+    text = text or ""
+    if len(text) <= limit:
+        return text
+    return f"{text[:limit]}\n…（{len(text) - limit} 文字省略）"
+
+
+def should_sample() -> bool:
+    return TRACE_SAMPLE_RATE >= 1.0 or random.random() < TRACE_SAMPLE_RATE
+
+
+class TraceExporter:
+    """Step の内容をキューに積み、バックグラウンドでまとめて JSONL に追記する。"""
+
+    def __init__(self, path: str, batch_size: int = TRACE_EXPORT_BATCH, interval: float = TRACE_EXPORT_INTERVAL_SEC):
+        self.path = path
+        self.batch_size = batch_size
+        self.interval = interval
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def submit(self, record: dict) -> None:
+        if self._queue is None:
+            self._queue = asyncio.Queue(maxsize=10_000)
+            self._task = asyncio.create_task(self._run(), name="trace-exporter")
+        try:
+            self._queue.put_nowait(record)
+        except asyncio.QueueFull:
+            pass  # 取りこぼしてもターンは止めない
+
+    def _write(self, batch: list[dict]) -> None:
+        with open(self.path, "a", encoding="utf-8") as f:
+            for record in batch:
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+    async def _run(self) -> None:
+        while True:
+            batch = [await self._queue.get()]
+            deadline = time.monotonic() + self.interval
+            while len(batch) < self.batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            try:
+                await asyncio.to_thread(self._write, batch)
+            except Exception as e:
+                print(f"[Trace] export failed: {e}")
+
+
+exporter = TraceExporter(TRACE_EXPORT_PATH) if TRACE_EXPORT_PATH else None
+
+
+class _TracedStep:
+    """cl.Step の input / output を切り詰めて設定し、全文はエクスポーターへ回す。"""
+
+    def __init__(self, step: Optional[cl.Step], name: str):
+        self._step = step
+        self._name = name
+        self._input = ""
+        self._output = ""
+
+    @property
+    def input(self) -> str:
+        return self._input
+
+    @input.setter
+    def input(self, value: str) -> None:
+        self._input = value or ""
+        if self._step is not None:
+            self._step.input = truncate(self._input)
+
+    @property
+    def output(self) -> str:
+        return self._output
+
+    @output.setter
+    def output(self, value: str) -> None:
+        self._output = value or ""
+        if self._step is not None:
+            self._step.output = truncate(self._output)
+
+    def export(self, started_at: float) -> None:
+        if exporter is None or self._step is None:
+            return
+        exporter.submit({
+            "name": self._name,
+            "step_id": self._step.id,
+            "thread_id": getattr(self._step, "thread_id", None),
+            "started_at": started_at,
+            "duration_ms": round((time.time() - started_at) * 1000, 1),
+            "input": self._input,
+            "output": self._output,
+        })
+
+
+@asynccontextmanager
+async def traced_step(name: str):
+    """サンプリングされたターンだけ cl.Step を作る。対象外のターンでは何も記録しない。"""
+    started_at = time.time()
+    if not should_sample():
+        yield _TracedStep(None, name)
+        return
+    async with cl.Step(name=name) as step:
+        traced = _TracedStep(step, name)
+        try:
+            yield traced
+        finally:
+            traced.export(started_at)
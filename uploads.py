@@ -0,0 +1,316 @@
+"""アップロードファイルの取り込み（ストリーミングハッシュ + プロバイダ別 Files API の重複排除キャッシュ）。
+
+画像は image_prep でプロバイダごとの推奨サイズに縮小してからアップロードする（Grok は送信時に base64 でリクエストに埋め込む）。
+"""
+import asyncio
+import base64
+import hashlib
+import mimetypes
+import os
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Callable, Awaitable, Optional
+
+from image_prep import IMAGE_PREP_ENABLED, IMAGE_TARGETS, image_preprocessor
+
+# 一度に読み込むサイズ（ファイル全体をメモリに載せない）
+HASH_CHUNK_SIZE = 1024 * 1024
+# Gemini の Files API は48時間で失効するため、少し手前でキャッシュを捨てる
+GEMINI_FILE_TTL_SEC = 47 * 3600
+# (path, mtime, size) -> digest のメモの上限件数
+DIGEST_MEMO_SIZE = int(os.getenv("DIGEST_MEMO_SIZE", "4096"))
+# (content hash, provider) -> アップロード済み参照のキャッシュの上限件数（古いものから捨てる。捨てた分は次に使うとき再アップロード）
+FILE_REF_CACHE_SIZE = int(os.getenv("FILE_REF_CACHE_SIZE", "4096"))
+
+
+@dataclass
+class LocalFile:
+    """ハッシュ済みのローカルファイル。"""
+    path: str
+    name: str
+    mime: str
+    size: int
+    digest: str
+
+
+@dataclass
+class FileRef:
+    """プロバイダにアップロード済みのファイル参照。"""
+    provider: str
+    file_id: str
+    name: str
+    mime: str
+    uri: Optional[str] = None
+    path: Optional[str] = None  # Grok のみ: 送信時に読み込むローカルファイル（縮小済みの画像）
+
+
+def sha256_file(path: str, chunk_size: int = HASH_CHUNK_SIZE) -> tuple[str, int]:
+    """ファイルをチャンク単位で読みながら SHA-256 とサイズを求める。"""
+    h = hashlib.sha256()
+    size = 0
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            h.update(chunk)
+            size += len(chunk)
+    return h.hexdigest(), size
+
+
+class FileUploadCache:
+    """(content hash, provider) -> FileRef のプロセス共通キャッシュ。
+
+    同じ内容のファイルはセッションをまたいでもプロバイダごとに1回だけアップロードする。
+    同時に同じファイルが来た場合もキーごとのロックで二重アップロードを防ぐ。
+    参照は FILE_REF_CACHE_SIZE 件までの LRU で持ち、ロックは待っている人がいなくなったら捨てる。
+    """
+
+    def __init__(self, max_size: int = FILE_REF_CACHE_SIZE):
+        self.max_size = max_size
+        self._refs: "OrderedDict[tuple[str, str], tuple[FileRef, float]]" = OrderedDict()
+        # key -> [ロック, 使用中（待ちを含む）の数]
+        self._locks: dict[tuple[str, str], list] = {}
+
+    def _ttl(self, provider: str) -> Optional[float]:
+        return GEMINI_FILE_TTL_SEC if provider == "gemini" else None
+
+    def get(self, digest: str, provider: str) -> Optional[FileRef]:
+        entry = self._refs.get((digest, provider))
+        if not entry:
+            return None
+        ref, uploaded_at = entry
+        ttl = self._ttl(provider)
+        expired = ttl is not None and time.time() - uploaded_at > ttl
+        if expired or (ref.path and not os.path.exists(ref.path)):
+            self._refs.pop((digest, provider), None)
+            return None
+        self._refs.move_to_end((digest, provider))
+        return ref
+
+    async def get_or_upload(
+        self,
+        local: LocalFile,
+        provider: str,
+        upload_fn: Callable[[LocalFile], Awaitable[FileRef]],
+    ) -> FileRef:
+        key = (local.digest, provider)
+        cached = self.get(*key)
+        if cached:
+            return cached
+        entry = self._locks.get(key)
+        if entry is None:
+            entry = self._locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                cached = self.get(*key)
+                if cached:
+                    return cached
+                ref = await upload_fn(local)
+                self._refs[key] = (ref, time.time())
+                if len(self._refs) > self.max_size:
+                    self._refs.popitem(last=False)
+                return ref
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0 and self._locks.get(key) is entry:
+                del self._locks[key]
+
+
+file_upload_cache = FileUploadCache()
+
+# (path, mtime, size) -> digest。同じ添付を複数の処理（アップロード/索引化）で扱っても再ハッシュしない
+_digest_memo: "OrderedDict[tuple[str, float, int], str]" = OrderedDict()
+
+
+async def hash_element(element: Any) -> Optional[LocalFile]:
+    """Chainlit の要素（cl.File / cl.Image 等）をハッシュする。パスを持たない要素は対象外。"""
+    path = getattr(element, "path", None)
+    if not path:
+        return None
+    name = getattr(element, "name", None) or path.rsplit("/", 1)[-1]
+    mime = getattr(element, "mime", None) or mimetypes.guess_type(name)[0] or "application/octet-stream"
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    memo_key = (path, st.st_mtime, st.st_size)
+    digest = _digest_memo.get(memo_key)
+    size = st.st_size
+    if digest is None:
+        # ハッシュ計算はディスクI/Oなのでイベントループを止めないようスレッドで実行
+        digest, size = await asyncio.to_thread(sha256_file, path)
+        _digest_memo[memo_key] = digest
+        if len(_digest_memo) > DIGEST_MEMO_SIZE:
+            _digest_memo.popitem(last=False)
+    else:
+        _digest_memo.move_to_end(memo_key)
+    return LocalFile(path=path, name=name, mime=mime, size=size, digest=digest)
+
+
+# --- プロバイダ別アップロード ---
+def _is_image(mime: str) -> bool:
+    return mime.startswith("image/")
+
+
+def supports_file(provider: str, mime: str) -> bool:
+    """プロバイダがリクエストに添付できるファイル種別か判定する。"""
+    if provider == "openai":
+        return _is_image(mime) or mime == "application/pdf"
+    if provider == "claude":
+        return _is_image(mime) or mime in ("application/pdf", "text/plain")
+    if provider == "gemini":
+        return True
+    if provider == "grok":
+        return _is_image(mime)
+    return False
+
+
+async def prepare_local(local: LocalFile, provider: str) -> LocalFile:
+    """画像ならプロバイダ向けに縮小・再エンコードしたファイルに差し替える（失敗したら元のまま）。"""
+    if not (IMAGE_PREP_ENABLED and _is_image(local.mime) and provider in IMAGE_TARGETS):
+        return local
+    try:
+        prepared = await image_preprocessor.prepare(local.path, local.mime, local.digest, provider)
+    except Exception as e:
+        print(f"[Image] {provider}: {local.name} の縮小に失敗したため元の画像を使います: {e}")
+        return local
+    size = "" if not prepared.size[0] else f" {prepared.original_size[0]}x{prepared.original_size[1]} -> {prepared.size[0]}x{prepared.size[1]},"
+    print(
+        f"[Image] {provider}: {local.name}{size} {prepared.original_bytes} -> {prepared.bytes} bytes "
+        f"({prepared.bytes / max(1, prepared.original_bytes):.1%}) {'cached' if prepared.cached else f'{prepared.elapsed_ms}ms'}"
+    )
+    if prepared.path == local.path:
+        return local
+    stem = local.name.rsplit(".", 1)[0]
+    return LocalFile(
+        path=prepared.path,
+        name=f"{stem}.{prepared.path.rsplit('.', 1)[-1]}",
+        mime=prepared.mime,
+        size=prepared.bytes,
+        digest=prepared.digest,
+    )
+
+
+async def _upload_openai(client, local: LocalFile) -> FileRef:
+    purpose = "vision" if _is_image(local.mime) else "user_data"
+    with open(local.path, "rb") as f:
+        uploaded = await client.files.create(file=(local.name, f, local.mime), purpose=purpose)
+    return FileRef(provider="openai", file_id=uploaded.id, name=local.name, mime=local.mime)
+
+
+async def _upload_claude(client, local: LocalFile) -> FileRef:
+    with open(local.path, "rb") as f:
+        uploaded = await client.beta.files.upload(file=(local.name, f, local.mime))
+    return FileRef(provider="claude", file_id=uploaded.id, name=local.name, mime=local.mime)
+
+
+async def _upload_gemini(client, local: LocalFile) -> FileRef:
+    uploaded = await client.aio.files.upload(
+        file=local.path,
+        config={"mime_type": local.mime, "display_name": local.name},
+    )
+    return FileRef(
+        provider="gemini",
+        file_id=uploaded.name,
+        name=local.name,
+        mime=uploaded.mime_type or local.mime,
+        uri=uploaded.uri,
+    )
+
+
+async def _inline_grok(client, local: LocalFile) -> FileRef:
+    # xAI には Files API がないので送信時に data URL にして埋め込む。キャッシュには（縮小済みの）ファイルのパスだけを持つ
+    return FileRef(provider="grok", file_id=local.digest[:16], name=local.name, mime=local.mime, path=local.path)
+
+
+UPLOADERS = {
+    "openai": _upload_openai,
+    "claude": _upload_claude,
+    "gemini": _upload_gemini,
+    "grok": _inline_grok,
+}
+
+
+async def upload_elements(elements: list, provider: str, client) -> tuple[list[FileRef], list[str]]:
+    """メッセージ添付をハッシュ→重複排除→アップロードし、(参照一覧, スキップしたファイル名) を返す。"""
+    uploader = UPLOADERS.get(provider)
+    refs: list[FileRef] = []
+    skipped: list[str] = []
+    if not elements:
+        return refs, skipped
+
+    locals_ = await asyncio.gather(*(hash_element(el) for el in elements))
+    pending = []
+    for el, local in zip(elements, locals_):
+        if local is None:
+            continue
+        if uploader is None or client is None or not supports_file(provider, local.mime):
+            skipped.append(local.name)
+            continue
+        pending.append(local)
+
+    async def _one(local: LocalFile) -> Optional[FileRef]:
+        local = await prepare_local(local, provider)
+        try:
+            cached = file_upload_cache.get(local.digest, provider) is not None
+            ref = await file_upload_cache.get_or_upload(local, provider, lambda lf: uploader(client, lf))
+            print(f"[Upload] {provider}: {local.name} ({local.size} bytes, sha256={local.digest[:12]}) -> {ref.file_id}{' (cached)' if cached else ''}")
+            return ref
+        except Exception as e:
+            print(f"[Upload] {provider}: {local.name} のアップロードに失敗しました: {e}")
+            skipped.append(local.name)
+            return None
+
+    for ref in await asyncio.gather(*(_one(lf) for lf in pending)):
+        if ref:
+            refs.append(ref)
+    return refs, skipped
+
+
+# --- リクエストへの添付 ---
+def openai_file_parts(refs: list[FileRef]) -> list[dict]:
+    """Responses API の input content 用パーツ。"""
+    parts = []
+    for ref in refs:
+        if _is_image(ref.mime):
+            parts.append({"type": "input_image", "file_id": ref.file_id})
+        else:
+            parts.append({"type": "input_file", "file_id": ref.file_id})
+    return parts
+
+
+def claude_file_blocks(refs: list[FileRef]) -> list[dict]:
+    """Messages API の content ブロック（Files API beta）。"""
+    blocks = []
+    for ref in refs:
+        block_type = "image" if _is_image(ref.mime) else "document"
+        blocks.append({"type": block_type, "source": {"type": "file", "file_id": ref.file_id}})
+    return blocks
+
+
+def gemini_file_parts(refs: list[FileRef]) -> list:
+    """generate_content の contents に渡す Part。"""
+    from google.genai.types import Part
+    return [Part.from_uri(file_uri=ref.uri, mime_type=ref.mime) for ref in refs if ref.uri]
+
+
+def _data_url(ref: FileRef) -> Optional[str]:
+    try:
+        with open(ref.path, "rb") as f:
+            data = f.read()
+    except OSError as e:
+        print(f"[Upload] grok: {ref.name} を読み込めません: {e}")
+        return None
+    return f"data:{ref.mime};base64,{base64.b64encode(data).decode('ascii')}"
+
+
+async def grok_image_urls(refs: list[FileRef]) -> list[str]:
+    """xai_sdk の image() に渡す data URL（ファイルの読み込みとエンコードはスレッドで行う）。"""
+    refs = [ref for ref in refs if ref.provider == "grok" and ref.path]
+    if not refs:
+        return []
+    urls = await asyncio.to_thread(lambda: [_data_url(ref) for ref in refs])
+    return [url for url in urls if url]
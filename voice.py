@@ -0,0 +1,417 @@
+"""音声モード（マイク入力 → 文字起こし → 通常の応答 → 読み上げ）。
+
+Chainlit の音声フック（on_audio_start / on_audio_chunk / on_audio_end）から使う。
+- 受け取った PCM16（config.toml の [features.audio] の sample_rate、モノラル）はリングバッファに積み、
+  フレームごとの音量で発話区間を切り出す（VAD）。息継ぎ程度の無音（VOICE_SILENCE_MS）で区間を閉じて
+  すぐに文字起こしに送るので、話し終わった時点では前の区間の文字起こしが済んでいる
+- VOICE_TURN_SILENCE_MS の無音が続いたら（またはマイクを止めたら）そこまでを1ターンとして送る
+- 文字起こしは選択中のプロバイダ（OpenAI / Gemini）、それ以外のモデルでは使える方を使う
+- 応答は文ごとに読み上げ（OpenAI TTS の PCM ストリーム）に回し、届いた音声チャンクをそのまま画面に送る。
+  読み上げ中に話し始めたら読み上げを止める
+- 話し終わり（最後の有声フレーム）から最初の音声チャンクを送るまで（mouth-to-ear）と内訳を [Voice] として出力する
+"""
+import asyncio
+import io
+import os
+import re
+import time
+import wave
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable, Optional
+
+import numpy as np
+
+VOICE_SAMPLE_RATE = int(os.getenv("VOICE_SAMPLE_RATE", "24000"))  # .chainlit/config.toml の [features.audio] と合わせる
+VOICE_FRAME_MS = 20
+# これより大きい音量（dBFS）のフレームを有声とみなす（周囲の雑音に合わせて VOICE_VAD_MARGIN_DB まで引き上げる）
+VOICE_VAD_DBFS = float(os.getenv("VOICE_VAD_DBFS", "-45"))
+VOICE_VAD_MARGIN_DB = float(os.getenv("VOICE_VAD_MARGIN_DB", "10"))
+VOICE_SILENCE_MS = int(os.getenv("VOICE_SILENCE_MS", "400"))  # 区間を閉じて文字起こしに送る無音
+VOICE_TURN_SILENCE_MS = int(os.getenv("VOICE_TURN_SILENCE_MS", "900"))  # ターンを送る無音（0 = マイクを止めるまで送らない）
+VOICE_MIN_SPEECH_MS = int(os.getenv("VOICE_MIN_SPEECH_MS", "200"))  # これより短い有声区間は雑音として捨てる
+VOICE_PREROLL_MS = int(os.getenv("VOICE_PREROLL_MS", "200"))  # 語頭を切らないよう区間の前に含める
+VOICE_MAX_SEGMENT_SEC = float(os.getenv("VOICE_MAX_SEGMENT_SEC", "15"))
+VOICE_RING_SEC = float(os.getenv("VOICE_RING_SEC", "60"))
+VOICE_LANGUAGE = os.getenv("VOICE_LANGUAGE", "ja")
+VOICE_STT_MODELS = {
+    "openai": os.getenv("VOICE_STT_MODEL_OPENAI", "gpt-4o-mini-transcribe"),
+    "gemini": os.getenv("VOICE_STT_MODEL_GEMINI", "gemini-2.5-flash-lite"),
+}
+VOICE_TTS_ENABLED = os.getenv("VOICE_TTS_ENABLED", "1") != "0"
+VOICE_TTS_MODEL = os.getenv("VOICE_TTS_MODEL", "gpt-4o-mini-tts")
+VOICE_TTS_VOICE = os.getenv("VOICE_TTS_VOICE", "alloy")
+VOICE_TTS_CHUNK_BYTES = int(os.getenv("VOICE_TTS_CHUNK_BYTES", "4800"))  # 24kHz PCM16 で 100ms
+
+
+def _ms_to_bytes(ms: float, sample_rate: int) -> int:
+    return int(sample_rate * ms / 1000) * 2
+
+
+def to_wav(pcm: bytes, sample_rate: int = VOICE_SAMPLE_RATE) -> bytes:
+    buf = io.BytesIO()
+    with wave.open(buf, "wb") as w:
+        w.setnchannels(1)
+        w.setsampwidth(2)
+        w.setframerate(sample_rate)
+        w.writeframes(pcm)
+    return buf.getvalue()
+
+
+def frame_dbfs(frame: bytes) -> float:
+    samples = np.frombuffer(frame, dtype="<i2").astype(np.float32)
+    rms = float(np.sqrt(np.mean(samples * samples))) if samples.size else 0.0
+    return 20 * np.log10(max(rms, 1.0) / 32768)
+
+
+class PCMRing:
+    """固定長のリングバッファ。書き込んだ総バイト数を位置として、区間 [start, end) を取り出す。"""
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.buf = bytearray(capacity)
+        self.written = 0
+
+    def write(self, data: bytes) -> None:
+        n = len(data)
+        if n >= self.capacity:
+            data = data[-self.capacity:]
+        pos = (self.written + n - len(data)) % self.capacity
+        first = min(len(data), self.capacity - pos)
+        self.buf[pos:pos + first] = data[:first]
+        self.buf[:len(data) - first] = data[first:]
+        self.written += n
+
+    def read(self, start: int, end: int) -> bytes:
+        start = max(start, self.written - self.capacity, 0)
+        end = min(end, self.written)
+        if end <= start:
+            return b""
+        a, b = start % self.capacity, end % self.capacity
+        if a < b:
+            return bytes(self.buf[a:b])
+        return bytes(self.buf[a:]) + bytes(self.buf[:b])
+
+
+@dataclass
+class Segment:
+    pcm: bytes
+    speech_end_at: float  # 最後の有声フレームを受け取った時刻（perf_counter）
+    closed_at: float
+
+
+class VoiceSegmenter:
+    """PCM を VOICE_FRAME_MS のフレームに分けて有声 / 無声を判定し、発話区間とターンの区切りを返す。"""
+
+    def __init__(self, sample_rate: int = VOICE_SAMPLE_RATE):
+        self.sample_rate = sample_rate
+        self.ring = PCMRing(_ms_to_bytes(VOICE_RING_SEC * 1000, sample_rate))
+        self.frame_bytes = _ms_to_bytes(VOICE_FRAME_MS, sample_rate)
+        self.noise_dbfs = -70.0
+        self._pending = bytearray()
+        self._pos = 0  # 次のフレームの開始位置（ring の位置）
+        self._start: Optional[int] = None  # 発話区間の開始位置（None = 区間外）
+        self._voiced_ms = 0
+        self._silence_ms = 0
+        self._voiced_end = 0
+        self._voiced_at = 0.0
+        self._turn_open = False  # 前回のターンの区切り以降に区間があった
+        self._turn_silence_ms = 0
+
+    def feed(self, data: bytes, now: float) -> list[tuple[str, Optional[Segment]]]:
+        """("speech", None)（話し始め）/ ("segment", Segment) / ("turn", None) のリストを返す。"""
+        self.ring.write(data)
+        self._pending += data
+        events = []
+        while len(self._pending) >= self.frame_bytes:
+            frame = bytes(self._pending[:self.frame_bytes])
+            del self._pending[:self.frame_bytes]
+            start, self._pos = self._pos, self._pos + self.frame_bytes
+            level = frame_dbfs(frame)
+            voiced = level > max(VOICE_VAD_DBFS, self.noise_dbfs + VOICE_VAD_MARGIN_DB)
+            if not voiced:
+                self.noise_dbfs = 0.95 * self.noise_dbfs + 0.05 * level
+            self._step(voiced, start, now, events)
+        return events
+
+    def _step(self, voiced: bool, start: int, now: float, events: list) -> None:
+        end = start + self.frame_bytes
+        if self._start is None:
+            if voiced:
+                self._start = max(0, start - _ms_to_bytes(VOICE_PREROLL_MS, self.sample_rate))
+                self._voiced_ms, self._silence_ms = VOICE_FRAME_MS, 0
+                self._voiced_end, self._voiced_at = end, now
+                self._turn_silence_ms = 0
+                events.append(("speech", None))
+            elif self._turn_open:
+                self._turn_silence_ms += VOICE_FRAME_MS
+                if VOICE_TURN_SILENCE_MS and self._turn_silence_ms + VOICE_SILENCE_MS >= VOICE_TURN_SILENCE_MS:
+                    self._turn_open = False
+                    events.append(("turn", None))
+            return
+        if voiced:
+            self._voiced_ms += VOICE_FRAME_MS
+            self._silence_ms = 0
+            self._voiced_end, self._voiced_at = end, now
+        else:
+            self._silence_ms += VOICE_FRAME_MS
+        if self._silence_ms >= VOICE_SILENCE_MS:
+            self._close(now, events)
+        elif end - self._start >= _ms_to_bytes(VOICE_MAX_SEGMENT_SEC * 1000, self.sample_rate):
+            self._close(now, events, keep_open=True)
+
+    def _close(self, now: float, events: list, keep_open: bool = False) -> None:
+        if self._voiced_ms >= VOICE_MIN_SPEECH_MS:
+            tail = _ms_to_bytes(min(self._silence_ms, 100), self.sample_rate)
+            events.append(("segment", Segment(self.ring.read(self._start, self._voiced_end + tail), self._voiced_at, now)))
+            self._turn_open = True
+        self._start = self._pos if keep_open else None
+        self._voiced_ms = 0
+
+    def flush(self, now: float) -> list[tuple[str, Optional[Segment]]]:
+        """録音の終わり: 閉じていない区間を閉じ、ターンを区切る。"""
+        events = []
+        if self._start is not None:
+            self._close(now, events)
+        if self._turn_open:
+            self._turn_open = False
+            events.append(("turn", None))
+        return events
+
+
+def pick_transcriber(clients, provider: str) -> Optional[tuple[str, object, str]]:
+    """(プロバイダ, クライアント, モデル)。選択中のプロバイダが文字起こしできなければ使える方。"""
+    for name in (provider, "openai", "gemini"):
+        if name in VOICE_STT_MODELS and clients.for_provider(name) is not None:
+            return name, clients.for_provider(name), VOICE_STT_MODELS[name]
+    return None
+
+
+async def transcribe(provider: str, client, model: str, pcm: bytes, sample_rate: int = VOICE_SAMPLE_RATE) -> str:
+    wav = to_wav(pcm, sample_rate)
+    if provider == "openai":
+        resp = await client.audio.transcriptions.create(
+            model=model, file=("speech.wav", wav, "audio/wav"), language=VOICE_LANGUAGE or None,
+        )
+        return (resp.text or "").strip()
+    from google.genai import types
+
+    resp = await client.aio.models.generate_content(
+        model=model,
+        contents=[
+            types.Part.from_bytes(data=wav, mime_type="audio/wav"),
+            "この音声を文字起こしして、発話内容だけを出力してください。聞き取れない場合は何も出力しないでください。",
+        ],
+    )
+    return (resp.text or "").strip()
+
+
+@dataclass
+class Utterance:
+    text: str
+    speech_end_at: float  # 最後の有声フレームを受け取った時刻
+    transcribed_at: float
+    segments: int
+    stt_ms: float  # 区間の文字起こしにかかった時間の合計
+    audio_ms: float
+
+
+def _join(texts: list[str]) -> str:
+    sep = "" if VOICE_LANGUAGE in ("ja", "zh") else " "
+    return sep.join(t for t in texts if t)
+
+
+class VoiceInput:
+    """1回の録音（on_audio_start 〜 on_audio_end）。区間ごとに文字起こしを始め、ターンの区切りで on_turn を呼ぶ。
+
+    ターンは前のターンが終わってから順に処理する。on_speech は話し始めるたびに呼ぶ（読み上げの割り込み用）。
+    """
+
+    def __init__(
+        self,
+        stt: tuple[str, object, str],
+        on_turn: Callable[[Utterance], Awaitable[None]],
+        on_speech: Optional[Callable[[], Awaitable[None]]] = None,
+        sample_rate: int = VOICE_SAMPLE_RATE,
+    ):
+        self.stt = stt
+        self.on_turn = on_turn
+        self.on_speech = on_speech
+        self.sample_rate = sample_rate
+        self.segmenter = VoiceSegmenter(sample_rate)
+        self._pending: list[asyncio.Task] = []
+        self._turn: Optional[asyncio.Task] = None
+        self._tasks: set[asyncio.Task] = set()
+
+    def _spawn(self, coro) -> asyncio.Task:
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    def feed(self, data: bytes) -> None:
+        self._handle(self.segmenter.feed(data, time.perf_counter()))
+
+    def _handle(self, events: list) -> None:
+        for kind, segment in events:
+            if kind == "speech" and self.on_speech is not None:
+                self._spawn(self.on_speech())
+            elif kind == "segment":
+                self._pending.append(self._spawn(self._transcribe(segment)))
+            elif kind == "turn" and self._pending:
+                pending, self._pending = self._pending, []
+                self._turn = self._spawn(self._run_turn(pending, self._turn))
+
+    async def _transcribe(self, segment: Segment) -> tuple[str, Segment, float]:
+        started = time.perf_counter()
+        provider, client, model = self.stt
+        text = await transcribe(provider, client, model, segment.pcm, self.sample_rate)
+        return text, segment, (time.perf_counter() - started) * 1000
+
+    async def _run_turn(self, pending: list[asyncio.Task], previous: Optional[asyncio.Task]) -> None:
+        if previous is not None:
+            await asyncio.gather(previous, return_exceptions=True)
+        results = []
+        for task in pending:
+            try:
+                results.append(await task)
+            except Exception as e:
+                print(f"[Voice] transcription failed: {e}")
+        if not results:
+            return
+        utterance = Utterance(
+            text=_join([text for text, _, _ in results]),
+            speech_end_at=max(seg.speech_end_at for _, seg, _ in results),
+            transcribed_at=time.perf_counter(),
+            segments=len(results),
+            stt_ms=round(sum(ms for _, _, ms in results), 1),
+            audio_ms=round(sum(len(seg.pcm) for _, seg, _ in results) / 2 / self.sample_rate * 1000, 1),
+        )
+        await self.on_turn(utterance)
+
+    async def finish(self) -> None:
+        """録音の終わり: 残りの区間をターンとして送り、処理中のターンが終わるまで待つ。"""
+        self._handle(self.segmenter.flush(time.perf_counter()))
+        if self._turn is not None:
+            await asyncio.gather(self._turn, return_exceptions=True)
+
+    def cancel(self) -> None:
+        for task in list(self._tasks):
+            task.cancel()
+
+
+# 文の区切り（読み上げはこの単位で始める）
+SENTENCE_END_RE = re.compile(r"[。！？!?\n]+|[.:;](?=\s)")
+_MARKDOWN_RE = re.compile(r"https?://\S+|[*_#>`|~]|\[([^\]]*)\]\([^)]*\)")
+
+
+def speakable(sentence: str) -> str:
+    """マークダウンの記号と URL を除く（リンクは表示テキストだけ読む）。"""
+    return _MARKDOWN_RE.sub(lambda m: m.group(1) or "", sentence).strip()
+
+
+@dataclass
+class SpeakerStats:
+    sentences: int = 0
+    chars: int = 0
+    audio_bytes: int = 0
+    first_text_at: Optional[float] = None
+    first_audio_at: Optional[float] = None
+    tts_first_byte_ms: list = field(default_factory=list)
+
+
+class Speaker:
+    """応答のトークンを feed() で受け取り、文ごとに読み上げて PCM チャンクを send に順に渡す。
+
+    コードブロックの中は読まない。close() で残りを読み上げに回し、wait() で読み終わるまで待つ。
+    """
+
+    def __init__(self, client, send: Callable[[bytes], Awaitable[None]], model: str = VOICE_TTS_MODEL, voice: str = VOICE_TTS_VOICE):
+        self.client = client
+        self.send = send
+        self.model = model
+        self.voice = voice
+        self.stats = SpeakerStats()
+        self.spoken: list[str] = []
+        self._buf = ""
+        self._in_code = False
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self._task = asyncio.create_task(self._run(), name="voice-speaker")
+
+    def feed(self, text: str) -> None:
+        if self.stats.first_text_at is None:
+            self.stats.first_text_at = time.perf_counter()
+        self._buf += text
+        while (m := SENTENCE_END_RE.search(self._buf)) is not None:
+            sentence, self._buf = self._buf[:m.end()], self._buf[m.end():]
+            self._enqueue(sentence)
+
+    def _enqueue(self, sentence: str) -> None:
+        if sentence.count("```") % 2:
+            self._in_code = not self._in_code
+            return
+        if self._in_code or "```" in sentence:
+            return
+        text = speakable(sentence)
+        if text:
+            self._queue.put_nowait(text)
+
+    def close(self) -> None:
+        if self._buf:
+            self._enqueue(self._buf)
+            self._buf = ""
+        self._queue.put_nowait(None)
+
+    async def wait(self) -> None:
+        await asyncio.gather(self._task, return_exceptions=True)
+
+    def cancel(self) -> None:
+        self._task.cancel()
+
+    async def _run(self) -> None:
+        while (sentence := await self._queue.get()) is not None:
+            started = time.perf_counter()
+            first = True
+            try:
+                async with self.client.audio.speech.with_streaming_response.create(
+                    model=self.model, voice=self.voice, input=sentence, response_format="pcm",
+                ) as resp:
+                    carry = b""
+                    async for chunk in resp.iter_bytes(VOICE_TTS_CHUNK_BYTES):
+                        chunk, carry = carry + chunk, b""
+                        if len(chunk) % 2:  # PCM16 はサンプルの途中で切らない
+                            chunk, carry = chunk[:-1], chunk[-1:]
+                        if not chunk:
+                            continue
+                        if first:
+                            first = False
+                            self.stats.tts_first_byte_ms.append(round((time.perf_counter() - started) * 1000, 1))
+                            if self.stats.first_audio_at is None:
+                                self.stats.first_audio_at = time.perf_counter()
+                        self.stats.audio_bytes += len(chunk)
+                        await self.send(chunk)
+            except Exception as e:
+                print(f"[Voice] speech failed: {e}")
+                continue
+            self.stats.sentences += 1
+            self.stats.chars += len(sentence)
+            self.spoken.append(sentence)
+
+
+def latency_report(utterance: Utterance, llm_first_token_at: Optional[float], speaker: Optional[Speaker]) -> dict:
+    """話し終わりからの各段階の時間（ms）。"""
+    def since(t):
+        return None if t is None else round((t - utterance.speech_end_at) * 1000, 1)
+
+    report = {
+        "transcribed": since(utterance.transcribed_at),
+        "first_token": since(llm_first_token_at),
+        "mouth_to_ear": None,
+        "segments": utterance.segments,
+        "audio_ms": utterance.audio_ms,
+        "stt_ms": utterance.stt_ms,
+    }
+    if speaker is not None:
+        report["mouth_to_ear"] = since(speaker.stats.first_audio_at)
+        report["tts_first_byte_ms"] = speaker.stats.tts_first_byte_ms[:1]
+        report["sentences"] = speaker.stats.sentences
+    return report
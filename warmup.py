@@ -0,0 +1,65 @@
+"""プロバイダ接続の事前ウォームアップ（チャット開始・モデル切替時にバックグラウンドで実行）。"""
+import asyncio
+import os
+import time
+from typing import Awaitable, Callable, Optional
+
+# 同じプロバイダを温め直すまでの最小間隔（プロセス全体で共有）
+WARMUP_MIN_INTERVAL_SEC = float(os.getenv("WARMUP_MIN_INTERVAL_SEC", "60"))
+# モデル到達確認の結果をキャッシュする時間
+WARMUP_MODEL_CACHE_SEC = float(os.getenv("WARMUP_MODEL_CACHE_SEC", "600"))
+# 同時に走らせるウォームアップ数の上限
+WARMUP_MAX_CONCURRENCY = int(os.getenv("WARMUP_MAX_CONCURRENCY", "2"))
+WARMUP_TIMEOUT_SEC = float(os.getenv("WARMUP_TIMEOUT_SEC", "10"))
+
+WarmFn = Callable[[str], Awaitable[object]]
+
+
+class ProviderWarmer:
+    """プロバイダごとの接続プールを、軽いメタデータ取得（モデル情報）で温めておく。
+
+    - 呼び出し側はブロックしない（タスクを作って即座に戻る）
+    - プロバイダ単位でレート制限し、同じプロバイダへの同時実行もまとめる
+    - 結果（モデルに到達できたか）は一定時間キャッシュする
+    """
+
+    def __init__(self, warm_fns: dict[str, WarmFn]):
+        self.warm_fns = warm_fns
+        self._last_warm: dict[str, float] = {}
+        self._inflight: dict[str, asyncio.Task] = {}
+        self._model_ok: dict[tuple[str, str], tuple[bool, float]] = {}
+        self._sem: Optional[asyncio.Semaphore] = None
+
+    def model_reachable(self, provider: str, model: str) -> Optional[bool]:
+        entry = self._model_ok.get((provider, model))
+        if entry and time.monotonic() - entry[1] < WARMUP_MODEL_CACHE_SEC:
+            return entry[0]
+        return None
+
+    def schedule(self, provider: str, model: str) -> Optional[asyncio.Task]:
+        """ウォームアップを予約する。実行不要（レート制限・実行中・キャッシュ済み）なら None。"""
+        if provider not in self.warm_fns:
+            return None
+        now = time.monotonic()
+        if provider in self._inflight and not self._inflight[provider].done():
+            return None
+        if now - self._last_warm.get(provider, float("-inf")) < WARMUP_MIN_INTERVAL_SEC and self.model_reachable(provider, model) is not None:
+            return None
+        self._last_warm[provider] = now
+        task = asyncio.create_task(self._warm(provider, model), name=f"warmup:{provider}")
+        self._inflight[provider] = task
+        return task
+
+    async def _warm(self, provider: str, model: str) -> None:
+        if self._sem is None:
+            self._sem = asyncio.Semaphore(WARMUP_MAX_CONCURRENCY)
+        async with self._sem:
+            started = time.monotonic()
+            try:
+                await asyncio.wait_for(self.warm_fns[provider](model), timeout=WARMUP_TIMEOUT_SEC)
+                ok = True
+            except Exception as e:
+                ok = False
+                print(f"[Warmup] {provider}:{model} failed: {e}")
+            self._model_ok[(provider, model)] = (ok, time.monotonic())
+            print(f"[Warmup] {provider}:{model} ok={ok} in {(time.monotonic() - started) * 1000:.0f}ms")
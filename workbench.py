@@ -0,0 +1,238 @@
+"""CodeWorkbench への差分（append / replace）送信。全文は最初の1回だけ送る。
+
+画面には差分だけを送り、データレイヤーには全文（と実行出力）のスナップショットを少し遅らせて保存する。
+"""
+import asyncio
+import json
+import os
+import time
+import uuid
+from dataclasses import dataclass, field
+from typing import AsyncIterator, Optional
+
+import chainlit as cl
+from chainlit.data import get_data_layer
+
+
+def _utf16_len(text: str) -> int:
+    """JavaScript の文字列オフセット（UTF-16 コード単位）に合わせた長さ。"""
+    return len(text.encode("utf-16-le")) // 2
+
+
+def make_patch(old: str, new: str) -> Optional[dict]:
+    """old -> new の差分を1つの操作で表す。変化が無ければ None。
+
+    - 末尾への追記: {"op": "append", "text": ...}
+    - それ以外: 共通の先頭・末尾を除いた1区間の置換 {"op": "replace", "start", "end", "text"}
+    オフセットは UTF-16 単位（クライアントの Monaco / JS 文字列と一致させる）。
+    """
+    if old == new:
+        return None
+    if new.startswith(old):
+        return {"op": "append", "text": new[len(old):]}
+    prefix = 0
+    limit = min(len(old), len(new))
+    while prefix < limit and old[prefix] == new[prefix]:
+        prefix += 1
+    suffix = 0
+    while suffix < limit - prefix and old[-1 - suffix] == new[-1 - suffix]:
+        suffix += 1
+    start = _utf16_len(old[:prefix])
+    end = start + _utf16_len(old[prefix:len(old) - suffix])
+    return {"op": "replace", "start": start, "end": end, "text": new[prefix:len(new) - suffix]}
+
+
+# 実行出力の送信間隔（この間に出た出力は1つの更新にまとめる）
+OUTPUT_FLUSH_SEC = float(os.getenv("WORKBENCH_OUTPUT_FLUSH_SEC", "0.1"))
+# サーバー側に保持する実行出力の上限（再同期用）
+OUTPUT_MAX_CHARS = int(os.getenv("WORKBENCH_OUTPUT_MAX_CHARS", "200000"))
+# 全文スナップショットを保存するまでの待ち時間（この間の更新は1回の保存にまとめる）
+PERSIST_DELAY_SEC = float(os.getenv("WORKBENCH_PERSIST_DELAY_SEC", "1.0"))
+
+
+def apply_patch(text: str, patch: dict) -> str:
+    """（検証用）クライアントと同じ規則で差分を適用する。"""
+    op = patch["op"]
+    if op.startswith("output"):
+        return text  # 実行出力の操作は本文を変えない
+    if op == "reset":
+        return patch["text"]
+    if op == "append":
+        return text + patch["text"]
+    units = text.encode("utf-16-le")
+    head = units[: patch["start"] * 2].decode("utf-16-le")
+    tail = units[patch["end"] * 2:].decode("utf-16-le")
+    return head + patch["text"] + tail
+
+
+@dataclass
+class WorkbenchDocument:
+    """サイドバーに表示中のドキュメント（サーバー側の正本）。"""
+    doc_id: str
+    text: str
+    meta: dict
+    seq: int = 0
+    element: Optional[cl.CustomElement] = None
+    bytes_sent: list = field(default_factory=list)
+    # 実行出力 [{"stream": "stdout" | "stderr", "text": ...}]
+    output: list = field(default_factory=list)
+    output_chars: int = 0
+    persist_task: Optional[asyncio.Task] = None
+
+
+def snapshot_props(doc: WorkbenchDocument) -> dict:
+    """全文と実行出力を持つ props（保存用。読み込み直したときはこれだけで復元できる）。"""
+    return {
+        **doc.meta,
+        "docId": doc.doc_id,
+        "seq": doc.seq,
+        "patch": {"op": "reset", "text": doc.text, "base": doc.seq - 1},
+        "output": doc.output,
+        "key": f"workbench-{doc.doc_id}",
+    }
+
+
+async def _persist_later(doc: WorkbenchDocument) -> None:
+    data_layer = get_data_layer()
+    while data_layer is not None and doc.element is not None:
+        await asyncio.sleep(PERSIST_DELAY_SEC)
+        seq = doc.seq
+        # 画面上の要素と同じ id で上書き保存する（差分ではなく全文）
+        snapshot = cl.CustomElement(
+            id=doc.element.id,
+            name=doc.element.name,
+            props=snapshot_props(doc),
+            display=doc.element.display,
+            for_id=doc.element.for_id,
+        )
+        try:
+            await data_layer.create_element(snapshot)
+        except Exception as e:
+            print(f"[Workbench] failed to persist {doc.doc_id}: {e}")
+            return
+        if doc.seq == seq:
+            return
+        # 保存中に届いた更新も保存する
+
+
+def schedule_persist(doc: WorkbenchDocument) -> None:
+    if get_data_layer() is None or (doc.persist_task is not None and not doc.persist_task.done()):
+        return
+    doc.persist_task = asyncio.create_task(_persist_later(doc), name=f"workbench-persist-{doc.doc_id}")
+
+
+async def send_workbench(doc: WorkbenchDocument, patch: dict, sidebar_title: str) -> None:
+    doc.seq += 1
+    props = {
+        **doc.meta,
+        "docId": doc.doc_id,
+        "seq": doc.seq,
+        "patch": {**patch, "base": doc.seq - 1},
+        "key": f"workbench-{doc.doc_id}",
+    }
+    if doc.element is None:
+        doc.element = cl.CustomElement(name="CodeWorkbench", props=props, display="inline")
+    doc.element.props = props
+    # セッションのファイルに書かれる content は最新の（小さい）props にそろえる。全文は schedule_persist で保存する
+    doc.element.content = json.dumps(props, ensure_ascii=False)
+    doc.bytes_sent.append(len(doc.element.content.encode("utf-8")))
+    await cl.ElementSidebar.set_title(sidebar_title)
+    # サイドバーは key が前回と同じだと要素を差し替えない（新しい props が届かない）ので、更新ごとに key を変える。
+    # 要素の id は同じなので、CodeWorkbench は DOC_STORE の正本に差分を適用し続けられる
+    await cl.ElementSidebar.set_elements([doc.element], key=f"{doc.doc_id}:{doc.seq}")
+    schedule_persist(doc)
+
+
+async def update_workbench(code: str, meta: dict, sidebar_title: str = "Code Workbench") -> WorkbenchDocument:
+    """セッションのワークベンチを code の内容にする。同じドキュメントなら差分だけ送る。"""
+    code = code or ""
+    doc: Optional[WorkbenchDocument] = cl.user_session.get("workbench_doc")
+    if doc is None or doc.meta != meta:
+        doc = WorkbenchDocument(doc_id=uuid.uuid4().hex[:12], text=code, meta=meta)
+        cl.user_session.set("workbench_doc", doc)
+        await send_workbench(doc, {"op": "reset", "text": code}, sidebar_title)
+        return doc
+    patch = make_patch(doc.text, code)
+    doc.text = code
+    if patch is None:
+        # 内容が同じでもサイドバーは開き直す（閉じられていなければ何も変わらない）
+        await cl.ElementSidebar.set_title(sidebar_title)
+        await cl.ElementSidebar.set_elements([doc.element], key=f"{doc.doc_id}:{doc.seq}")
+        return doc
+    await send_workbench(doc, patch, sidebar_title)
+    return doc
+
+
+async def resync_workbench(doc_id: str) -> None:
+    """クライアントが差分を取りこぼした（再マウント・再接続など）ときに全文を送り直す。"""
+    doc: Optional[WorkbenchDocument] = cl.user_session.get("workbench_doc")
+    if doc is None or doc.doc_id != doc_id:
+        return
+    await send_workbench(doc, {"op": "reset", "text": doc.text}, "Code Workbench")
+    if doc.output:
+        await send_workbench(doc, {"op": "output_reset", "chunks": doc.output}, "Code Workbench")
+
+
+def _keep_output(doc: WorkbenchDocument, stream: str, text: str) -> None:
+    if doc.output and doc.output[-1]["stream"] == stream:
+        doc.output[-1] = {"stream": stream, "text": doc.output[-1]["text"] + text}
+    else:
+        doc.output.append({"stream": stream, "text": text})
+    doc.output_chars += len(text)
+    while doc.output_chars > OUTPUT_MAX_CHARS and len(doc.output) > 1:
+        doc.output_chars -= len(doc.output.pop(0)["text"])
+
+
+async def stream_output(
+    doc: WorkbenchDocument,
+    events: AsyncIterator[tuple[str, object]],
+    sidebar_title: str = "Code Workbench",
+) -> Optional[dict]:
+    """実行イベント（("stdout" | "stderr", text) ... ("exit", info)）をワークベンチの出力欄へ流す。
+
+    出力は OUTPUT_FLUSH_SEC ごとにまとめて送る。戻り値は exit の情報。
+    """
+    doc.output, doc.output_chars = [], 0
+    await send_workbench(doc, {"op": "output_reset", "chunks": [], "running": True}, sidebar_title)
+    pending: list[dict] = []
+    last_flush = time.monotonic()
+    lock = asyncio.Lock()  # seq の順序を保つため送信は1本ずつ
+    timer: Optional[asyncio.Task] = None
+    info = None
+
+    async def flush():
+        nonlocal pending, last_flush
+        async with lock:
+            if pending:
+                chunks, pending = pending, []
+                await send_workbench(doc, {"op": "output", "chunks": chunks}, sidebar_title)
+            last_flush = time.monotonic()
+
+    async def flush_later(delay: float):
+        # 出力の後しばらく何も出ない場合でも、まとめ待ちの出力を送る
+        await asyncio.sleep(delay)
+        await flush()
+
+    try:
+        async for kind, payload in events:
+            if kind == "exit":
+                info = payload
+                break
+            text = str(payload)
+            _keep_output(doc, kind, text)
+            if pending and pending[-1]["stream"] == kind:
+                pending[-1]["text"] += text
+            else:
+                pending.append({"stream": kind, "text": text})
+            wait = OUTPUT_FLUSH_SEC - (time.monotonic() - last_flush)
+            if wait <= 0:
+                await flush()
+            elif timer is None or timer.done():
+                timer = asyncio.create_task(flush_later(wait))
+    finally:
+        # 送信途中で止めると seq がずれるので、予約済みの送信は待つ
+        if timer is not None:
+            await asyncio.gather(timer, return_exceptions=True)
+    await flush()
+    await send_workbench(doc, {"op": "output_exit", **(info or {})}, sidebar_title)
+    return info